@@ -1,12 +1,46 @@
 import os
+import io
+import struct
 import hashlib
+import hmac
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Protocol.KDF import scrypt
 from Cryptodome.Cipher import AES
+from Cryptodome.Hash import SHA256
+from Cryptodome.Protocol.KDF import HKDF
 from Cryptodome.Random import get_random_bytes
 
 # The size in bytes that we read, encrypt and write to at once
 BUFFER_SIZE = 1024 * 1024  # ~ 1 Mb
 
+# Encrypted file layout
+# v1: salt (32) + nonce (16) + data + tag (16), key = scrypt(password, salt)
+# v2: MAGIC (4) + VERSION (1) + salt (32) + nonce (16) + data + tag (16),
+#     key = HKDF(meeting master key, salt)
+# v3: MAGIC (4) + CHUNKED_VERSION (1) + salt (32) + nonce prefix (7)
+#     + chunk size (4), then every chunk of data sealed on its own:
+#     encrypted chunk + tag (16), key = HKDF(meeting master key, salt)
+MAGIC = b'RDRP'
+VERSION = 2
+CHUNKED_VERSION = 3
+SALT_SIZE = 32
+NONCE_SIZE = 16
+PREFIX_SIZE = 7
+TAG_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 1 + SALT_SIZE + NONCE_SIZE
+CHUNKED_HEADER_SIZE = len(MAGIC) + 1 + SALT_SIZE + PREFIX_SIZE + 4
+
+# The size in bytes of the chunks sealed on their own (v3)
+CHUNK_SIZE = 64 * 1024  # 64 Kb
+
+# Files of at least this size are encrypted and decrypted by WORKERS threads.
+# The cipher releases the GIL, so threads use every core
+# without copying the chunks to other processes
+PARALLEL_THRESHOLD = 32 * 1024 * 1024  # 32 Mb
+WORKERS = os.cpu_count() or 1
+
 
 # We're gonna HASH the password that is composed of a unique meeting ID concatenated with a random password
 # returned signature will be our pre-shared password for the AES-GCM crypto
@@ -25,7 +59,354 @@ def encrypt_sha256(ID, meeting_pw):
     return sha_signature
 
 
-def encrypt_AES(input_filename, password):
+def meeting_salt(meeting_uid):
+    """ Salt of the meeting master key.
+        Every attendant must derive the same master key,
+        so it is computed from the meeting uid instead of being random
+    """
+    return hashlib.sha256(b'roomdrop meeting key ' +
+                          str(meeting_uid).encode()).digest()
+
+
+class MeetingKey:
+    """ Keys used to encrypt and decrypt the files of a meeting.
+        The expensive scrypt derivation is done once per session,
+        every file then gets its own subkey with a cheap HKDF over its salt
+    """
+    def __init__(self, password, meeting_uid):
+        # Kept to decrypt files in the v1 format
+        self.password = password
+
+        # use the Scrypt KDF to get the master key from the password
+        self.master_key = scrypt(password,
+                                 meeting_salt(meeting_uid),
+                                 key_len=32,
+                                 N=2**17,
+                                 r=8,
+                                 p=1)
+
+    def file_key(self, salt):
+        # Derive the file subkey from the master key and the file salt
+        return HKDF(self.master_key, 32, salt, SHA256, context=MAGIC)
+
+    def digest_key(self):
+        # Key of the content digests, unrelated to the file subkeys
+        return HKDF(self.master_key, 32, b'', SHA256, context=MAGIC + b'DGST')
+
+
+def file_digest(file_in, key):
+    """ Meeting scoped digest of a plaintext (HMAC-SHA256).
+        Files of the meeting with the same content get the same digest,
+        so the server stores them once without learning their content
+        or being able to compare them with files of other meetings
+    """
+    digest = hmac.new(key.digest_key(), digestmod=hashlib.sha256)
+    data = memoryview(bytearray(BUFFER_SIZE))
+
+    while True:
+        length = _readinto(file_in, data)
+
+        if length == 0:
+            return digest.hexdigest()
+
+        digest.update(data[:length])
+
+
+class ChunkedCipher:
+    """ Seals every chunk of a file on its own (STREAM construction).
+        The nonce of a chunk is made of the file nonce prefix, the chunk index
+        and a flag only set on the last chunk. Chunks can be decrypted
+        independently, but a reordered, dropped or truncated chunk
+        fails the verification
+    """
+    def __init__(self, key, salt=None, prefix=None, chunk_size=CHUNK_SIZE):
+        # generate a random salt and nonce prefix for a new file
+        self.salt = salt if salt is not None else get_random_bytes(SALT_SIZE)
+        self.prefix = prefix if prefix is not None else get_random_bytes(
+            PREFIX_SIZE)
+        self.chunk_size = chunk_size
+
+        self.key = key.file_key(self.salt)
+
+        self.header = MAGIC + bytes([CHUNKED_VERSION]) + self.salt + \
+            self.prefix + struct.pack('>I', chunk_size)
+
+    def _cipher(self, index, last):
+        nonce = self.prefix + struct.pack('>I', index) + bytes([last])
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+
+        # The header is authenticated along with every chunk
+        cipher.update(self.header)
+
+        return cipher
+
+    def encrypt(self, index, data, last):
+        # Encrypted chunk followed by its tag
+        encrypted_data, tag = self._cipher(index, last).encrypt_and_digest(data)
+
+        return encrypted_data + tag
+
+    def decrypt(self, index, data, last):
+        # Raises a ValueError if the chunk was tampered with
+        return self._cipher(index, last).decrypt_and_verify(
+            data[:-TAG_SIZE], data[-TAG_SIZE:])
+
+    def encrypt_into(self, index, data, last, output):
+        """ Write the encrypted chunk and its tag into the output buffer.
+            Returns the number of bytes written
+        """
+        size = len(data)
+        cipher = self._cipher(index, last)
+
+        cipher.encrypt(data, output=output[:size])
+        output[size:size + TAG_SIZE] = cipher.digest()
+
+        return size + TAG_SIZE
+
+    def decrypt_into(self, index, data, last, output):
+        """ Write the decrypted chunk into the output buffer.
+            Returns the number of bytes written
+        """
+        size = len(data) - TAG_SIZE
+
+        self._cipher(index, last).decrypt_and_verify(data[:size],
+                                                     data[size:],
+                                                     output=output[:size])
+
+        return size
+
+
+def _read_header(file_in, key):
+    """ Read the header of an encrypted file and create the matching cipher.
+        Returns the cipher and the size of the header
+    """
+    magic = file_in.read(len(MAGIC))
+    version = file_in.read(1)
+
+    if magic == MAGIC and version == bytes([VERSION]):
+        # Read salt and derive the file subkey
+        salt = file_in.read(SALT_SIZE)
+        nonce = file_in.read(NONCE_SIZE)
+
+        cipher = AES.new(key.file_key(salt), AES.MODE_GCM, nonce=nonce)
+
+        # The header is authenticated along with the data
+        cipher.update(magic + version + salt + nonce)
+
+        return cipher, HEADER_SIZE
+
+    if magic == MAGIC and version == bytes([CHUNKED_VERSION]):
+        salt = file_in.read(SALT_SIZE)
+        prefix = file_in.read(PREFIX_SIZE)
+        chunk_size, = struct.unpack('>I', file_in.read(4))
+
+        return ChunkedCipher(key, salt, prefix,
+                             chunk_size), CHUNKED_HEADER_SIZE
+
+    # Otherwise the file has no header (v1): start over from the salt
+    file_in.seek(0)
+
+    salt = file_in.read(SALT_SIZE)  # The salt we generated was 32 bits long
+
+    derived_key = scrypt(key.password, salt, key_len=32, N=2**17, r=8,
+                         p=1)  # Generate a key using the password and salt again
+
+    # Read nonce and create cipher
+    nonce = file_in.read(NONCE_SIZE)  # The nonce is 16 bytes long
+    cipher = AES.new(derived_key, AES.MODE_GCM, nonce=nonce)
+
+    return cipher, SALT_SIZE + NONCE_SIZE
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Threads are created on first use, after FUSE forked to the background
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(WORKERS)
+
+        return _executor
+
+
+def workers_for(size):
+    # Small files are not worth the threads synchronization
+    return WORKERS if size >= PARALLEL_THRESHOLD else 1
+
+
+def _map_chunks(function, chunks, workers):
+    """ Call function(index, data, last) on every chunk and yield the results
+        in order. With several workers, up to 2 * workers chunks are processed
+        at the same time by the shared thread pool
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield function(*chunk)
+        return
+
+    executor = _get_executor()
+    pending = deque()
+
+    for chunk in chunks:
+        pending.append(executor.submit(function, *chunk))
+
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def chunk_count(size, chunk_size=CHUNK_SIZE):
+    # An empty file still has one (empty) chunk that carries a tag
+    return max(1, -(-size // chunk_size))
+
+
+def encrypted_size(size):
+    # Size of the encrypted file: header + data + a tag for every chunk
+    return CHUNKED_HEADER_SIZE + size + chunk_count(size) * TAG_SIZE
+
+
+def encrypt_stream(file_in,
+                   key,
+                   size=None,
+                   workers=1,
+                   chunk_size=CHUNK_SIZE):
+    """ Encrypt an opened file chunk by chunk.
+        Yields the header and then every sealed chunk,
+        so the encrypted file never has to be written to the disk.
+        If size is given, at most size bytes are read from file_in.
+
+        With one worker, the chunks are read and encrypted into reused
+        buffers: a yielded chunk is only valid until the next one is asked for
+    """
+    cipher = ChunkedCipher(key, chunk_size=chunk_size)
+
+    yield cipher.header
+
+    if workers > 1:
+        yield from _map_chunks(cipher.encrypt, _read_chunks(file_in, cipher,
+                                                            size), workers)
+        return
+
+    # Two input buffers: the chunk being encrypted and the one read ahead
+    # to know which chunk is the last one
+    data = memoryview(bytearray(cipher.chunk_size))
+    next_data = memoryview(bytearray(cipher.chunk_size))
+    output = memoryview(bytearray(cipher.chunk_size + TAG_SIZE))
+
+    remaining = size
+    length = _readinto(file_in, data, remaining)
+
+    index = 0
+    while True:
+        if remaining is not None:
+            remaining -= length
+
+        next_length = _readinto(file_in, next_data, remaining)
+        last = next_length == 0
+
+        yield output[:cipher.encrypt_into(index, data[:length], last, output)]
+
+        if last:
+            break
+
+        data, next_data = next_data, data
+        length = next_length
+        index += 1
+
+
+def _readinto(file_in, buffer, remaining=None):
+    # Fill the buffer, or read the remaining bytes, until the end of file
+    if remaining is not None:
+        buffer = buffer[:min(len(buffer), remaining)]
+
+    length = 0
+    while length < len(buffer):
+        read = file_in.readinto(buffer[length:])
+
+        if not read:
+            break
+
+        length += read
+
+    return length
+
+
+def _read_chunks(file_in, cipher, size=None):
+    """ Yield (index, data, last) for every chunk of the file to encrypt """
+    remaining = size
+
+    def read_chunk():
+        nonlocal remaining
+
+        length = cipher.chunk_size if remaining is None else min(
+            cipher.chunk_size, remaining)
+        data = file_in.read(length) if length > 0 else b''
+
+        if remaining is not None:
+            remaining -= len(data)
+
+        return data
+
+    # Read one chunk ahead to know which chunk is the last one
+    index = 0
+    data = read_chunk()
+
+    while True:
+        next_data = read_chunk()
+        last = len(next_data) == 0
+
+        yield index, data, last
+
+        if last:
+            break
+
+        data = next_data
+        index += 1
+
+
+def encrypt_range(file_in, cipher, size, offset, length):
+    """ Bytes [offset, offset + length) of the encrypted file of an opened file
+        of size bytes. Only the chunks covering the range are encrypted, so
+        ranges of the same encrypted file can be produced again later on,
+        as long as the same cipher (salt and nonce prefix) is used
+    """
+    end = offset + length
+    header = cipher.header
+    segment_size = cipher.chunk_size + TAG_SIZE
+    chunks = chunk_count(size, cipher.chunk_size)
+
+    encrypted = []
+
+    if offset < len(header):
+        encrypted.append(header[offset:end])
+
+    # First chunk covering the range
+    index = max(0, offset - len(header)) // segment_size
+
+    while index < chunks:
+        start = len(header) + index * segment_size
+
+        if start >= end:
+            break
+
+        file_in.seek(index * cipher.chunk_size)
+        data = file_in.read(min(cipher.chunk_size,
+                                size - index * cipher.chunk_size))
+        sealed = cipher.encrypt(index, data, index == chunks - 1)
+
+        encrypted.append(sealed[max(0, offset - start):end - start])
+        index += 1
+
+    return b''.join(encrypted)
+
+
+def encrypt_AES(input_filename, key):
     output_filename = input_filename + '.encrypted'  # The crypted filename
 
     # Open files
@@ -35,42 +416,187 @@ def encrypt_AES(input_filename, password):
         output_filename,
         'wb')  # wb = write bytes. Required to write the encrypted data
 
-    # generate a random salt
-    salt = get_random_bytes(32)
+    # Write the header and the sealed chunks
+    workers = workers_for(os.fstat(file_in.fileno()).st_size)
 
-    # use the Scrypt KDF to get a private key from the password
-    key = scrypt(password, salt, key_len=32, N=2**17, r=8,
-                 p=1)  # Generate a key using the password and salt
+    for chunk in encrypt_stream(file_in, key, workers=workers):
+        file_out.write(chunk)
 
-    # Write the salt to the top of the output file
-    file_out.write(salt)
+    # Close both files
+    file_in.close()
+    file_out.close()
 
-    # create cipher config
-    cipher = AES.new(key, AES.MODE_GCM)
+    return output_filename
 
-    # Write out the nonce to the output file under the salt
-    file_out.write(cipher.nonce)
 
-    # Read, encrypt and write the data
-    data = file_in.read(BUFFER_SIZE)  # Read in some of the file
-    while len(data) != 0:  # Check if we need to encrypt anymore data
-        encrypted_data = cipher.encrypt(data)  # Encrypt the data we read
-        file_out.write(
-            encrypted_data)  # Write the encrypted data to the output file
-        data = file_in.read(
-            BUFFER_SIZE
-        )  # Read some more of the file to see if there is any more left
+class StreamDecryptor:
+    """ Decrypt an encrypted file received by chunks, without knowing its size.
+        What could be the end of the file (the tag in v1 and v2,
+        the last sealed chunk in v3) is held back until finalize()
+    """
+    def __init__(self, key, workers=1):
+        self.key = key
+        self.workers = workers
+        self.cipher = None
+        self.buffer = bytearray()
+        self.output = bytearray()
+        self.index = 0  # index of the next chunk (v3)
 
-    # Get and write the tag for decryption verification
-    tag = cipher.digest(
-    )  # Signal to the cipher that we are done and get the tag
-    file_out.write(tag)
+    def update(self, chunk):
+        """ Returns the data decrypted so far.
+            It is only valid until the next call to update()
+        """
+        self.buffer += chunk
 
-    # Close both files
-    file_in.close()
-    file_out.close()
+        # Wait for the whole header before creating the cipher
+        if self.cipher is None:
+            if len(self.buffer) < max(HEADER_SIZE, CHUNKED_HEADER_SIZE):
+                return b''
 
-    return output_filename
+            self.cipher, header_size = _read_header(
+                io.BytesIO(self.buffer), self.key)
+            del self.buffer[:header_size]
+
+        if isinstance(self.cipher, ChunkedCipher):
+            return self._update_chunks()
+
+        # Decrypt everything but what could be the tag
+        if len(self.buffer) <= TAG_SIZE:
+            return b''
+
+        data = self.buffer[:-TAG_SIZE]
+        del self.buffer[:-TAG_SIZE]
+
+        return self.cipher.decrypt(data)
+
+    def _update_chunks(self):
+        segment_size = self.cipher.chunk_size + TAG_SIZE
+
+        # Number of complete chunks but what could be the last one
+        count = (len(self.buffer) - 1) // segment_size
+        if count <= 0:
+            return b''
+
+        with memoryview(self.buffer) as view:
+            chunks = [(self.index + i,
+                       view[i * segment_size:(i + 1) * segment_size], False)
+                      for i in range(count)]
+
+            if self.workers > 1:
+                decrypted = b''.join(
+                    _map_chunks(self.cipher.decrypt, chunks, self.workers))
+            else:
+                decrypted = self._decrypt_into_output(chunks)
+
+            for chunk in chunks:
+                chunk[1].release()
+
+        self.index += count
+        del self.buffer[:count * segment_size]
+
+        return decrypted
+
+    def _decrypt_into_output(self, chunks):
+        # The output buffer only grows, it is reused between updates
+        size = len(chunks) * self.cipher.chunk_size
+        if len(self.output) < size:
+            self.output = bytearray(size)
+
+        output = memoryview(self.output)
+        position = 0
+
+        for index, data, last in chunks:
+            position += self.cipher.decrypt_into(index, data, last,
+                                                 output[position:])
+
+        return output[:position]
+
+    def finalize(self):
+        """ Verify the end of the file and return the data left to write """
+        if self.cipher is None or len(self.buffer) < TAG_SIZE:
+            raise ValueError('Truncated encrypted file')
+
+        if isinstance(self.cipher, ChunkedCipher):
+            return self.cipher.decrypt(self.index, self.buffer, True)
+
+        # Verify encrypted file was not tampered with
+        if len(self.buffer) != TAG_SIZE:
+            raise ValueError('Truncated encrypted file')
+
+        self.cipher.verify(self.buffer)
+
+        return b''
+
+
+class ChunkedReader:
+    """ Random access to the data of a file encrypted by chunks (v3).
+        Only the chunks covering the requested range are read and verified
+    """
+    def __init__(self, file_in, key):
+        self.file_in = file_in
+        self.cipher, header_size = _read_header(file_in, key)
+
+        if not isinstance(self.cipher, ChunkedCipher):
+            raise ValueError('Not a chunked encrypted file')
+
+        self.segment_size = self.cipher.chunk_size + TAG_SIZE
+
+        # Number of chunks and size of the decrypted data
+        encrypted_data_size = os.fstat(
+            file_in.fileno()).st_size - CHUNKED_HEADER_SIZE
+        self.chunks = max(1, -(-encrypted_data_size // self.segment_size))
+        self.size = encrypted_data_size - self.chunks * TAG_SIZE
+
+        if self.size < 0:
+            raise ValueError('Truncated encrypted file')
+
+    def read_chunk(self, index):
+        self.file_in.seek(CHUNKED_HEADER_SIZE + index * self.segment_size)
+        data = self.file_in.read(self.segment_size)
+
+        return self.cipher.decrypt(index, data, index == self.chunks - 1)
+
+    def read_all(self, workers=1):
+        """ Yield the decrypted chunks in order.
+            With one worker, the chunks are read and decrypted into reused
+            buffers: a yielded chunk is only valid until the next one
+        """
+        self.file_in.seek(CHUNKED_HEADER_SIZE)
+
+        if workers > 1:
+            chunks = ((index, self.file_in.read(self.segment_size),
+                       index == self.chunks - 1)
+                      for index in range(self.chunks))
+
+            yield from _map_chunks(self.cipher.decrypt, chunks, workers)
+            return
+
+        data = memoryview(bytearray(self.segment_size))
+        output = memoryview(bytearray(self.cipher.chunk_size))
+
+        for index in range(self.chunks):
+            length = _readinto(self.file_in, data)
+            length = self.cipher.decrypt_into(index, data[:length],
+                                              index == self.chunks - 1,
+                                              output)
+
+            yield output[:length]
+
+    def read(self, offset, length):
+        if length <= 0 or offset >= self.size:
+            return b''
+
+        chunk_size = self.cipher.chunk_size
+
+        # Chunks covering the range
+        first = offset // chunk_size
+        last = min((offset + length - 1) // chunk_size, self.chunks - 1)
+
+        data = b''.join(
+            self.read_chunk(index) for index in range(first, last + 1))
+
+        start = offset - first * chunk_size
+        return data[start:start + length]
 
 
 # Base code coming from : https://nitratine.net/blog/post/python-gcm-encryption-tutorial/ then modified to be implemented to the project
@@ -103,14 +629,19 @@ def _encrypt_AES(filename, password):
     # Write out the nonce to the output file under the salt
     file_out.write(cipher.nonce)
 
+    # Buffers reused for every read and encryption
+    data = memoryview(bytearray(BUFFER_SIZE))
+    encrypted_data = memoryview(bytearray(BUFFER_SIZE))
+
     # Read, encrypt and write the data
-    data = file_in.read(BUFFER_SIZE)  # Read in some of the file
-    while len(data) != 0:  # Check if we need to encrypt anymore data
-        encrypted_data = cipher.encrypt(data)  # Encrypt the data we read
-        file_out.write(
-            encrypted_data)  # Write the encrypted data to the output file
-        data = file_in.read(
-            BUFFER_SIZE
+    length = file_in.readinto(data)  # Read in some of the file
+    while length:  # Check if we need to encrypt anymore data
+        cipher.encrypt(data[:length], output=encrypted_data[:length]
+                       )  # Encrypt the data we read
+        file_out.write(encrypted_data[:length]
+                       )  # Write the encrypted data to the output file
+        length = file_in.readinto(
+            data
         )  # Read some more of the file to see if there is any more left
 
     # Get and write the tag for decryption verification
@@ -125,7 +656,7 @@ def _encrypt_AES(filename, password):
     return output_filename
 
 
-def decrypt_AES(input_filename, password):
+def decrypt_AES(input_filename, key):
     # The decrypted file
     # output_filename = os.path.splitext(filename)[0]
     output_filename = input_filename.replace('.encrypted', '')
@@ -134,42 +665,56 @@ def decrypt_AES(input_filename, password):
     file_in = open(input_filename, 'rb')
     file_out = open(output_filename, 'wb')
 
-    # Read salt and generate key
-    salt = file_in.read(32)  # The salt we generated was 32 bits long
+    # Read header and create cipher
+    cipher, header_size = _read_header(file_in, key)
 
-    key = scrypt(password, salt, key_len=32, N=2**17, r=8,
-                 p=1)  # Generate a key using the password and salt again
+    # Files encrypted by chunks are decrypted chunk by chunk
+    if isinstance(cipher, ChunkedCipher):
+        file_in.seek(0)
 
-    # Read nonce and create cipher
-    nonce = file_in.read(16)  # The nonce is 16 bytes long
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        try:
+            reader = ChunkedReader(file_in, key)
+
+            for data in reader.read_all(workers_for(reader.size)):
+                file_out.write(data)
+        except ValueError as e:
+            # If a chunk was tampered with, we delete the file we created
+            file_in.close()
+            file_out.close()
+            os.remove(output_filename)
+            raise e
+
+        file_in.close()
+        file_out.close()
+        return
 
     # Identify how many bytes of encrypted there is
-    # We know that the salt (32) + the nonce (16) + the data (?) + the tag (16) is in the file
+    # We know that the header (?) + the data (?) + the tag (16) is in the file
     # So some basic algebra can tell us how much data we need to read to decrypt
     file_in_size = os.path.getsize(input_filename)
-    encrypted_data_size = file_in_size - 32 - 16 - 16  # Total - salt - nonce - tag = encrypted data
+    encrypted_data_size = file_in_size - header_size - TAG_SIZE  # Total - header - tag = encrypted data
+
+    # Buffers reused for every read and decryption
+    data = memoryview(bytearray(BUFFER_SIZE))
+    decrypted_data = memoryview(bytearray(BUFFER_SIZE))
 
     # Read, decrypt and write the data
-    for _ in range(
-            int(encrypted_data_size / BUFFER_SIZE)
-    ):  # Identify how many loops of full buffer reads we need to do
-        data = file_in.read(
-            BUFFER_SIZE)  # Read in some data from the encrypted file
-        decrypted_data = cipher.decrypt(data)  # Decrypt the data
-        file_out.write(
-            decrypted_data)  # Write the decrypted data to the output file
-
-    data = file_in.read(
-        int(encrypted_data_size % BUFFER_SIZE
-            ))  # Read whatever we have calculated to be left of encrypted data
-
-    decrypted_data = cipher.decrypt(data)  # Decrypt the data
-    file_out.write(
-        decrypted_data)  # Write the decrypted data to the output file
+    remaining = encrypted_data_size
+    while remaining > 0:
+        # Read in some data from the encrypted file
+        length = _readinto(file_in, data, remaining)
+        if length == 0:
+            break
+
+        remaining -= length
+
+        cipher.decrypt(data[:length],
+                       output=decrypted_data[:length])  # Decrypt the data
+        file_out.write(decrypted_data[:length]
+                       )  # Write the decrypted data to the output file
 
     # Verify encrypted file was not tampered with
-    tag = file_in.read(16)
+    tag = file_in.read(TAG_SIZE)
 
     try:
         cipher.verify(tag)
@@ -1,5 +1,7 @@
-import requests, json, os
-from aes import encrypt_sha256, encrypt_AES, decrypt_AES
+import requests, json, os, tempfile, hashlib
+from requests.adapters import HTTPAdapter
+from uuid import uuid4
+from aes import BUFFER_SIZE, encrypt_sha256, encrypt_range, file_digest, encrypt_stream, encrypted_size, workers_for, ChunkedCipher, MeetingKey, StreamDecryptor
 
 HOST_CREDS_PATH = '/tmp/host.credentials.json'
 GUEST_CREDS_PATH = '/tmp/guest.credentials.json'
@@ -14,43 +16,217 @@ REMOTE = 'https://pacific-wave-46729.herokuapp.com'
 # Url used for requests
 API_URL = LOCAL if DEBUG is True else REMOTE
 
+# Number of transfers that can run at the same time,
+# which is also the number of connections kept alive to the server
+TRANSFER_CONCURRENCY = 4
+
+# (connect, read) timeouts in seconds of every request
+TIMEOUT = (5, 60)
+
+# Files of at least this size are uploaded chunk by chunk,
+# so an interrupted upload can be resumed
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024  # 8 Mb
+
+# Size of the encrypted chunks sent by resumable uploads
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4 Mb
+
+# Number of times an interrupted upload is resumed
+UPLOAD_RETRIES = 3
+
+# Files smaller than this are uploaded together by upload_many(),
+# in requests of at most BULK_UPLOAD_FILES files and BULK_UPLOAD_SIZE bytes
+BULK_UPLOAD_THRESHOLD = 1024 * 1024  # 1 Mb
+BULK_UPLOAD_FILES = 100
+BULK_UPLOAD_SIZE = 16 * 1024 * 1024  # 16 Mb
+
+# Where resumable uploads are remembered, to resume them after a restart
+UPLOADS_STATE_PATH = '/tmp/roomdrop-uploads'
+
+# Number of times an interrupted download is resumed
+DOWNLOAD_RETRIES = 3
+
+# Where the ETags of downloaded files are remembered,
+# so files that didn't change are not downloaded again
+DOWNLOADS_STATE_PATH = '/tmp/roomdrop-downloads'
+
+
+class FileChangedError(Exception):
+    """ A file changed while it was being uploaded """
+
+
+def create_session(pool_size=TRANSFER_CONCURRENCY + 2):
+    """ Session that keeps up to pool_size connections to the server alive,
+        so requests don't pay for a new TCP and TLS handshake every time.
+
+        The pool leaves room for a download and a manifest next to the
+        TRANSFER_CONCURRENCY uploads. It doesn't block when it is busy: the
+        requests past pool_size open a connection of their own, thrown away
+        afterwards, rather than waiting without a timeout for a transfer to end
+    """
+    session = requests.Session()
+
+    # Only API_URL is requested, so one pool is enough
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=pool_size,
+                          pool_block=False)
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def is_file_response(res):
+    # Errors are sent back as JSON, files as attachments
+    return res.status_code in (200, 206) and not res.headers.get(
+        'Content-Type', '').startswith('application/json')
+
+
+def is_hidden(path):
+    # Trash, version control and temporary files of the editors stay local
+    return '.Trash' in path or '.git' in path or '.goutputstream' in path
+
+
+def encrypted_filename(path):
+    # The server stores the encrypted file under FILENAME.encrypted
+    return os.path.basename(path) + '.encrypted'
+
+
+def encrypt_file(path, key, size):
+    """ Encrypted content of the file at path, read up to the size it had
+        when the request was prepared. FileChangedError is raised before
+        the request is complete if the file changed size meanwhile,
+        rather than sending a truncated file or fewer bytes than announced
+    """
+    sent = 0
+
+    with open(path, 'rb') as file_in:
+        for data in encrypt_stream(file_in, key, size, workers_for(size)):
+            sent += len(data)
+            yield data
+
+        current_size = os.fstat(file_in.fileno()).st_size
+
+    if sent != encrypted_size(size) or current_size != size:
+        raise FileChangedError(f'{path} changed while it was uploaded: '
+                               f'{size} bytes expected, {current_size} found')
+
+
+class EncryptedUpload:
+    """ multipart/form-data request body that encrypts a file while it is sent.
+        requests streams any iterable that has a length,
+        so only one buffer of the file is in memory at a time
+        and the encrypted file is never written to the disk
+    """
+    def __init__(self, path, key, field='file'):
+        self.path = path
+        self.key = key
+
+        # The size is fixed now for the Content-Length,
+        # encrypt_file() checks that it is what is sent
+        self.size = os.path.getsize(path)
+
+        filename = encrypted_filename(path).replace('"', '%22').replace(
+            '\r', '').replace('\n', '')
+
+        boundary = uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+
+        self.head = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def __len__(self):
+        return len(self.head) + encrypted_size(self.size) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        yield from encrypt_file(self.path, self.key, self.size)
+        yield self.tail
+
+
+class EncryptedBulkUpload:
+    """ multipart/form-data request body of many files, encrypted while
+        they are sent like EncryptedUpload, after the given text fields """
+    def __init__(self, paths, key, fields=None, field='file'):
+        self.key = key
+
+        boundary = uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+
+        self.fields = b''.join(
+            (f'--{boundary}\r\n'
+             f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+             f'{value}\r\n').encode() for name, value in (fields or {}).items())
+
+        # (path, size, head) of every file, sizes are fixed now
+        # for the Content-Length, like EncryptedUpload
+        self.files = []
+
+        for path in paths:
+            filename = encrypted_filename(path).replace('"', '%22').replace(
+                '\r', '').replace('\n', '')
+
+            head = (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').encode()
+
+            self.files.append((path, os.path.getsize(path), head))
+
+        self.tail = f'--{boundary}--\r\n'.encode()
+
+    def __len__(self):
+        return len(self.fields) + sum(
+            len(head) + encrypted_size(size) + 2
+            for _, size, head in self.files) + len(self.tail)
+
+    def __iter__(self):
+        yield self.fields
+
+        for path, size, head in self.files:
+            yield head
+            yield from encrypt_file(path, self.key, size)
+            yield b'\r\n'
+
+        yield self.tail
+
 
 class Client:
     def __init__(self, creds_path):
         with open(creds_path, 'r') as credentials_file:
             self.credentials = json.loads(credentials_file.read())
 
-            # Create a folder in /tmp to store encrypted files
-            self.ENCRYPTED_PATH = os.path.join('/tmp', 'encrypted')
-            if not os.path.exists(self.ENCRYPTED_PATH):
-                os.mkdir(self.ENCRYPTED_PATH)
-
             # Generate SHA signature from meeting UID and password
             self.signature = encrypt_sha256(
                 self.credentials['meeting']['uid'],
                 self.credentials['meeting']['password'])
 
-    def upload(self, path_to_file):
-        pass
+            # Derive the meeting master key once for the whole session
+            self.key = MeetingKey(self.signature,
+                                  self.credentials['meeting']['uid'])
 
-    def download(self, path_to_file):
-        pass
+        # Connections to the server shared by every request
+        self.session = create_session()
 
-    def delete(self, path_to_file):
-        pass
+        # Last manifest of the meeting and its ETag, see manifest()
+        self._manifest = None
+        self._manifest_etag = None
 
+    def request(self, method, endpoint, **kwargs):
+        # Send a request to the API through the pooled session
+        kwargs.setdefault('timeout', TIMEOUT)
 
-class HostClient(Client):
-    """ Host client that handles file uploads and downloads.
-        It uploads every new file added in the public folder
-        And downloads every file added in a guest folder
-    """
-    def __init__(self):
-        Client.__init__(self, HOST_CREDS_PATH)
+        return self.session.request(method, API_URL + endpoint, **kwargs)
 
     def upload(self, path_to_file):
+        pass
+
+    def _upload(self, path_to_file, author_uid):
         # Ignore hidden files
-        if '.Trash' in path_to_file or '.git' in path_to_file or '.goutputstream' in path_to_file:
+        if is_hidden(path_to_file):
             return
 
         # File absolute path located in the meeting save folder
@@ -59,28 +235,527 @@ class HostClient(Client):
 
         meeting_uid = self.credentials['meeting'][
             'uid']  # Meeting uid from credentials
-        author_uid = self.credentials['meeting']['host_uid']
-        filename = path_to_file.split('/')[-1]
 
         params = {'author_uid': author_uid}
+
+        # Don't send the file if the meeting already has the same content
+        digest = self._digest(abspath)
+
+        res = self.request('POST',
+                           f'/meetings/{meeting_uid}/files/preflight',
+                           params=params,
+                           json={
+                               'filename': encrypted_filename(abspath),
+                               'digest': digest
+                           })
+
+        if 'error' in res.json() or res.json()['exists']:
+            return res
+
+        # Large files are sent by chunks that survive a lost connection
+        if os.path.getsize(abspath) >= RESUMABLE_THRESHOLD:
+            return self._upload_resumable(abspath, params, digest)
+
         endpoint = f'/meetings/{meeting_uid}/files/upload'
+        params['digest'] = digest
+
+        # Encrypt the file while it is being sent
+        body = EncryptedUpload(abspath, self.key)
+
+        # Make a request with the streamed file
+        res = self.request('POST',
+                           endpoint,
+                           data=body,
+                           params=params,
+                           headers={'Content-Type': body.content_type})
+
+        return res
+
+    def upload_many(self, paths):
+        """ Upload files, see _upload_many() """
+        return {path: self.upload(path) for path in paths}
+
+    def _upload_many(self, paths, author_uid):
+        """ Upload files of an author, the small ones together in bulk
+            requests. Returns the response of every path, sent for the
+            files of its request, None for the ignored ones and the error
+            raised for the ones that could not be sent, the other files
+            are still sent """
+        responses = {}
+        batch = []
+        batch_size = 0
+
+        for path in paths:
+            # Ignore hidden files, often gone by now
+            if is_hidden(path):
+                responses[path] = None
+                continue
+
+            abspath = os.path.join(self.credentials['meeting']['mountpoint'],
+                                   path[1:])
+
+            try:
+                size = os.path.getsize(abspath)
+            except OSError as error:
+                responses[path] = error
+                continue
+
+            # Large files are sent on their own
+            if size >= BULK_UPLOAD_THRESHOLD:
+                try:
+                    responses[path] = self._upload(path, author_uid)
+                except Exception as error:
+                    responses[path] = error
+
+                continue
+
+            if batch and (len(batch) == BULK_UPLOAD_FILES
+                          or batch_size + size > BULK_UPLOAD_SIZE):
+                responses.update(self._upload_bulk(batch, author_uid))
+                batch = []
+                batch_size = 0
+
+            batch.append(path)
+            batch_size += size
+
+        if batch:
+            responses.update(self._upload_bulk(batch, author_uid))
+
+        return responses
+
+    def _upload_bulk(self, paths, author_uid):
+        # Hidden files were left out by _upload_many()
+        responses = {}
+
+        # Files with the same content in the meeting share their storage,
+        # a file that can't be read anymore is left out of the request
+        digests = {}
+
+        for path in paths:
+            abspath = os.path.join(self.credentials['meeting']['mountpoint'],
+                                   path[1:])
+
+            try:
+                digests[path] = (abspath, self._digest(abspath))
+            except OSError as error:
+                responses[path] = error
+
+        paths = list(digests)
+
+        # A single file can skip its content if the meeting already has it
+        if len(paths) == 1:
+            try:
+                responses[paths[0]] = self._upload(paths[0], author_uid)
+            except Exception as error:
+                responses[paths[0]] = error
+
+        if len(paths) <= 1:
+            return responses
+
+        meeting_uid = self.credentials['meeting']['uid']
+
+        try:
+            # Encrypt the files while they are being sent
+            body = EncryptedBulkUpload(
+                [abspath for abspath, _ in digests.values()], self.key, {
+                    'digests':
+                    json.dumps({
+                        encrypted_filename(abspath): digest
+                        for abspath, digest in digests.values()
+                    })
+                })
+
+            res = self.request('POST',
+                               f'/meetings/{meeting_uid}/files/upload/bulk',
+                               data=body,
+                               params={'author_uid': author_uid},
+                               headers={'Content-Type': body.content_type})
+        except Exception as error:
+            res = error
+
+        responses.update(dict.fromkeys(paths, res))
+
+        return responses
+
+    def _digest(self, abspath):
+        with open(abspath, 'rb') as file_in:
+            return file_digest(file_in, self.key)
+
+    def _upload_resumable(self, abspath, params, digest):
+        for attempt in range(UPLOAD_RETRIES + 1):
+            try:
+                res = self._resume_upload(abspath, params, digest)
+            except (requests.ConnectionError, requests.Timeout):
+                # Resume from the chunks the server received
+                if attempt == UPLOAD_RETRIES:
+                    raise
+
+                continue
+
+            # Modified while it was sent: start over with a new session
+            if res is None:
+                digest = self._digest(abspath)
+                continue
+
+            return res
+
+        raise FileChangedError(f'{abspath} kept changing while it was uploaded')
+
+    def _resume_upload(self, abspath, params, digest):
+        """ Send the chunks of a file the server doesn't have yet then commit
+            the upload, None if the file was modified meanwhile """
+        meeting_uid = self.credentials['meeting']['uid']
+        endpoint = f'/meetings/{meeting_uid}/files/uploads'
+
+        stat = os.stat(abspath)
+        size = encrypted_size(stat.st_size)
+
+        # Resume the session of a previous attempt if the file didn't change
+        state = self._load_upload_state(abspath, stat)
+        received = set()
+
+        if state is not None:
+            res = self.request('GET',
+                               f'{endpoint}/{state["session_uid"]}',
+                               params=params)
+
+            if 'error' in res.json():
+                state = None
+            else:
+                received = set(res.json()['session']['received'])
+
+        if state is None:
+            # The salt and nonce prefix are kept to encrypt
+            # the missing chunks exactly like the ones already sent
+            cipher = ChunkedCipher(self.key)
+
+            res = self.request('POST',
+                               endpoint,
+                               params=params,
+                               json={
+                                   'filename': encrypted_filename(abspath),
+                                   'size': size,
+                                   'chunk_size': UPLOAD_CHUNK_SIZE,
+                                   'digest': digest
+                               })
+
+            if 'error' in res.json():
+                return res
+
+            state = {
+                'session_uid': res.json()['session']['uid'],
+                'salt': cipher.salt.hex(),
+                'prefix': cipher.prefix.hex(),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns
+            }
+            self._save_upload_state(abspath, state)
+        else:
+            cipher = ChunkedCipher(self.key, bytes.fromhex(state['salt']),
+                                   bytes.fromhex(state['prefix']))
+
+        session_endpoint = f'{endpoint}/{state["session_uid"]}'
+
+        # Send the chunks the server doesn't have
+        with open(abspath, 'rb') as file_in:
+            for index in range(-(-size // UPLOAD_CHUNK_SIZE)):
+                if index in received:
+                    continue
+
+                offset = index * UPLOAD_CHUNK_SIZE
+                data = encrypt_range(file_in, cipher, stat.st_size, offset,
+                                     min(UPLOAD_CHUNK_SIZE, size - offset))
+
+                res = self.request('PUT',
+                                   f'{session_endpoint}/chunks/{index}',
+                                   params=params,
+                                   data=data)
+
+                if 'error' in res.json():
+                    return res
+
+        # Modified while it was sent, its chunks are of no use anymore
+        if self._load_upload_state(abspath, os.stat(abspath)) is None:
+            self.request('DELETE', session_endpoint, params=params)
+            return None
+
+        res = self.request('POST', f'{session_endpoint}/commit', params=params)
+
+        self._remove_upload_state(abspath)
 
-        # Create encrypted file before upload
-        encrypted_file_path = encrypt_AES(abspath, self.signature)
+        return res
 
-        # Attach encrypted file
-        files = {'file': open(encrypted_file_path, 'rb')}
+    def _load_upload_state(self, abspath, stat):
+        """ State of the resumable upload of a file,
+            None if there is none or if the file changed since """
+        return self._load_state(UPLOADS_STATE_PATH, abspath, stat)
 
-        # Make a request with attached file
-        res = requests.post(API_URL + endpoint, files=files, params=params)
+    def _save_upload_state(self, abspath, state):
+        self._save_state(UPLOADS_STATE_PATH, abspath, state)
 
-        # Delete the encrypted file that was created
-        if os.path.exists(encrypted_file_path):
-            os.remove(encrypted_file_path)
+    def _remove_upload_state(self, abspath):
+        self._remove_state(UPLOADS_STATE_PATH, abspath)
+
+    def _state_path(self, folder, path):
+        name = hashlib.sha256(
+            (self.credentials['meeting']['uid'] + path).encode()).hexdigest()
+
+        return os.path.join(folder, name + '.json')
+
+    def _load_state(self, folder, path, stat=None):
+        """ State saved for a file,
+            None if there is none or if the file changed since """
+        try:
+            with open(self._state_path(folder, path), 'r') as state_file:
+                state = json.load(state_file)
+
+            if stat is None:
+                stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+
+        if state['size'] != stat.st_size or state['mtime'] != stat.st_mtime_ns:
+            self._remove_state(folder, path)
+            return None
+
+        return state
+
+    def _save_state(self, folder, path, state):
+        os.makedirs(folder, exist_ok=True)
+
+        with open(self._state_path(folder, path), 'w') as state_file:
+            json.dump(state, state_file)
+
+    def _remove_state(self, folder, path):
+        if os.path.exists(self._state_path(folder, path)):
+            os.remove(self._state_path(folder, path))
+
+    def download(self, path_to_file):
+        pass
+
+    def manifest(self):
+        """ Every file of the meeting with its author, size, digest and
+            version, None if the server answered with an error.
+            The server only sends it again once a file changed """
+        meeting_uid = self.credentials['meeting']['uid']
+
+        headers = {}
+
+        if self._manifest is not None:
+            headers['If-None-Match'] = self._manifest_etag
+
+        res = self.request(
+            'GET',
+            f'/meetings/{meeting_uid}/manifest',
+            params={'password': self.credentials['meeting']['password']},
+            headers=headers)
+
+        if res.status_code == 304:
+            return self._manifest
+
+        body = res.json()
+
+        if 'error' in body:
+            return None
+
+        self._manifest = body['files']
+        self._manifest_etag = res.headers.get('ETag')
+
+        return self._manifest
+
+    def reconcile(self):
+        """ Create the placeholders of the meeting files that are missing
+            or outdated in the mountpoint, downloaded once they are opened.
+            Returns the paths of the created placeholders """
+        files = self.manifest()
+        created = []
+
+        for file in files or ():
+            path = self._placeholder_path(file)
+
+            if path is None:
+                continue
+
+            # Decrypted file path, once downloaded
+            output_path = path.replace('.encrypted', '')
+
+            if os.path.exists(path):
+                continue
+
+            if os.path.exists(output_path):
+                state = self._load_download_state(output_path)
+
+                # Same version as the one downloaded
+                if (state is not None and state['etag'].strip('"')
+                        == f'{file["uid"]}-{file["version"]}'):
+                    continue
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Create an empty file
+            with open(path, 'w'):
+                pass
+
+            created.append(path)
+
+        return created
+
+    def _placeholder_path(self, file):
+        """ Where a file of the manifest is downloaded,
+            None if this client doesn't download it """
+        return None
+
+    def _download(self, path_to_file, author_fullname):
+        # Download file save path (ex: foo.txt.encrypted)
+        save_path = os.path.join(self.credentials['meeting']['mountpoint'],
+                                 path_to_file[1:])
+
+        # Decrypted file path (ex: foo.txt)
+        output_path = save_path.replace('.encrypted', '')
+
+        meeting_uid = self.credentials['meeting']['uid']
+        filename = path_to_file.split('/')[-1]
+
+        # Request params in order to get the corresponding file
+        params = {
+            'filename': filename,
+            'author_fullname': author_fullname,
+            'password': self.credentials['meeting']['password']
+        }
+
+        # API endpoint to download a file
+        endpoint = f'/meetings/{meeting_uid}/files/download'
+
+        # The server answers 304 Not Modified if we already have this version
+        headers = {}
+        state = self._load_download_state(output_path)
+
+        if state is not None:
+            headers['If-None-Match'] = state['etag']
+
+        # Decrypt the file while it is received into a temporary file
+        # that only replaces the decrypted file once the tag is verified
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path),
+                                        prefix='.' +
+                                        os.path.basename(output_path),
+                                        suffix='.part')
+
+        try:
+            with os.fdopen(fd, 'wb') as file_out:
+                res = self._receive(endpoint, params, headers, file_out)
+        except BaseException:
+            # If the file could not be decrypted, delete what we wrote
+            os.remove(tmp_path)
+            raise
+
+        if is_file_response(res):
+            os.replace(tmp_path, output_path)
+            self._save_download_state(output_path, res.headers.get('ETag'))
+        else:
+            os.remove(tmp_path)
+
+            # Errors are sent back as JSON, keep the placeholder
+            if res.status_code != 304:
+                return res
+
+        # Delete the placeholder of the encrypted file
+        if save_path != output_path and os.path.exists(save_path):
+            os.remove(save_path)
+
+        return res
+
+    def _receive(self, endpoint, params, headers, file_out):
+        """ Download and decrypt a file into file_out.
+            An interrupted download is resumed with a Range request,
+            from the byte where it stopped, as long as the file has
+            the same ETag
+        """
+        decryptor = None
+        received = 0
+        etag = None
+
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            if received > 0:
+                headers = dict(headers,
+                               Range=f'bytes={received}-',
+                               **{'If-Range': etag})
+
+            try:
+                # Request the file without loading it in memory
+                with self.request('GET',
+                                  endpoint,
+                                  params=params,
+                                  headers=headers,
+                                  stream=True) as res:
+                    if not is_file_response(res):
+                        return res
+
+                    # The whole file is sent: (re)start from the beginning
+                    if res.status_code != 206:
+                        file_out.seek(0)
+                        file_out.truncate()
+                        received = 0
+
+                        # Large files are decrypted by several threads
+                        size = int(res.headers.get('Content-Length', 0))
+                        decryptor = StreamDecryptor(self.key,
+                                                    workers_for(size))
+
+                    etag = res.headers.get('ETag')
+
+                    for chunk in res.iter_content(BUFFER_SIZE):
+                        file_out.write(decryptor.update(chunk))
+                        received += len(chunk)
+
+                    file_out.write(decryptor.finalize())
+
+                    return res
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                # Can't resume without knowing the version being downloaded
+                if attempt == DOWNLOAD_RETRIES or etag is None:
+                    raise
+
+    def _load_download_state(self, output_path):
+        """ State of a downloaded file,
+            None if there is none or if the file changed since """
+        return self._load_state(DOWNLOADS_STATE_PATH, output_path)
+
+    def _save_download_state(self, output_path, etag):
+        if etag is None:
+            return
+
+        stat = os.stat(output_path)
+
+        self._save_state(DOWNLOADS_STATE_PATH, output_path, {
+            'etag': etag,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        })
+
+    def delete(self, path_to_file):
+        pass
+
+
+class HostClient(Client):
+    """ Host client that handles file uploads and downloads.
+        It uploads every new file added in the public folder
+        And downloads every file added in a guest folder
+    """
+    def __init__(self):
+        Client.__init__(self, HOST_CREDS_PATH)
+
+    def upload(self, path_to_file):
+        return self._upload(path_to_file,
+                            self.credentials['meeting']['host_uid'])
+
+    def upload_many(self, paths):
+        return self._upload_many(paths,
+                                 self.credentials['meeting']['host_uid'])
 
     def download(self, path_to_file):
         # Ignore hidden files
-        if '.Trash' in path_to_file or '.git' in path_to_file or '.goutputstream' in path_to_file:
+        if is_hidden(path_to_file):
             return
 
         # Download file save path
@@ -89,38 +764,23 @@ class HostClient(Client):
 
         # If file exists and is empty
         if os.path.exists(save_path) and os.stat(save_path).st_size == 0:
-            meeting_uid = self.credentials['meeting']['uid']
-
             # Extract author and filename from path
             # Expected path format: /AUTHOR_FULLNAME/FILENAME
             _, author_fullname, filename = path_to_file.split('/')
 
-            # Request params in order to get the corresponding file
-            params = {
-                'filename': filename,
-                'author_fullname': author_fullname,
-                'password': self.credentials['meeting']['password']
-            }
+            return self._download(path_to_file, author_fullname)
 
-            # API endpoint to download a file
-            endpoint = f'/meetings/{meeting_uid}/files/download'
+    def _placeholder_path(self, file):
+        # Files of the guests, in the folder of their author
+        if file['author_uid'] == self.credentials['meeting']['host_uid']:
+            return None
 
-            # Request the file
-            res = requests.get(API_URL + endpoint, params=params)
+        # Its author left the meeting, it can't be downloaded by fullname
+        if file['author_fullname'] is None:
+            return None
 
-            # If there is not an error, save the downloaded file
-            if 'error' not in res.text:
-                with open(save_path, 'wb') as downloaded_file:
-                    downloaded_file.write(res.content)
-
-                # Decrypt downloaded file (ex: foo.txt.encrypted)
-                encrypted_file_path = os.path.join(
-                    self.credentials['meeting']['mountpoint'],
-                    path_to_file[1:])
-                decrypt_AES(encrypted_file_path, self.signature)
-
-                # Delete encrypted file
-                os.remove(encrypted_file_path)
+        return os.path.join(self.credentials['meeting']['mountpoint'],
+                            file['author_fullname'], file['filename'])
 
     def delete(self, path_to_file):
         for i in range(10):
@@ -144,7 +804,7 @@ class HostClient(Client):
         endpoint = f'/meetings/{meeting_uid}/files/public/delete'
 
         # Send request to delete file
-        res = requests.delete(API_URL + endpoint, params=params)
+        res = self.request('DELETE', endpoint, params=params)
 
         if 'error' not in res.text and os.path.exists(save_path):
             # Delete file from system
@@ -160,36 +820,14 @@ class GuestClient(Client):
         Client.__init__(self, GUEST_CREDS_PATH)
 
     def upload(self, path_to_file):
-        # Ignore hidden files
-        if '.Trash' in path_to_file or '.git' in path_to_file or '.goutputstream' in path_to_file:
-            return
+        return self._upload(path_to_file, self.credentials['guest']['uid'])
 
-        # File absolute path located in the meeting save folder
-        abspath = os.path.join(self.credentials['meeting']['mountpoint'],
-                               path_to_file[1:])
-
-        meeting_uid = self.credentials['meeting'][
-            'uid']  # Meeting uid from credentials
-        author_uid = self.credentials['guest']['uid']
-        params = {'author_uid': author_uid}
-        endpoint = f'/meetings/{meeting_uid}/files/upload'
-
-        # Create encrypted file before upload
-        encrypted_file_path = encrypt_AES(abspath, self.signature)
-
-        # Attached encrypted file
-        files = {'file': open(encrypted_file_path, 'rb')}
-
-        # Make a request with attached file
-        res = requests.post(API_URL + endpoint, files=files, params=params)
-
-        # Delete the encrypted file that was created
-        if os.path.exists(encrypted_file_path):
-            os.remove(encrypted_file_path)
+    def upload_many(self, paths):
+        return self._upload_many(paths, self.credentials['guest']['uid'])
 
     def download(self, path_to_file):
         # Ignore hidden files
-        if '.Trash' in path_to_file or '.git' in path_to_file or '.goutputstream' in path_to_file:
+        if is_hidden(path_to_file):
             return
 
         # Download file save path
@@ -198,39 +836,21 @@ class GuestClient(Client):
 
         # If file exists and is empty
         if os.path.exists(save_path) and os.stat(save_path).st_size == 0:
-            meeting_uid = self.credentials['meeting']['uid']
-
             # Extract author and filename from path
             # Expected path format: /AUTHOR_FULLNAME/FILENAME
             _, author_fullname, filename = path_to_file.split('/')
 
-            # Request params in order to get the corresponding file
-            params = {
-                'filename': filename,
-                'author_fullname':
-                self.credentials['meeting']['host_fullname'],
-                'password': self.credentials['meeting']['password']
-            }
-
-            # API endpoint to download a file
-            endpoint = f'/meetings/{meeting_uid}/files/download'
-
-            # Request the file
-            res = requests.get(API_URL + endpoint, params=params)
-
-            # If there is not an error, save the downloaded file
-            if 'error' not in res.text:
-                with open(save_path, 'wb') as downloaded_file:
-                    downloaded_file.write(res.content)
+            # Public files are always from the host
+            return self._download(
+                path_to_file, self.credentials['meeting']['host_fullname'])
 
-                # Decrypt downloaded file (ex: foo.txt.encrypted)
-                encrypted_file_path = os.path.join(
-                    self.credentials['meeting']['mountpoint'],
-                    path_to_file[1:])
-                decrypt_AES(encrypted_file_path, self.signature)
+    def _placeholder_path(self, file):
+        # Public files, from the host
+        if file['author_uid'] != self.credentials['meeting']['host_uid']:
+            return None
 
-                # Delete encrypted file
-                os.remove(encrypted_file_path)
+        return os.path.join(self.credentials['meeting']['mountpoint'],
+                            'public', file['filename'])
 
     def delete(self, path_to_file):
         # Extract filename from path
@@ -253,7 +873,7 @@ class GuestClient(Client):
         endpoint = f'/meetings/{meeting_uid}/files/guests/delete'
 
         # Send request to delete file
-        res = requests.delete(API_URL + endpoint, params=params)
+        res = self.request('DELETE', endpoint, params=params)
 
         for i in range(50):
             print(res.text)
@@ -15,7 +15,9 @@ from stat import *
 import fcntl
 from threading import Lock
 import logging
+import requests
 from api import HostClient
+from scheduler import UploadScheduler
 # pull in some spaghetti to make this stuff work without fuse-py being installed
 try:
     import _find_fuse_parts
@@ -46,6 +48,10 @@ def flag2mode(flags):
 
 client = HostClient()
 
+# Uploads run in the background so writes are not slowed down by the network.
+# Files are uploaded a second after their last handle is closed
+uploads = UploadScheduler(client, debounce=1)
+
 
 class HostFS(Fuse):
     def __init__(self, *args, **kw):
@@ -132,6 +138,13 @@ class HostFS(Fuse):
     def fsinit(self):
         os.chdir(self.root)
 
+        # Start upload workers once FUSE runs in the background
+        uploads.start()
+
+    def fsdestroy(self):
+        # Finish pending uploads before unmounting
+        uploads.join()
+
     class MeetingFile(object):
         def __init__(self, path, flags, *mode):
             self.file = os.fdopen(os.open("." + path, flags, *mode),
@@ -139,6 +152,13 @@ class HostFS(Fuse):
             self.fd = self.file.fileno()
             self.path = path  # keep the path
 
+            # Files in the shared folder are uploaded once closed
+            self.shared = path.split('/')[1] == 'public'
+            self.dirty = False
+
+            if self.shared:
+                uploads.open(path)
+
             if hasattr(os, 'pread'):
                 self.iolock = None
             else:
@@ -160,42 +180,26 @@ class HostFS(Fuse):
                 return os.pread(self.fd, length, offset)
 
         def write(self, buf, offset):
-
-            # The writing of large files as images
-            # are done by chunks of 4096 bytes.
-            # We can assume that if the size of the buffer is lower
-            # than 4096 then it must be the last chunk
-            CHUNK_SIZE = 4096
+            self.dirty = True
 
             if self.iolock:
                 self.iolock.acquire()
                 try:
                     self.file.seek(offset)
                     self.file.write(buf)
-
-                    res = len(buf)
-
-                    # The file should be uploaded if its in the public folder
-                    if self.path.split(
-                            '/')[1] == 'public' and len(buf) < CHUNK_SIZE:
-                        client.upload(self.path)
-
-                    return res
+                    return len(buf)
                 finally:
                     self.iolock.release()
             else:
-                res = os.pwrite(self.fd, buf, offset)
-
-                # The file should be uploaded if its in the public folder
-                if self.path.split(
-                        '/')[1] == 'public' and len(buf) < CHUNK_SIZE:
-                    client.upload(self.path)
-
-                return res
+                return os.pwrite(self.fd, buf, offset)
 
         def release(self, flags):
             self.file.close()
 
+            # Upload the file if this handle modified it
+            if self.shared:
+                uploads.close(self.path, self.dirty)
+
         def _fflush(self):
             if 'w' in self.file.mode or 'a' in self.file.mode:
                 self.file.flush()
@@ -216,6 +220,7 @@ class HostFS(Fuse):
             return os.fstat(self.fd)
 
         def ftruncate(self, len):
+            self.dirty = True
             self.file.truncate(len)
 
     def main(self, *a, **kw):
@@ -247,6 +252,12 @@ def main():
         print("can't enter root of underlying filesystem", file=sys.stderr)
         sys.exit(1)
 
+    # Files uploaded while the meeting wasn't mounted
+    try:
+        client.reconcile()
+    except requests.RequestException:
+        print("can't list the meeting files", file=sys.stderr)
+
     server.main()
 
 
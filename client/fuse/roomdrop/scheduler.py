@@ -0,0 +1,212 @@
+import logging
+import threading
+from queue import Empty, Queue
+
+from api import BULK_UPLOAD_FILES, TRANSFER_CONCURRENCY, is_hidden
+
+# Upload status of a path
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class UploadScheduler:
+    """ Uploads files from background threads
+        so FUSE callbacks never wait for the encryption and the network.
+
+        A path enqueued again before its upload started is uploaded once,
+        a path enqueued while it is being uploaded is uploaded again afterwards
+        so the last version of the file always reaches the server.
+
+        Open handles are tracked with open() and close(): a file is only
+        uploaded once the last handle on its path is closed, if any of them
+        wrote to it. With a debounce window, the upload waits debounce
+        seconds and is postponed again if the file is reopened meanwhile.
+
+        A worker takes up to batch_size waiting paths at once and uploads
+        them with client.upload_many(), which sends the small files together.
+
+        Workers are only started by start(), since threads don't survive
+        the fork that sends the FUSE process to the background
+    """
+    def __init__(self,
+                 client,
+                 workers=TRANSFER_CONCURRENCY,
+                 maxsize=256,
+                 debounce=0,
+                 on_status=None,
+                 batch_size=BULK_UPLOAD_FILES):
+        self.client = client
+        self.workers = workers
+        self.debounce = debounce
+        self.on_status = on_status
+        self.batch_size = batch_size
+
+        # Enqueuing blocks when maxsize uploads are already waiting
+        self.queue = Queue(maxsize)
+
+        self.lock = threading.Lock()
+        self.status = {}  # path -> last status
+        self.queued = set()  # paths waiting in the queue
+        self.modified = set()  # paths enqueued while being uploaded
+
+        self.handles = {}  # path -> number of open handles
+        self.dirty = set()  # paths written by a closed handle
+        self.timers = {}  # path -> debounce timer
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def enqueue(self, path):
+        # Hidden files are not uploaded at all
+        if is_hidden(path):
+            return
+
+        with self.lock:
+            # Upload again once the running upload is done
+            if self.status.get(path) == UPLOADING:
+                self.modified.add(path)
+                return
+
+            # Already waiting to be uploaded
+            if path in self.queued:
+                return
+
+            self.queued.add(path)
+            self._set_status(path, QUEUED)
+
+        self.queue.put(path)
+
+    def open(self, path):
+        with self.lock:
+            self.handles[path] = self.handles.get(path, 0) + 1
+
+            # Reopened during the debounce window: wait for this handle
+            timer = self.timers.pop(path, None)
+            if timer is not None:
+                timer.cancel()
+                self.dirty.add(path)
+
+    def close(self, path, dirty):
+        with self.lock:
+            self.handles[path] -= 1
+
+            if dirty:
+                self.dirty.add(path)
+
+            # Other handles are still open, the last one uploads the file
+            if self.handles[path] > 0:
+                return
+
+            del self.handles[path]
+
+            if path not in self.dirty:
+                return
+
+            self.dirty.discard(path)
+
+            if self.debounce > 0:
+                timer = threading.Timer(self.debounce, self._debounced,
+                                        (path, ))
+                timer.daemon = True
+                self.timers[path] = timer
+                timer.start()
+                return
+
+        self.enqueue(path)
+
+    def get_status(self, path):
+        with self.lock:
+            return self.status.get(path)
+
+    def join(self):
+        # Don't wait for the debounce window of closed files
+        with self.lock:
+            timers, self.timers = self.timers, {}
+
+        for path, timer in timers.items():
+            timer.cancel()
+            self.enqueue(path)
+
+        # Wait for every enqueued upload to be done
+        self.queue.join()
+
+    def _debounced(self, path):
+        with self.lock:
+            # Cancelled by a reopen right before firing
+            if self.timers.get(path) is not threading.current_thread():
+                return
+
+            del self.timers[path]
+
+        self.enqueue(path)
+
+    def _set_status(self, path, status):
+        self.status[path] = status
+
+        if self.on_status is not None:
+            self.on_status(path, status)
+
+    def _work(self):
+        while True:
+            paths = [self.queue.get()]
+
+            # Paths waiting together are uploaded together
+            while len(paths) < self.batch_size:
+                try:
+                    paths.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            taken = len(paths)
+
+            with self.lock:
+                for path in paths:
+                    self.queued.discard(path)
+                    self._set_status(path, UPLOADING)
+
+            while paths:
+                statuses = self._upload(paths)
+
+                with self.lock:
+                    # Modified during the upload: upload them again
+                    modified = [path for path in paths if path in self.modified]
+                    self.modified.difference_update(modified)
+
+                    for path in paths:
+                        if path not in modified:
+                            self._set_status(path, statuses[path])
+
+                paths = modified
+
+            for _ in range(taken):
+                self.queue.task_done()
+
+    def _upload(self, paths):
+        try:
+            responses = self.client.upload_many(paths)
+        except Exception:
+            logging.exception(f'Could not upload {", ".join(paths)}')
+            return dict.fromkeys(paths, FAILED)
+
+        return {path: self._status(path, responses[path]) for path in paths}
+
+    def _status(self, path, res):
+        # Could not be sent, unlike the other files of its batch
+        if isinstance(res, Exception):
+            logging.error(f'Could not upload {path}: {res}')
+            return FAILED
+
+        # Not an answer of the server (ex: a proxy error page)
+        try:
+            failed = not res.ok or 'error' in res.json()
+        except ValueError:
+            failed = True
+
+        if failed:
+            logging.error(f'Could not upload {path}: {res.text}')
+            return FAILED
+
+        return DONE
@@ -156,6 +156,25 @@ const BASE =
 
 const socket = io(BASE);
 
+// Seq of the last file event received, sent when joining again after
+// a reconnection to only receive the events missed in between
+let lastSeq = null;
+
+// False for an event already received, a socket joining again can get
+// the same event live and in its catch up
+function seen(data) {
+  if (data.seq === undefined) {
+    return true;
+  }
+
+  if (lastSeq !== null && data.seq <= lastSeq) {
+    return false;
+  }
+
+  lastSeq = data.seq;
+  return true;
+}
+
 // Once connected, join the meeting room
 socket.on("connect", () => {
   console.log("connected");
@@ -167,6 +186,8 @@ socket.on("connect", () => {
   socket.emit("join", {
     guest_fullname: guest.fullname,
     meeting_uid: meeting.uid,
+    batch_files: true,
+    last_seq: lastSeq,
   });
 });
 
@@ -218,26 +239,25 @@ if (initiatedFuse && createdPublicFolder) {
 //
 // ==============================================================
 
+// Guests of the meeting, received with the snapshot of the meeting
+// then updated when a guest joins or leaves
+let roster = [];
+
 // Log every event
 socket.onAny(function (event, data) {
   console.log(event, data);
-
-  // Update guests list when a guest joins or leaves
-  if (event === "new join" || event === "leaved") {
-    updateGuestList(data.guests);
-  }
 });
 
-// On new guest join
-socket.on("new join", function (data) {
-  const { guest_fullname, guests, public_files } = data;
-  console.log("Nouvel participant", data);
+// Once joined, the current guests and public files
+socket.on("snapshot", function (data) {
+  const { public_files } = data;
 
-  // mettre a jour la liste des particiapnts
-  updateGuestList(guests);
+  lastSeq = data.seq;
+  roster = data.guests;
+  updateGuestList(roster);
 
   // Add notification to the message feed
-  addNotification(`${guest_fullname} joined the meeting`);
+  addNotification(`You joined the meeting`);
 
   // Download public files
   for (let i = 0; i < public_files.length; i++) {
@@ -261,15 +281,36 @@ socket.on("new join", function (data) {
   }
 });
 
+// On new guest join
+socket.on("new join", function (data) {
+  const { guest_fullname } = data;
+
+  // mettre a jour la liste des particiapnts
+  if (!roster.includes(guest_fullname)) {
+    roster.push(guest_fullname);
+    updateGuestList(roster);
+  }
+
+  // Add notification to the message feed
+  addNotification(`${guest_fullname} joined the meeting`);
+});
+
 // On guest leave
 socket.on("leaved", function (data) {
   const { guest_fullname } = data;
 
+  roster = roster.filter((fullname) => fullname !== guest_fullname);
+  updateGuestList(roster);
+
   addNotification(`${guest_fullname} leaved the meeting`);
 });
 
 // On new file add
-socket.on("new file", function (data) {
+function onNewFile(data) {
+  if (!seen(data)) {
+    return;
+  }
+
   // Create a new file in the fusemount directory
   const { filename, author_fullname } = data;
   const display_filename = filename.replace(".encrypted", "");
@@ -292,10 +333,14 @@ socket.on("new file", function (data) {
   if (author_fullname == guest.fullname) {
     addNotification(`You uploaded ${display_filename}`);
   }
-});
+}
 
 // On deleted file from public
-socket.on("delete file public", function (data) {
+function onDeleteFilePublic(data) {
+  if (!seen(data)) {
+    return;
+  }
+
   const { filename } = data;
 
   const publicFilePath = path.join(meeting.fuseMountpoint, "public", filename);
@@ -306,6 +351,39 @@ socket.on("delete file public", function (data) {
 
     addNotification(`${meeting.host_fullname} deleted ${filename}`);
   }
+}
+
+socket.on("new file", onNewFile);
+socket.on("delete file public", onDeleteFilePublic);
+
+// File changes sent together, named after their own event
+const fileHandlers = {
+  "new file": onNewFile,
+  "delete file public": onDeleteFilePublic,
+};
+
+function applyFileChange(change) {
+  const handler = fileHandlers[change.event];
+
+  if (handler) {
+    handler(change);
+  } else {
+    seen(change);
+  }
+}
+
+socket.on("files changed", function (data) {
+  data.deleted.forEach(applyFileChange);
+  data.added.forEach(onNewFile);
+});
+
+// Joined again after a reconnection, the file events missed in between
+socket.on("catch up", function (data) {
+  roster = data.guests;
+  updateGuestList(roster);
+
+  data.events.forEach(applyFileChange);
+  seen(data);
 });
 
 // On new message
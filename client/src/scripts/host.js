@@ -157,6 +157,25 @@ const BASE =
 
 const socket = io(BASE);
 
+// Seq of the last file event received, sent when joining again after
+// a reconnection to only receive the events missed in between
+let lastSeq = null;
+
+// False for an event already received, a socket joining again can get
+// the same event live and in its catch up
+function seen(data) {
+  if (data.seq === undefined) {
+    return true;
+  }
+
+  if (lastSeq !== null && data.seq <= lastSeq) {
+    return false;
+  }
+
+  lastSeq = data.seq;
+  return true;
+}
+
 // Once connected, join the meeting room
 socket.on("connect", function () {
   console.log("connected");
@@ -167,6 +186,8 @@ socket.on("connect", function () {
   // Notify meeting attendants
   socket.emit("join", {
     meeting_uid: meeting.uid,
+    batch_files: true,
+    last_seq: lastSeq,
   });
 });
 
@@ -215,22 +236,32 @@ if (initiatedFuse && createdPublicFolder) {
 //
 // ==============================================================
 
+// Guests of the meeting, received with the snapshot of the meeting
+// then updated when a guest joins or leaves
+let roster = [];
+
 // Log every event
 socket.onAny(function (event, data) {
   console.log(event, data);
+});
 
-  // Update guest list when a guest joins or leaves
-  if (event === "new join" || event === "leaved") {
-    updateGuestList(data.guests);
-  }
+// Once joined, the current guests
+socket.on("snapshot", function (data) {
+  lastSeq = data.seq;
+
+  roster = data.guests;
+  updateGuestList(roster);
 });
 
 // On new join
 socket.on("new join", function (data) {
   const { guest_fullname } = data;
 
-  // If the host joined
-  if (!guest_fullname) return;
+  // Update guest list
+  if (!roster.includes(guest_fullname)) {
+    roster.push(guest_fullname);
+    updateGuestList(roster);
+  }
 
   // Create a new directory named after the new guest
   const guestDirPath = path.join(meeting.fuseMountpoint, guest_fullname);
@@ -247,11 +278,18 @@ socket.on("new join", function (data) {
 socket.on("leaved", function (data) {
   const { guest_fullname } = data;
 
+  roster = roster.filter((fullname) => fullname !== guest_fullname);
+  updateGuestList(roster);
+
   addNotification(`${guest_fullname} left the meeting`);
 });
 
 // On new filed add
-socket.on("new file", function (data) {
+function onNewFile(data) {
+  if (!seen(data)) {
+    return;
+  }
+
   // Create a new file in the fusemount directory
   const { filename, author_fullname } = data;
   const display_filename = filename.replace(".encrypted", "");
@@ -280,10 +318,14 @@ socket.on("new file", function (data) {
     // Add notification to the message feed
     addNotification(`${author_fullname} uploaded ${display_filename}`);
   }
-});
+}
 
 // On guest file deleted
-socket.on("delete file guest", function (data) {
+function onDeleteFileGuest(data) {
+  if (!seen(data)) {
+    return;
+  }
+
   const { filename, guest_fullname } = data;
 
   const guestFilePath = path.join(
@@ -299,6 +341,39 @@ socket.on("delete file guest", function (data) {
     // Add notification to the message feed
     addNotification(`${author_fullname} deleted ${filename}`);
   }
+}
+
+socket.on("new file", onNewFile);
+socket.on("delete file guest", onDeleteFileGuest);
+
+// File changes sent together, named after their own event
+const fileHandlers = {
+  "new file": onNewFile,
+  "delete file guest": onDeleteFileGuest,
+};
+
+function applyFileChange(change) {
+  const handler = fileHandlers[change.event];
+
+  if (handler) {
+    handler(change);
+  } else {
+    seen(change);
+  }
+}
+
+socket.on("files changed", function (data) {
+  data.deleted.forEach(applyFileChange);
+  data.added.forEach(onNewFile);
+});
+
+// Joined again after a reconnection, the file events missed in between
+socket.on("catch up", function (data) {
+  roster = data.guests;
+  updateGuestList(roster);
+
+  data.events.forEach(applyFileChange);
+  seen(data);
 });
 
 // On new message
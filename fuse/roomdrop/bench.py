@@ -0,0 +1,378 @@
+""" Roomdrop client benchmarks
+
+Usage: python3 bench.py http [--requests N]
+       python3 bench.py parallel [--size MB] [--max-workers N]
+       python3 bench.py buffers [--sizes MB,MB,...]
+       python3 bench.py crypto [--sizes SIZE,...] [--chunk-sizes SIZE,...]
+
+Sizes are given in bytes or with a K, M or G suffix (ex: 1K,64M,1G).
+
+Every result is printed as one JSON object per line
+so that runs can be saved and compared.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import aes
+from api import create_session
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Local stand-in of the API server answering every request with JSON """
+    protocol_version = 'HTTP/1.1'  # Keep connections alive
+    disable_nagle_algorithm = True
+
+    def _answer(self):
+        # Drain the request body if there is one
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+
+        body = b'{"success": "ok"}'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = _answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in():
+    # Start the stand-in server on a free port
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def report(**result):
+    print(json.dumps(result), flush=True)
+
+
+def bench_http(args):
+    """ Per-request latency without and with the pooled session """
+    server, url = start_stand_in()
+
+    def measure(get):
+        get(url)  # warm up
+
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            get(url).content
+        elapsed = time.perf_counter() - start
+
+        return elapsed / args.requests
+
+    # A new connection for every request, like module-level requests.get
+    unpooled = measure(requests.get)
+
+    # Connections kept alive by the session
+    session = create_session()
+    pooled = measure(session.get)
+
+    server.shutdown()
+
+    report(bench='http',
+           requests=args.requests,
+           unpooled_ms=unpooled * 1000,
+           pooled_ms=pooled * 1000,
+           saved_ms=(unpooled - pooled) * 1000)
+
+
+def bench_parallel(args):
+    """ Encryption and decryption throughput from 1 to N worker threads """
+    key = aes.MeetingKey('roomdrop', 'bench')
+    size = args.size * 1024 * 1024
+
+    # The shared thread pool is sized on first use
+    aes.WORKERS = args.max_workers
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'plain')
+        encrypted_path = os.path.join(folder, 'encrypted')
+
+        write_random_file(path, size)
+
+        workers = 1
+        baseline = None
+
+        while workers <= args.max_workers:
+            # Encrypt into a file that is then decrypted
+            start = time.perf_counter()
+            with open(path, 'rb') as file_in, \
+                    open(encrypted_path, 'wb') as file_out:
+                for chunk in aes.encrypt_stream(file_in, key, workers=workers):
+                    file_out.write(chunk)
+            encryption = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with open(encrypted_path, 'rb') as file_in:
+                reader = aes.ChunkedReader(file_in, key)
+                for _ in reader.read_all(workers):
+                    pass
+            decryption = time.perf_counter() - start
+
+            if baseline is None:
+                baseline = (encryption, decryption)
+
+            report(bench='parallel',
+                   size=size,
+                   workers=workers,
+                   cpus=os.cpu_count(),
+                   encrypt_mb_s=args.size / encryption,
+                   decrypt_mb_s=args.size / decryption,
+                   encrypt_speedup=baseline[0] / encryption,
+                   decrypt_speedup=baseline[1] / decryption)
+
+            workers *= 2
+
+
+def allocating_encrypt(file_in, key):
+    """ Chunk encryption allocating new bytes for every read and chunk,
+        as encrypt_stream did before reusing its buffers
+    """
+    cipher = aes.ChunkedCipher(key)
+
+    yield cipher.header
+    yield from aes._map_chunks(cipher.encrypt,
+                               aes._read_chunks(file_in, cipher), 1)
+
+
+def allocating_decrypt(file_in, key):
+    # Chunk decryption allocating new bytes for every read and chunk
+    reader = aes.ChunkedReader(file_in, key)
+
+    for index in range(reader.chunks):
+        yield reader.read_chunk(index)
+
+
+def bench_buffers(args):
+    """ Throughput and memory of reused buffers against allocating ones """
+    key = aes.MeetingKey('roomdrop', 'bench')
+
+    def reused_encrypt(file_in, key):
+        return aes.encrypt_stream(file_in, key)
+
+    def reused_decrypt(file_in, key):
+        return aes.ChunkedReader(file_in, key).read_all()
+
+    variants = {
+        'allocating': (allocating_encrypt, allocating_decrypt),
+        'reused': (reused_encrypt, reused_decrypt),
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'plain')
+        encrypted_path = os.path.join(folder, 'encrypted')
+
+        for megabytes in args.sizes:
+            size = megabytes * 1024 * 1024
+            write_random_file(path, size)
+
+            for name, (encrypt, decrypt) in variants.items():
+
+                def run_encrypt():
+                    with open(path, 'rb') as file_in, \
+                            open(encrypted_path, 'wb') as file_out:
+                        for chunk in encrypt(file_in, key):
+                            file_out.write(chunk)
+
+                def run_decrypt():
+                    with open(encrypted_path, 'rb') as file_in:
+                        for _ in decrypt(file_in, key):
+                            pass
+
+                for operation, run in (('encrypt', run_encrypt),
+                                       ('decrypt', run_decrypt)):
+                    # Time without tracing, then trace the memory
+                    start = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - start
+
+                    tracemalloc.start()
+                    run()
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+
+                    report(bench='buffers',
+                           variant=name,
+                           operation=operation,
+                           size=size,
+                           mb_s=megabytes / elapsed,
+                           traced_peak_kb=peak / 1024)
+
+
+def write_random_file(path, size):
+    # Write the file by blocks so large sizes don't need as much memory
+    with open(path, 'wb') as file:
+        while size > 0:
+            block = os.urandom(min(size, aes.BUFFER_SIZE))
+            file.write(block)
+            size -= len(block)
+
+
+def parse_size(size):
+    # 64K -> 65536
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    size = size.strip().upper()
+
+    if size[-1] in units:
+        return int(size[:-1]) * units[size[-1]]
+
+    return int(size)
+
+
+def parse_sizes(sizes):
+    return [parse_size(size) for size in sizes.split(',')]
+
+
+def repeat(function, minimum=0.2):
+    """ Call function until minimum seconds passed.
+        Returns the average duration of a call
+    """
+    calls = 0
+    start = time.perf_counter()
+
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= minimum:
+            return elapsed / calls
+
+
+def bench_crypto(args):
+    """ Throughput and peak RSS for every file and chunk size, then KDF cost """
+    # Every case runs in its own process so that its peak RSS is its own
+    for size in args.sizes:
+        for chunk_size in args.chunk_sizes:
+            output = subprocess.run([
+                sys.executable, __file__, 'crypto-case', '--size',
+                str(size), '--chunk-size',
+                str(chunk_size)
+            ],
+                                    check=True,
+                                    capture_output=True,
+                                    text=True).stdout
+
+            print(output, end='', flush=True)
+
+    # Last, since Linux keeps the peak RSS of a process for its children
+    password = aes.encrypt_sha256('bench', 'roomdrop')
+
+    # Meeting master key, derived once per session
+    report(bench='kdf',
+           kdf='scrypt',
+           seconds=repeat(lambda: aes.MeetingKey(password, 'bench'), 1))
+
+    # File subkeys
+    key = aes.MeetingKey(password, 'bench')
+    salt = os.urandom(aes.SALT_SIZE)
+    report(bench='kdf',
+           kdf='hkdf',
+           seconds=repeat(lambda: key.file_key(salt)))
+
+
+def bench_crypto_case(args):
+    """ Encrypt and decrypt one file with the given chunk size """
+    # The 128 Mb used by scrypt would hide the peak RSS of the transfer,
+    # so the master key is random instead of derived
+    key = aes.MeetingKey.__new__(aes.MeetingKey)
+    key.password = None
+    key.master_key = os.urandom(32)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'plain')
+        encrypted_path = os.path.join(folder, 'encrypted')
+        decrypted_path = os.path.join(folder, 'decrypted')
+
+        write_random_file(path, args.size)
+
+        def encrypt():
+            with open(path, 'rb') as file_in, \
+                    open(encrypted_path, 'wb') as file_out:
+                for chunk in aes.encrypt_stream(file_in,
+                                                key,
+                                                chunk_size=args.chunk_size):
+                    file_out.write(chunk)
+
+        def decrypt():
+            with open(encrypted_path, 'rb') as file_in, \
+                    open(decrypted_path, 'wb') as file_out:
+                for chunk in aes.ChunkedReader(file_in, key).read_all():
+                    file_out.write(chunk)
+
+        encryption = repeat(encrypt)
+        decryption = repeat(decrypt)
+
+    megabytes = args.size / 1024 / 1024
+
+    report(bench='crypto',
+           size=args.size,
+           chunk_size=args.chunk_size,
+           encrypt_seconds=encryption,
+           decrypt_seconds=decryption,
+           encrypt_mb_s=megabytes / encryption,
+           decrypt_mb_s=megabytes / decryption,
+           max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roomdrop client benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    http = commands.add_parser('http', help=bench_http.__doc__)
+    http.add_argument('--requests', type=int, default=500)
+    http.set_defaults(run=bench_http)
+
+    parallel = commands.add_parser('parallel', help=bench_parallel.__doc__)
+    parallel.add_argument('--size', type=int, default=256, help='in Mb')
+    parallel.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parallel.set_defaults(run=bench_parallel)
+
+    buffers = commands.add_parser('buffers', help=bench_buffers.__doc__)
+    buffers.add_argument('--sizes',
+                         type=lambda sizes: [int(s) for s in sizes.split(',')],
+                         default=[10, 100, 1024, 2048],
+                         help='comma separated sizes in Mb')
+    buffers.set_defaults(run=bench_buffers)
+
+    crypto = commands.add_parser('crypto', help=bench_crypto.__doc__)
+    crypto.add_argument('--sizes',
+                        type=parse_sizes,
+                        default=parse_sizes('1K,64K,1M,16M,256M,1G'))
+    crypto.add_argument('--chunk-sizes',
+                        type=parse_sizes,
+                        default=parse_sizes('16K,64K,256K,1M'))
+    crypto.set_defaults(run=bench_crypto)
+
+    crypto_case = commands.add_parser('crypto-case',
+                                      help=bench_crypto_case.__doc__)
+    crypto_case.add_argument('--size', type=parse_size, required=True)
+    crypto_case.add_argument('--chunk-size', type=parse_size, required=True)
+    crypto_case.set_defaults(run=bench_crypto_case)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
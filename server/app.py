@@ -1,13 +1,30 @@
 from flask import Flask, request, jsonify, send_from_directory
+from flask import g, has_request_context
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit, send, join_room, leave_room
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, delete, event, func, insert, literal
+from sqlalchemy import or_, select, tuple_, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload, undefer_group
 import os
-from shutil import rmtree
+import base64
+import sqlite3
+import hashlib
+import json
+import re
+import threading
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from collections import namedtuple
 from uuid import uuid4
 
+from batcher import EventBatcher
+from cache import LRUCache
+from message_queue import client_manager
+from presence import PresenceRegistry
+
 app = Flask(__name__)
 
 # CORS
@@ -15,7 +32,52 @@ CORS(app)
 
 # SocketIO
 app.config['SECRET_KEY'] = 'roomdrop'
-sio = SocketIO(app, cors_allowed_origins="*")
+
+# Message queue of the workers, so that events emitted to a room
+# reach the clients connected to every worker (see message_queue.py)
+# (ex: redis://localhost:6379/0, loopback://127.0.0.1:5555)
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+# Guests present in the meetings, see on_join
+presence = PresenceRegistry()
+
+
+def apply_remote_emit(event, data, room):
+    """ Apply the changes sent by the other processes: guests joining or
+        leaving them, see announce_presence, and auth records to forget,
+        see invalidate_auth """
+    if not isinstance(data, dict):
+        return
+
+    if room == PRESENCE_ROOM and event == PRESENCE_EVENT:
+        presence.apply(data.get('meeting_uid'), data.get('guest_fullname'),
+                       data.get('joined') is True)
+
+    elif room == AUTH_CACHE_ROOM and event == AUTH_CACHE_EVENT:
+        forget_auth(data.get('meetings', []), data.get('guests', []))
+
+
+# Events are serialized like the responses (ex: dates of the files)
+queue_options = {'json': app.json}
+
+if app.config['SOCKETIO_MESSAGE_QUEUE']:
+    queue_options['client_manager'] = client_manager(
+        app.config['SOCKETIO_MESSAGE_QUEUE'],
+        on_remote_emit=apply_remote_emit,
+        json=app.json)
+
+# The manager listens to the queue from the start, the presence registry
+# must see the guests joining through other processes
+sio = SocketIO(app, cors_allowed_origins="*", **queue_options)
+
+# File changes sent together to the sockets joining with batch_files,
+# see notify_file_change
+app.config['FILE_EVENTS_WINDOW'] = 0.2  # seconds
+app.config['FILE_EVENTS_BATCH'] = 100  # changes per event at most
+
+# File events kept for the sockets catching up after a reconnection,
+# per meeting, see log_events
+app.config['EVENT_LOG_SIZE'] = 500
 
 # Upload folder
 app.config['UPLOADS'] = os.path.join(os.curdir, 'uploads')
@@ -23,19 +85,139 @@ app.config['UPLOADS'] = os.path.join(os.curdir, 'uploads')
 if not os.path.exists(app.config['UPLOADS']):
     os.mkdir(app.config['UPLOADS'])
 
+# Largest chunk and file accepted by resumable uploads
+app.config['MAX_UPLOAD_CHUNK_SIZE'] = 16 * 1024 * 1024  # 16 Mb
+app.config['MAX_UPLOAD_SIZE'] = 4 * 1024 * 1024 * 1024  # 4 Gb
+
+# Resumable uploads not committed after this are dropped with their chunks
+app.config['UPLOAD_SESSION_TTL'] = 24 * 60 * 60  # seconds
+
+# Files sent by one bulk upload at most, see upload_files
+app.config['BULK_UPLOAD_MAX_FILES'] = 500
+
+# Size of the blocks copied from request bodies to the storage
+BUFFER_SIZE = 1024 * 1024
+
+# Values of an IN list, SQLite accepts 999 parameters before 3.32
+IN_BATCH_SIZE = 500
+
+# Number of items of a listing page, when not given and at most
+app.config['PAGE_SIZE'] = 50
+app.config['MAX_PAGE_SIZE'] = 500
+
+# Meeting and guest auth records cached by every process
+app.config['AUTH_CACHE_SIZE'] = 4096
+app.config['AUTH_CACHE_TTL'] = 60  # seconds
+
+# Folder of the uploads folder where the contents of files are stored
+BLOBS_FOLDER = '.blobs'
+
+# Storage is reclaimed by a background job runner in every process
+# (see run_jobs), deleted files and folders wait in the job table
+app.config['JOB_RUNNER'] = os.environ.get('JOB_RUNNER', '1') == '1'
+app.config['JOB_POLL_INTERVAL'] = 5  # seconds between empty runs
+app.config['JOB_BATCH_SIZE'] = 20  # jobs claimed per run
+app.config['JOB_DELETE_BUDGET'] = 1000  # files removed per job run
+app.config['JOB_LEASE'] = 300  # seconds before other runners retry a job
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 10  # seconds, doubled every attempt
+
+# Contents are addressed by hex SHA-256 sized digests
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
 # Database config
+# SQLite by default, any database supported by SQLAlchemy
+# with SQLALCHEMY_DATABASE_URI or DATABASE_URL (ex: postgresql://...)
 DB_FILENAME = 'db.sqlite3'
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_FILENAME}'
+DATABASE_URI = os.environ.get(
+    'SQLALCHEMY_DATABASE_URI',
+    os.environ.get('DATABASE_URL', f'sqlite:///{DB_FILENAME}'))
+
+# Heroku still gives postgres:// urls, that SQLAlchemy doesn't accept
+if DATABASE_URI.startswith('postgres://'):
+    DATABASE_URI = 'postgresql://' + DATABASE_URI[len('postgres://'):]
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+# Connections kept by every process, eventlet serves many requests at once
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    # Server databases close idle connections
+    'pool_recycle': 1800,
+    'pool_pre_ping': not DATABASE_URI.startswith('sqlite')
+}
+
+# SQLite settings applied to every connection:
+# in WAL mode readers don't block the writer and the writer doesn't block
+# readers, and writers wait for each other up to the busy timeout instead
+# of failing with "database is locked"
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE',
+                                                   'WAL')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(
+    os.environ.get('SQLITE_BUSY_TIMEOUT', 30000))  # ms
+
+# In-memory databases have a single connection, without a pool
+if DATABASE_URI in ('sqlite://', 'sqlite:///:memory:'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+
 db = SQLAlchemy(app)
 
+# Send the number of database queries of every request
+# in the X-Query-Count header
+app.config['COUNT_QUERIES'] = os.environ.get('COUNT_QUERIES') == '1'
+
 
 # Utility functions
 def gen_uid():
     return str(uuid4())[:6]
 
 
+def is_true(value):
+    # Boolean url argument (ex: ?full=1)
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute(
+        f'PRAGMA journal_mode = {app.config["SQLITE_JOURNAL_MODE"]}')
+    cursor.execute(
+        f'PRAGMA busy_timeout = {app.config["SQLITE_BUSY_TIMEOUT"]:d}')
+
+    # In WAL mode, only the last transactions can be lost on a power failure,
+    # the database can't be corrupted
+    if app.config['SQLITE_JOURNAL_MODE'].upper() == 'WAL':
+        cursor.execute('PRAGMA synchronous = NORMAL')
+
+    cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*args):
+    if app.config['COUNT_QUERIES'] and has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+@app.after_request
+def send_query_count(response):
+    if app.config['COUNT_QUERIES']:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+
+    return response
+
+
 # Database models
 class Meeting(db.Model):
+    # Listing order
+    __table_args__ = (db.Index('ix_meeting_created_at_uid', 'created_at',
+                               'uid'), )
+
     uid = db.Column(db.String, default=gen_uid, primary_key=True)
     title = db.Column(db.String, nullable=False)
 
@@ -54,26 +236,50 @@ class Meeting(db.Model):
                             cascade='all, delete-orphan',
                             lazy=True)
 
+    upload_sessions = db.relationship('UploadSession',
+                                      cascade='all, delete-orphan',
+                                      lazy=True)
+
+    # Seq of the last file event, see log_events
+    event_seq = db.Column(db.Integer, default=0, nullable=False)
+
     created_at = db.Column(db.DateTime, default=datetime.now)
 
-    def as_json(self):
-        return {
+    def as_json(self, full=False):
+        """ Summary of the meeting with its number of guests and files,
+            the full form also has the guest and file lists.
+            Load meetings with meeting_query(full) to serialize them
+            without a query per meeting """
+        meeting = {
             'uid': self.uid,
             'title': self.title,
             'host_uid': self.host_uid,
             'host_fullname': self.host_fullname,
             'password': self.password,
             'secret_key': self.secret_key,
-            'guests': [g.as_json() for g in self.guests],
-            'files': [f.as_json() for f in self.files],
             'created_at': self.created_at
         }
 
+        if full:
+            meeting['guests'] = [g.as_json() for g in self.guests]
+            meeting['files'] = [f.as_json() for f in self.files]
+            meeting['guest_count'] = len(meeting['guests'])
+            meeting['file_count'] = len(meeting['files'])
+        else:
+            meeting['guest_count'] = self.guest_count
+            meeting['file_count'] = self.file_count
+
+        return meeting
+
     def __repr__(self):
         return f'Meeting({self.uid}, {self.host_uid}, {self.host_fullname}, {self.password}, {self.secret_key}, {len(self.guests)}, {len(self.files)}, {self.created_at})'
 
 
 class Guest(db.Model):
+    # Guests are looked up by meeting and fullname,
+    # which is also the index of the meeting guest list
+    __table_args__ = (db.UniqueConstraint('meeting_uid', 'fullname'), )
+
     uid = db.Column(db.String, default=gen_uid, primary_key=True)
     meeting_uid = db.Column(db.String,
                             db.ForeignKey('meeting.uid'),
@@ -93,17 +299,39 @@ class Guest(db.Model):
 
 
 class File(db.Model):
+    # Files are looked up by meeting, author and filename,
+    # the prefixes of this index serve the meeting and author file lists
+    __table_args__ = (db.UniqueConstraint('meeting_uid', 'author_uid',
+                                          'filename'),
+                      db.Index('ix_file_meeting_uid_created_at_uid',
+                               'meeting_uid', 'created_at', 'uid'))
+
     uid = db.Column(db.String, default=gen_uid, primary_key=True)
-    meeting_uid = db.Column(db.Integer,
+    meeting_uid = db.Column(db.String,
                             db.ForeignKey('meeting.uid'),
                             nullable=False)
-    author_uid = db.Column(db.Integer,
-                           db.ForeignKey('guest.uid'),
-                           nullable=False)
+    # Uid of a guest or of the meeting host
+    author_uid = db.Column(db.String, nullable=False)
     filename = db.Column(db.String, nullable=False)
     local_path = db.Column(db.String, nullable=False)
     save_path = db.Column(db.String, nullable=False)
 
+    # Stored content, shared by the files with the same digest
+    blob_digest = db.Column(db.String, db.ForeignKey('blob.digest'))
+    blob = db.relationship('Blob', lazy=True)
+
+    # Incremented every time the file content changes
+    version = db.Column(db.Integer, default=1, nullable=False)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime,
+                           default=datetime.now,
+                           onupdate=datetime.now)
+
+    def etag(self):
+        # Strong ETag: a file uid and version always have the same content
+        return f'{self.uid}-{self.version}'
+
     def as_json(self):
         return {
             'uid': self.uid,
@@ -111,14 +339,716 @@ class File(db.Model):
             'meeting_uid': self.meeting_uid,
             'filename': self.filename,
             'local_path': self.local_path,
-            'save_path': self.save_path
+            'save_path': self.save_path,
+            'digest': self.blob_digest,
+            'version': self.version,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
         }
 
     def __repr__(self):
         return f'File({self.uid}, {self.author_uid}, {self.meeting_uid}, {self.filename}, {self.local_path}, {self.save_path})'
 
 
+class Blob(db.Model):
+    """ Content of uploaded files, stored once per digest.
+
+        The digest is either a meeting scoped keyed digest of the plaintext
+        given by the client, or the SHA-256 of the stored content.
+        The blob is deleted with the last file referencing it
+    """
+    digest = db.Column(db.String, primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    save_path = db.Column(db.String, nullable=False)
+    references = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f'Blob({self.digest}, {self.size}, {self.references})'
+
+
+class UploadSession(db.Model):
+    """ A file uploaded chunk by chunk,
+        that can be resumed after an interrupted connection """
+    uid = db.Column(db.String, default=gen_uid, primary_key=True)
+    meeting_uid = db.Column(db.String,
+                            db.ForeignKey('meeting.uid'),
+                            nullable=False,
+                            index=True)
+    author_uid = db.Column(db.String, nullable=False)
+    filename = db.Column(db.String, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    part_path = db.Column(db.String, nullable=False)
+    digest = db.Column(db.String)
+
+    chunks = db.relationship('UploadChunk',
+                             cascade='all, delete-orphan',
+                             lazy=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def chunk_count(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        # Every chunk is chunk_size long, except the last one
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def as_json(self):
+        return {
+            'uid': self.uid,
+            'meeting_uid': self.meeting_uid,
+            'author_uid': self.author_uid,
+            'filename': self.filename,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunk_count': self.chunk_count(),
+            'received': sorted(chunk.index for chunk in self.chunks),
+            'created_at': self.created_at
+        }
+
+    def __repr__(self):
+        return f'UploadSession({self.uid}, {self.meeting_uid}, {self.author_uid}, {self.filename}, {self.size}, {self.chunk_size})'
+
+
+# Number of guests and files of a meeting, loaded by a subquery
+Meeting.guest_count = db.column_property(select(func.count(
+    Guest.uid)).where(Guest.meeting_uid == Meeting.uid).scalar_subquery(),
+                                         deferred=True,
+                                         group='counts')
+
+Meeting.file_count = db.column_property(select(func.count(
+    File.uid)).where(File.meeting_uid == Meeting.uid).scalar_subquery(),
+                                        deferred=True,
+                                        group='counts')
+
+
+def meeting_query(full=False):
+    """ Meetings query loading what as_json(full) needs along with them,
+        so serializing them costs the same number of queries
+        whatever the number of meetings """
+    # One query per relationship, selectinload would send one more
+    # every 500 meetings
+    if full:
+        return Meeting.query.options(subqueryload(Meeting.guests),
+                                     subqueryload(Meeting.files))
+
+    return Meeting.query.options(undefer_group('counts'))
+
+
+def encode_cursor(values):
+    # Opaque cursor from the sort key of the last item of a page
+    values = [v.isoformat() if isinstance(v, date) else v for v in values]
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, columns):
+    """ Sort key of a cursor, raises ValueError if it is invalid """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+
+        # Dates are sent back as ISO 8601 strings
+        return [
+            datetime.fromisoformat(value)
+            if isinstance(column.type, db.DateTime) else value
+            for column, value in zip(columns, values)
+        ]
+    except (ValueError, TypeError):
+        raise ValueError('Invalid argument: cursor')
+
+
+def paginate(query, columns, cursor, limit):
+    """ Page of query sorted by columns, the last one being unique,
+        starting after the cursor of the previous page.
+
+        Keyset pagination: the page is read from the index whatever
+        its position, unlike with an offset.
+        Returns the items and the cursor of the next page,
+        None for the last page
+    """
+    if cursor is not None:
+        values = decode_cursor(cursor, columns)
+        query = query.filter(
+            tuple_(*columns) > tuple_(*[
+                literal(value, column.type)
+                for column, value in zip(columns, values)
+            ]))
+
+    # One more item tells if there is a next page
+    items = query.order_by(*columns).limit(limit + 1).all()
+
+    if len(items) <= limit:
+        return items, None
+
+    items = items[:limit]
+
+    return items, encode_cursor(
+        [getattr(items[-1], column.key) for column in columns])
+
+
+def get_page_args():
+    """ cursor, limit and fields url arguments of a listing,
+        raises ValueError if one is invalid
+
+    Usage: ?cursor=CURSOR&limit=LIMIT&fields=uid,title
+    """
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', app.config['PAGE_SIZE'])
+    fields = request.args.get('fields')
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('Invalid argument: limit')
+
+    if not 0 < limit <= app.config['MAX_PAGE_SIZE']:
+        raise ValueError('Invalid argument: limit')
+
+    if fields is not None:
+        fields = fields.split(',')
+
+    return cursor, limit, fields
+
+
+def get_date_arg(name):
+    """ ISO 8601 date url argument, None if not given,
+        raises ValueError if it is invalid """
+    value = request.args.get(name)
+
+    if value is None:
+        return None
+
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid argument: {name}')
+
+
+def select_fields(items, fields):
+    """ Keep the given fields of the serialized items,
+        raises ValueError on an unknown field """
+    if fields is None or not items:
+        return items
+
+    unknown = [field for field in fields if field not in items[0]]
+
+    if unknown:
+        raise ValueError(f'Invalid argument: fields ({", ".join(unknown)})')
+
+    return [{field: item[field] for field in fields} for item in items]
+
+
+class UploadChunk(db.Model):
+    """ A chunk received by an upload session """
+    session_uid = db.Column(db.String,
+                            db.ForeignKey('upload_session.uid'),
+                            primary_key=True)
+    index = db.Column(db.Integer, primary_key=True)
+
+    def __repr__(self):
+        return f'UploadChunk({self.session_uid}, {self.index})'
+
+
+class Job(db.Model):
+    """ Work done in the background by the job runners, see run_jobs().
+
+        A job is claimed by one runner for JOB_LEASE seconds, a job whose
+        runner died is claimed again once its lease expired. Failed jobs
+        are retried after JOB_RETRY_DELAY seconds, doubled every attempt,
+        and kept as failed after JOB_MAX_ATTEMPTS
+    """
+    # Claimed in run_after order
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status',
+                               'run_after'), )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # 'delete': remove the file or folder at path
+    # 'expire_upload': drop the upload session writing the file at path
+    kind = db.Column(db.String, nullable=False)
+    path = db.Column(db.String, nullable=False)
+    # 'pending' or 'failed'
+    status = db.Column(db.String, default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.String)
+
+    run_after = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    owner = db.Column(db.String)
+    lease_until = db.Column(db.DateTime)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f'Job({self.id}, {self.kind}, {self.path}, {self.status}, {self.attempts})'
+
+
+class MeetingEvent(db.Model):
+    """ A file event sent to a meeting room, numbered by seq in the order
+        of the meeting events, see log_events(). Only the last EVENT_LOG_SIZE
+        events of a meeting are kept. A guest leaving with files is logged
+        too, as "guest left", since the manifest changes.
+
+        The primary key keeps the seqs of a meeting unique
+    """
+    meeting_uid = db.Column(db.String,
+                            db.ForeignKey('meeting.uid'),
+                            primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String, nullable=False)
+    data = db.Column(db.JSON, nullable=False)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def as_json(self):
+        # Sent like the events of a "files changed" batch
+        return dict(self.data, event=self.event, seq=self.seq)
+
+    def __repr__(self):
+        return f'MeetingEvent({self.meeting_uid}, {self.seq}, {self.event})'
+
+
+# Auth cache
+# Almost every request checks a meeting password or secret key, or who
+# the author of a file is: these records are cached instead of the rows.
+# Meetings and guests never change, entries are invalidated when they are
+# deleted or created, in every process when there is a message queue.
+# Otherwise the TTL bounds how long other processes see them
+MeetingAuth = namedtuple('MeetingAuth',
+                         'uid host_uid host_fullname password secret_key')
+GuestAuth = namedtuple('GuestAuth', 'uid meeting_uid fullname')
+
+meeting_cache = LRUCache(app.config['AUTH_CACHE_SIZE'],
+                         app.config['AUTH_CACHE_TTL'])
+guest_cache = LRUCache(app.config['AUTH_CACHE_SIZE'],
+                       app.config['AUTH_CACHE_TTL'])
+
+
+def get_meeting_auth(uid):
+    """ Auth record of a meeting, None if not found """
+    def load():
+        meeting = Meeting.query.filter_by(uid=uid).first()
+
+        if meeting is None:
+            return None
+
+        return MeetingAuth(meeting.uid, meeting.host_uid,
+                           meeting.host_fullname, meeting.password,
+                           meeting.secret_key)
+
+    # Unknown uids are not cached, they would evict meetings
+    return meeting_cache.get_or_load(uid, load, cache_none=False)
+
+
+def guest_auth(guest):
+    return GuestAuth(guest.uid, guest.meeting_uid,
+                     guest.fullname) if guest is not None else None
+
+
+def get_guest_auth(guest_uid):
+    """ Auth record of a guest, None if not found """
+    return guest_cache.get_or_load(
+        ('uid', guest_uid),
+        lambda: guest_auth(Guest.query.filter_by(uid=guest_uid).first()),
+        cache_none=False)
+
+
+def get_guest_auth_by_fullname(meeting_uid, fullname):
+    """ Auth record of the guest of a meeting with this fullname,
+        None if there is none (ex: the host), which is cached too
+        until a guest joins with this fullname """
+    return guest_cache.get_or_load(
+        ('fullname', meeting_uid, fullname), lambda: guest_auth(
+            Guest.query.filter_by(meeting_uid=meeting_uid,
+                                  fullname=fullname).first()))
+
+
+# Auth records forgotten by a process are forgotten by the others through
+# an event of the message queue, sent to a room without sockets
+AUTH_CACHE_ROOM = 'auth cache'
+AUTH_CACHE_EVENT = 'forget auth'
+
+
+def guest_keys(guest):
+    return [('uid', guest.uid), ('fullname', guest.meeting_uid, guest.fullname)]
+
+
+def invalidate_guest(guest):
+    invalidate_auth(guests=guest_keys(guest))
+
+
+def invalidate_auth(meetings=(), guests=()):
+    """ Forget the auth records of meetings by uid and of guests by key,
+        in this process and in the others """
+    forget_auth(meetings, guests)
+
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        data = {
+            'meetings': list(meetings),
+            'guests': [list(key) for key in guests]
+        }
+
+        sio.emit(AUTH_CACHE_EVENT, data, room=AUTH_CACHE_ROOM)
+
+
+def forget_auth(meetings, guests):
+    for uid in meetings:
+        meeting_cache.invalidate(uid)
+
+    # Sent by the queue as lists
+    for key in guests:
+        guest_cache.invalidate(tuple(key))
+
+
+# Background jobs
+# Requests only record the storage to reclaim, the job runner of every
+# process then claims due jobs from the job table and runs them in batches
+JOB_DELETE = 'delete'
+JOB_EXPIRE_UPLOAD = 'expire_upload'
+
+# Work done by the job runner of this process, for /stats/jobs
+job_counters = {
+    'runs': 0,
+    'completed': 0,
+    'retried': 0,
+    'failed': 0,
+    'removed': 0,
+    'reclaimed_bytes': 0
+}
+job_counters_lock = threading.Lock()
+
+job_runner_started = False
+job_runner_lock = threading.Lock()
+
+
+def count_jobs(**counts):
+    with job_counters_lock:
+        for name, count in counts.items():
+            job_counters[name] += count
+
+
+def delete_later(*paths):
+    """ Remove files or folders of the storage in the background,
+        once the current transaction is committed """
+    if paths:
+        db.session.execute(insert(Job), [{
+            'kind': JOB_DELETE,
+            'path': path
+        } for path in paths])
+
+
+def expire_upload(part_path):
+    """ Drop the upload session writing part_path if it wasn't committed """
+    sessions = select(
+        UploadSession.uid).where(UploadSession.part_path == part_path)
+
+    db.session.execute(
+        delete(UploadChunk).where(UploadChunk.session_uid.in_(sessions)))
+    db.session.execute(
+        delete(UploadSession).where(UploadSession.part_path == part_path))
+
+    delete_later(part_path)
+
+
+def remove_path(path, budget):
+    """ Remove at most budget files and folders of path, deepest first.
+        Returns the number removed, their size and whether path is gone """
+    if not os.path.lexists(path):
+        return 0, 0, True
+
+    if os.path.islink(path) or not os.path.isdir(path):
+        size = os.lstat(path).st_size
+        os.remove(path)
+        return 1, size, True
+
+    removed = size = 0
+
+    with os.scandir(path) as entries:
+        entries = list(entries)
+
+    for entry in entries:
+        if removed >= budget:
+            return removed, size, False
+
+        entry_removed, entry_size, done = remove_path(entry.path,
+                                                      budget - removed)
+        removed += entry_removed
+        size += entry_size
+
+        if not done:
+            return removed, size, False
+
+    if removed >= budget:
+        return removed, size, False
+
+    os.rmdir(path)
+    return removed + 1, size, True
+
+
+def run_job(job):
+    """ Run a claimed job, returns whether it is done """
+    if job.kind == JOB_DELETE:
+        removed, size, done = remove_path(job.path,
+                                          app.config['JOB_DELETE_BUDGET'])
+        count_jobs(removed=removed, reclaimed_bytes=size)
+        return done
+
+    if job.kind == JOB_EXPIRE_UPLOAD:
+        expire_upload(job.path)
+        return True
+
+    raise ValueError(f'Unknown job kind: {job.kind}')
+
+
+def claim_jobs(limit):
+    """ Lease at most limit due jobs to this runner, oldest first """
+    now = datetime.now()
+    owner = uuid4().hex
+    claimable = or_(Job.lease_until.is_(None), Job.lease_until < now)
+
+    due = select(Job.id).where(Job.status == 'pending', Job.run_after <= now,
+                               claimable).order_by(Job.run_after,
+                                                   Job.id).limit(limit)
+
+    # The lease is checked again by the update,
+    # so that two runners never claim the same job
+    db.session.execute(
+        update(Job).where(Job.id.in_(due), claimable).values(
+            owner=owner,
+            lease_until=now + timedelta(seconds=app.config['JOB_LEASE'])).
+        execution_options(synchronize_session=False))
+    db.session.commit()
+
+    return Job.query.filter_by(owner=owner).order_by(Job.run_after,
+                                                     Job.id).all()
+
+
+def run_jobs(limit=None):
+    """ Run a batch of due jobs, returns the number of jobs run """
+    jobs = claim_jobs(limit or app.config['JOB_BATCH_SIZE'])
+
+    for job in jobs:
+        job_id = job.id
+
+        try:
+            done = run_job(job)
+        except Exception as e:
+            # Its changes are undone (ex: database is locked),
+            # the job is read again to record the attempt
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+
+            if job is None:
+                continue
+
+            job.attempts += 1
+            job.last_error = str(e)
+
+            if job.attempts >= app.config['JOB_MAX_ATTEMPTS']:
+                job.status = 'failed'
+                count_jobs(failed=1)
+            else:
+                delay = app.config['JOB_RETRY_DELAY'] * 2**(job.attempts - 1)
+                job.run_after = datetime.now() + timedelta(seconds=delay)
+                count_jobs(retried=1)
+        else:
+            if done:
+                db.session.delete(job)
+                count_jobs(completed=1)
+
+            # Its budget is spent, the other due jobs go first
+            else:
+                job.run_after = datetime.now()
+
+        job.owner = job.lease_until = None
+
+        # Committed job by job, to keep the progress of the batch
+        db.session.commit()
+
+    count_jobs(runs=1)
+
+    return len(jobs)
+
+
+def job_runner():
+    """ Run the due jobs as long as the process runs """
+    while True:
+        with app.app_context():
+            try:
+                count = run_jobs()
+            except Exception:
+                app.logger.exception('Job runner failed')
+                db.session.rollback()
+                count = 0
+
+        # Yield to the requests between batches, wait if there was no job
+        sio.sleep(0 if count else app.config['JOB_POLL_INTERVAL'])
+
+
+@app.before_request
+def start_job_runner():
+    """ Start the job runner of this process along with its first request """
+    global job_runner_started
+
+    if job_runner_started or not app.config['JOB_RUNNER']:
+        return
+
+    with job_runner_lock:
+        if not job_runner_started:
+            sio.start_background_task(job_runner)
+            job_runner_started = True
+
+
 # Events
+# A joining socket receives a snapshot of the meeting, the other sockets
+# of the room only receive what changed: the guest who joined or left
+# Guests joining or leaving a process are told to the other processes
+# by an event of the message queue, sent to a room without sockets
+PRESENCE_ROOM = 'presence'
+PRESENCE_EVENT = 'guest presence'
+
+
+def announce_presence(meeting_uid, fullname, joined):
+    """ Tell every process that a guest joined or left this one, and the
+        room when the guest joined its first process or left its last one """
+    changed = presence.apply(meeting_uid, fullname, joined)
+
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        data = {
+            'meeting_uid': meeting_uid,
+            'guest_fullname': fullname,
+            'joined': joined
+        }
+
+        sio.emit(PRESENCE_EVENT, data, room=PRESENCE_ROOM)
+
+    # Still here through another process
+    if not changed:
+        return
+
+    event = 'new join' if joined else 'leaved'
+
+    sio.emit(event, {'guest_fullname': fullname},
+             room=meeting_uid,
+             skip_sid=request.sid)
+
+
+# The file changes go to one of the two file rooms of a meeting: the sockets
+# joining with batch_files receive them every FILE_EVENTS_WINDOW in one
+# "files changed" event, the others receive one event per change
+def file_events_room(meeting_uid, batched):
+    return f'{meeting_uid}:files:{"batched" if batched else "each"}'
+
+
+def send_file_changes(meeting_uid, changes):
+    sio.emit('files changed', {
+        'added': [data for added, data in changes if added],
+        'deleted': [data for added, data in changes if not added]
+    },
+             room=file_events_room(meeting_uid, True))
+
+
+file_events = EventBatcher(send_file_changes,
+                           window=app.config['FILE_EVENTS_WINDOW'],
+                           max_size=app.config['FILE_EVENTS_BATCH'],
+                           start_task=sio.start_background_task,
+                           sleep=sio.sleep)
+
+
+# Every file event of a meeting is numbered and logged: a socket joining
+# again with the seq of the last event it received only gets the events it
+# missed, unless they are not all logged anymore
+def log_events(meeting_uid, events):
+    """ Log (event, data) events of a meeting, returns their seqs,
+        none if the meeting was deleted """
+
+    # The seqs are taken from the counter of the meeting: its row is locked
+    # by the update until the commit, so the workers logging events of the
+    # same meeting get seqs of their own
+    allocated = db.session.execute(
+        update(Meeting.__table__).where(Meeting.uid == meeting_uid).values(
+            event_seq=Meeting.event_seq + len(events)))
+
+    if not allocated.rowcount:
+        return []
+
+    seq = current_seq(meeting_uid)
+    first_seq = seq - len(events) + 1
+
+    db.session.execute(insert(MeetingEvent.__table__), [{
+        'meeting_uid': meeting_uid,
+        'seq': first_seq + i,
+        'event': event,
+        'data': data
+    } for i, (event, data) in enumerate(events)])
+
+    db.session.execute(
+        delete(MeetingEvent).where(
+            MeetingEvent.meeting_uid == meeting_uid,
+            MeetingEvent.seq <= seq - app.config['EVENT_LOG_SIZE']))
+    db.session.commit()
+
+    return list(range(first_seq, seq + 1))
+
+
+def current_seq(meeting_uid):
+    """ Seq of the last event of a meeting, 0 before the first one """
+    return db.session.execute(
+        select(Meeting.event_seq).where(
+            Meeting.uid == meeting_uid)).scalar() or 0
+
+
+def missed_events(meeting_uid, last_seq):
+    """ Events of a meeting after last_seq, None if some of them
+        are not logged anymore """
+    events = db.session.execute(
+        select(MeetingEvent).where(
+            MeetingEvent.meeting_uid == meeting_uid,
+            MeetingEvent.seq > last_seq).order_by(
+                MeetingEvent.seq)).scalars().all()
+
+    first_seq = events[0].seq if events else current_seq(meeting_uid) + 1
+
+    if first_seq != last_seq + 1:
+        return None
+
+    return [event.as_json() for event in events]
+
+
+def notify_file_change(meeting_uid, event, data, author_uid, filename):
+    """ Log a file added ("new file") or deleted and tell the room.
+        The changes of a file waiting to be sent replace each other """
+    notify_file_changes(meeting_uid, [(event, data, author_uid, filename)])
+
+
+def notify_file_changes(meeting_uid, changes):
+    """ notify_file_change() for (event, data, author_uid, filename) changes
+        made together, logged at once and sent in as few batches as possible
+    """
+    seqs = log_events(meeting_uid,
+                      [(event, data) for event, data, _, _ in changes])
+    batch = []
+
+    for seq, (event, data, author_uid, filename) in zip(seqs, changes):
+        data = dict(data, seq=seq)
+
+        sio.emit(event, data, room=file_events_room(meeting_uid, False))
+
+        # Same key for the upload and the deletion of a file
+        key = (author_uid, secure_filename(filename))
+
+        # Added files are "new file" ones, deleted files keep the event name
+        # telling the kind of deletion
+        if event == 'new file':
+            batch.append((key, (True, data)))
+        else:
+            batch.append((key, (False, dict(data, event=event))))
+
+    file_events.add_many(meeting_uid, batch)
+
+
 @sio.on('join')
 def on_join(data):
     # get guest fullname and meeting_uid from data
@@ -127,53 +1057,76 @@ def on_join(data):
 
     # add session to corresponding meeting room
     join_room(meeting_uid)
+    join_room(file_events_room(meeting_uid, bool(data.get('batch_files'))))
 
     # Get corresponding meeting
-    meeting = Meeting.query.filter_by(uid=meeting_uid).first()
+    meeting = get_meeting_auth(meeting_uid)
 
     # If meeting has ended
     if meeting is None:
         return
 
-    # Guest's fullname
-    guests = [guest.fullname for guest in meeting.guests]
+    # The other guests only need to know about the first socket of a guest
+    if presence.join(meeting_uid, request.sid, guest_fullname):
+        announce_presence(meeting_uid, guest_fullname, True)
+
+    # A socket joining again only needs the file events it missed
+    last_seq = data.get('last_seq')
+
+    if isinstance(last_seq, int):
+        events = missed_events(meeting_uid, last_seq)
+
+        if events is not None:
+            emit('catch up', {
+                'guests': presence.fullnames(meeting_uid),
+                'events': events,
+                'seq': events[-1]['seq'] if events else last_seq
+            })
+            return
+
+    # Events after this one are sent to the socket, the files are read after
+    seq = current_seq(meeting_uid)
 
     # Get public files
     host_files = File.query.filter_by(meeting_uid=meeting.uid,
                                       author_uid=meeting.host_uid).all()
     files = [file.as_json() for file in host_files]
 
-    # notify with current guest list ans publicly shared files
-    response = {'guests': guests, 'public_files': files}
+    # Current guest list and publicly shared files, for this socket only
+    response = {
+        'guests': presence.fullnames(meeting_uid),
+        'public_files': files,
+        'seq': seq
+    }
 
     if guest_fullname is not None:
         response['guest_fullname'] = guest_fullname
 
-    sio.emit('new join', response, room=meeting_uid)
+    emit('snapshot', response)
 
 
 @sio.on('leave')
 def on_leave(data):
-    # get guest fullname and meeting_uid from data
+    # get meeting_uid from data, the guest is the one who joined
     meeting_uid = data.get('meeting_uid')
-    guest_fullname = data.get('guest_fullname')
-
-    # get meeting guests
-    meeting = Meeting.query.filter_by(uid=meeting_uid).first()
-
-    # If the meeting has ended
-    if meeting is None:
-        return
 
-    # Guest's fullname
-    guests = [guest for guest in meeting.guests]
+    guest_fullname = presence.leave(meeting_uid, request.sid)
 
-    # notify with current guest list
-    response = {'guest_fullname': guest_fullname, 'guests': guests}
-    sio.emit('leaved', response, room=meeting_uid)
+    # notify the others, unless the guest is still here with another socket
+    if guest_fullname is not None:
+        announce_presence(meeting_uid, guest_fullname, False)
 
     # remove session from meeting
     leave_room(meeting_uid)
+    leave_room(file_events_room(meeting_uid, False))
+    leave_room(file_events_room(meeting_uid, True))
+
+
+@sio.on('disconnect')
+def on_disconnect(reason=None):
+    # Guests closing the app don't always leave first
+    for meeting_uid, guest_fullname in presence.disconnect(request.sid):
+        announce_presence(meeting_uid, guest_fullname, False)
 
 
 @sio.on('end')
@@ -200,12 +1153,483 @@ def on_message(data):
     sio.emit('new message', response, room=meeting_uid)
 
 
+# Upload helpers
+def get_author_fullname(meeting, author_uid):
+    """ Fullname of the host or the guest uploading a file,
+        None if the author is unknown """
+    # If author is the host
+    if author_uid == meeting.host_uid:
+        return meeting.host_fullname
+
+    # Get corresponding guest
+    guest = get_guest_auth(author_uid)
+
+    return guest.fullname if guest is not None else None
+
+
+def valid_digest(digest):
+    # Digests name the stored blobs, they can't be anything else
+    return digest is None or DIGEST_PATTERN.fullmatch(digest) is not None
+
+
+def reference_blob(digest):
+    """ Add a reference to the blob stored with a digest, None if there is
+        none. The count is updated by the database, so that concurrent
+        uploads of the same content don't lose references """
+    if not change_references(digest, 1):
+        return None
+
+    return Blob.query.get(digest)
+
+
+def change_references(digest, count):
+    """ Add count to the references of a blob, the number of updated blobs """
+    return db.session.execute(
+        update(Blob).where(Blob.digest == digest).values(
+            references=Blob.references +
+            count).execution_options(synchronize_session=False)).rowcount
+
+
+def acquire_blob(digest, save):
+    """ Reference the blob of an upload content.
+        The content is saved with save(path) unless a blob with the same
+        digest is already stored, without a digest it is addressed by
+        the SHA-256 of the saved content. Without save, None is returned
+        if the content isn't stored (anymore) """
+
+    # Looked up first so that nothing is written while the content is saved
+    if digest is not None and Blob.query.get(digest) is not None:
+        blob = reference_blob(digest)
+
+        # Otherwise released meanwhile
+        if blob is not None:
+            return blob
+
+    if save is None:
+        return None
+
+    tmp_path, digest = save_content(save, digest)
+    insert_blobs({digest: tmp_path})
+
+    return reference_blob(digest)
+
+
+def save_content(save, digest=None):
+    """ Save a content next to the blobs with save(path), the path where it
+        is saved and its digest, the SHA-256 of the content if not given """
+    blobs_folder = os.path.join(app.config['UPLOADS'], BLOBS_FOLDER)
+    os.makedirs(blobs_folder, exist_ok=True)
+
+    tmp_path = os.path.join(blobs_folder, '.' + uuid4().hex)
+    save(tmp_path)
+
+    if digest is None:
+        sha256 = hashlib.sha256()
+
+        with open(tmp_path, 'rb') as saved:
+            for block in iter(lambda: saved.read(BUFFER_SIZE), b''):
+                sha256.update(block)
+
+        digest = sha256.hexdigest()
+
+    return tmp_path, digest
+
+
+def insert_blobs(contents):
+    """ Store the contents saved by save_content(), given as {digest: path},
+        as blobs without references, unless concurrent uploads stored them
+        meanwhile. The save paths of their blobs by digest """
+    blobs_folder = os.path.join(app.config['UPLOADS'], BLOBS_FOLDER)
+    contents = dict(contents)
+    paths = {}
+
+    for attempt in range(3):
+        digests = list(contents)
+
+        for start in range(0, len(digests), IN_BATCH_SIZE):
+            for digest, save_path in db.session.query(
+                    Blob.digest, Blob.save_path).filter(
+                        Blob.digest.in_(digests[start:start +
+                                                IN_BATCH_SIZE])):
+                os.remove(contents.pop(digest))
+                paths[digest] = save_path
+
+        # Every blob has its own path: the deletion of a released blob
+        # is deferred, it must not remove a new blob with the same digest
+        rows = [{
+            'digest': digest,
+            'size': os.path.getsize(tmp_path),
+            'save_path': os.path.join(blobs_folder,
+                                      f'{digest}.{uuid4().hex[:8]}'),
+            'references': 0
+        } for digest, tmp_path in contents.items()]
+
+        if not rows:
+            return paths
+
+        # Inserted meanwhile by a concurrent upload, looked up again
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(Blob.__table__), rows)
+        except IntegrityError:
+            if attempt == 2:
+                for tmp_path in contents.values():
+                    os.remove(tmp_path)
+
+                raise
+
+            continue
+
+        for row in rows:
+            os.replace(contents[row['digest']], row['save_path'])
+            paths[row['digest']] = row['save_path']
+
+        return paths
+
+
+def content_digest(stream):
+    """ SHA-256 of an uploaded content, read again from its start """
+    sha256 = hashlib.sha256()
+
+    for block in iter(lambda: stream.read(BUFFER_SIZE), b''):
+        sha256.update(block)
+
+    stream.seek(0)
+
+    return sha256.hexdigest()
+
+
+def release_blob(digest, save_path):
+    """ Drop the reference of a file to the blob with this digest, once the
+        file is deleted or points to another blob. The blob is deleted with
+        its last reference and its content in the background """
+
+    # Stored before blobs, the file has its own content
+    if digest is None:
+        delete_later(save_path)
+        return
+
+    change_references(digest, -1)
+
+    # Deleted with its last reference. The row is locked by the update
+    # until the commit, other uploads can't reference it meanwhile
+    unreferenced = (Blob.digest == digest, Blob.references <= 0)
+    released = db.session.execute(
+        select(Blob.save_path).where(*unreferenced)).scalars().all()
+
+    if released:
+        db.session.execute(delete(Blob.__table__).where(*unreferenced))
+        delete_later(*released)
+
+
+def release_meeting_blobs(meeting_uid):
+    """ Drop the references of the files of a meeting to their blobs,
+        with a few queries whatever the number of files """
+    files = File.query.filter_by(meeting_uid=meeting_uid)
+
+    # References of every blob
+    references = db.session.execute(
+        select(File.blob_digest.label('digest'),
+               func.count().label('count')).where(
+                   File.meeting_uid == meeting_uid,
+                   File.blob_digest.isnot(None)).group_by(
+                       File.blob_digest)).mappings().all()
+
+    if references:
+        db.session.execute(
+            update(Blob.__table__).where(
+                Blob.digest == bindparam('b_digest')).values(
+                    references=Blob.references - bindparam('b_count')),
+            [{
+                'b_digest': row['digest'],
+                'b_count': row['count']
+            } for row in references])
+
+    released = db.session.execute(
+        select(Blob.digest, Blob.save_path).where(
+            Blob.references <= 0,
+            Blob.digest.in_(files.with_entities(File.blob_digest)))).all()
+
+    # Stored before blobs, the files have their own content
+    own_paths = files.filter(File.blob_digest.is_(None)).with_entities(
+        File.save_path).all()
+
+    delete_later(*[blob.save_path for blob in released],
+                 *[file.save_path for file in own_paths])
+
+    return [blob.digest for blob in released]
+
+
+def find_blob(digest):
+    """ Blob stored with this digest, None if there is none """
+    if digest is None or not valid_digest(digest):
+        return None
+
+    return Blob.query.get(digest)
+
+
+def store_file(meeting, author_uid, filename, save, digest=None):
+    """ Create the file of an upload, or get it if the author already uploaded
+        a file with the same name, then point it to the blob of its content,
+        saved with save(save_path) if it isn't stored yet. Without save,
+        None is returned if the content isn't stored """
+
+    # Files are stored and looked up by their secured filename
+    filename = secure_filename(filename)
+
+    # Check for no duplicate filenames from the same author
+    existingFile = File.query.filter_by(filename=filename,
+                                        meeting_uid=meeting.uid,
+                                        author_uid=author_uid).first()
+
+    blob = acquire_blob(digest, save)
+
+    # Released since the caller found it
+    if blob is None:
+        return None
+
+    file = point_file(meeting, author_uid, filename, existingFile, blob)
+
+    db.session.commit()
+
+    return file
+
+
+def store_files(meeting, author_uid, uploads):
+    """ store_file() for many uploads of an author, given as
+        (filename, save, digest) tuples with their digests,
+        in one transaction and a few queries whatever their number """
+    # Sent twice, the last content wins
+    latest = {}
+
+    for filename, save, digest in uploads:
+        filename = secure_filename(filename)
+        latest.pop(filename, None)
+        latest[filename] = (save, digest)
+
+    filenames = list(latest)
+    digests = [digest for _, digest in latest.values() if digest is not None]
+
+    existing = {}
+    paths = {}
+
+    for start in range(0, len(filenames), IN_BATCH_SIZE):
+        existing.update((file.filename, file) for file in File.query.filter(
+            File.meeting_uid == meeting.uid, File.author_uid == author_uid,
+            File.filename.in_(filenames[start:start + IN_BATCH_SIZE])))
+
+    for start in range(0, len(digests), IN_BATCH_SIZE):
+        paths.update(
+            db.session.query(Blob.digest, Blob.save_path).filter(
+                Blob.digest.in_(digests[start:start + IN_BATCH_SIZE])))
+
+    # The contents not stored yet are saved before anything is written
+    contents = {}
+    saved = {}
+
+    for filename, (save, digest) in latest.items():
+        if digest is None or (digest not in paths and digest not in saved):
+            tmp_path, digest = save_content(save, digest)
+
+            # Sent twice under different names
+            if digest in saved:
+                os.remove(tmp_path)
+            else:
+                saved[digest] = tmp_path
+
+        contents[filename] = digest
+
+    if saved:
+        paths.update(insert_blobs(saved))
+
+    # References taken and dropped by digest, counted by the database
+    references = {}
+    own_paths = []
+
+    for filename, digest in contents.items():
+        file = existing.get(filename)
+
+        # Same content as before: same reference
+        if file is not None and file.blob_digest == digest:
+            continue
+
+        references[digest] = references.get(digest, 0) + 1
+
+        if file is None:
+            continue
+
+        # Stored before blobs, the file has its own content
+        if file.blob_digest is None:
+            own_paths.append(file.save_path)
+        else:
+            references[file.blob_digest] = references.get(
+                file.blob_digest, 0) - 1
+
+    changed = [{
+        'b_digest': digest,
+        'b_count': count
+    } for digest, count in references.items() if count]
+
+    if changed:
+        db.session.execute(
+            update(Blob.__table__).where(
+                Blob.digest == bindparam('b_digest')).values(
+                    references=Blob.references + bindparam('b_count')),
+            changed)
+
+    uids = []
+
+    for filename, digest in contents.items():
+        file = existing.get(filename)
+
+        if file is None:
+            file = File(uid=gen_uid(),
+                        meeting_uid=meeting.uid,
+                        author_uid=author_uid,
+                        filename=filename,
+                        local_path='/',
+                        save_path=paths[digest],
+                        blob_digest=digest)
+
+            db.session.add(file)
+
+        # New content, new ETag
+        elif file.blob_digest != digest:
+            file.save_path = paths[digest]
+            file.blob_digest = digest
+            file.version += 1
+
+        uids.append(file.uid)
+
+    # No file points to the released blobs anymore
+    db.session.flush()
+
+    # Deleted with their last reference, their rows are locked by the update
+    released = [digest for digest, count in references.items() if count < 0]
+
+    for start in range(0, len(released), IN_BATCH_SIZE):
+        unreferenced = (Blob.digest.in_(released[start:start +
+                                                 IN_BATCH_SIZE]),
+                        Blob.references <= 0)
+        paths = db.session.execute(
+            select(Blob.save_path).where(*unreferenced)).scalars().all()
+
+        if paths:
+            db.session.execute(delete(Blob.__table__).where(*unreferenced))
+            own_paths.extend(paths)
+
+    delete_later(*own_paths)
+
+    db.session.commit()
+
+    # Loaded again together rather than one by one once expired
+    files = {}
+
+    for start in range(0, len(uids), IN_BATCH_SIZE):
+        files.update((file.uid, file) for file in File.query.filter(
+            File.uid.in_(uids[start:start + IN_BATCH_SIZE])))
+
+    return [files[uid] for uid in uids]
+
+
+def point_file(meeting, author_uid, filename, existingFile, blob):
+    """ Create the file of an upload pointing to its blob,
+        or point the existing file to it """
+
+    # If file doesnt exist
+    if existingFile is None:
+        # Create file
+        file = File(
+            uid=gen_uid(),
+            meeting_uid=meeting.uid,
+            author_uid=author_uid,
+            filename=filename,
+            local_path='/',  #TODO change this
+            save_path=blob.save_path,
+            blob_digest=blob.digest)
+
+        db.session.add(file)
+
+    # Same content as before: same reference and same ETag
+    elif existingFile.blob_digest == blob.digest:
+        file = existingFile
+        change_references(blob.digest, -1)
+
+    else:
+        # Update existing file
+        file = existingFile
+        released = (file.blob_digest, file.save_path)
+
+        file.save_path = blob.save_path
+        file.blob_digest = blob.digest
+
+        # New content, new ETag
+        file.version += 1
+
+        # No longer pointing to it when it's released
+        db.session.flush()
+        release_blob(*released)
+
+    return file
+
+
+def notify_new_file(meeting, filename, author_uid, author_fullname):
+    # Notify the room
+    notify_new_files(meeting, [filename], author_uid, author_fullname)
+
+
+def notify_new_files(meeting, filenames, author_uid, author_fullname):
+    # Notify the room once for files uploaded together
+    notify_file_changes(meeting.uid, [('new file', {
+        'filename': filename,
+        'author_uid': author_uid,
+        'author_fullname': author_fullname,
+    }, author_uid, filename) for filename in filenames])
+
+
 # Routes
 @app.route('/meetings')
 def meeting_index():
-    meetings = [meeting.as_json() for meeting in Meeting.query.all()]
+    """ List the meetings, by creation date
+
+    Usage: /meetings[?full=1][&created_after=DATE][&created_before=DATE]
+                    [&cursor=CURSOR][&limit=LIMIT][&fields=uid,title]
+
+    Meetings have their number of guests and files,
+    full=1 adds the guest and file lists.
+    The next page is requested with the next_cursor of the response,
+    which is null on the last page
+    """
+    full = is_true(request.args.get('full'))
+
+    try:
+        cursor, limit, fields = get_page_args()
+        created_after = get_date_arg('created_after')
+        created_before = get_date_arg('created_before')
+    except ValueError as e:
+        return jsonify(error=str(e))
+
+    query = meeting_query(full)
+
+    if created_after is not None:
+        query = query.filter(Meeting.created_at >= created_after)
+
+    if created_before is not None:
+        query = query.filter(Meeting.created_at < created_before)
+
+    try:
+        meetings, next_cursor = paginate(query,
+                                         [Meeting.created_at, Meeting.uid],
+                                         cursor, limit)
 
-    return jsonify(meetings=meetings, success="All meetings")
+        meetings = select_fields(
+            [meeting.as_json(full) for meeting in meetings], fields)
+    except ValueError as e:
+        return jsonify(error=str(e))
+
+    return jsonify(meetings=meetings,
+                   next_cursor=next_cursor,
+                   success="All meetings")
 
 
 @app.route('/meetings/new', methods=['POST'])
@@ -278,7 +1702,16 @@ def join_meeting():
         guest = Guest(fullname=fullname, meeting_uid=meeting.uid)
 
         db.session.add(guest)
-        db.session.commit()
+
+        # Joined at the same time with the same fullname
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify(error="Fullname already exists", fullname=fullname)
+
+        # The fullname may be cached as not being a guest
+        invalidate_guest(guest)
 
         return jsonify(success="Meeting joined successfully",
                        guest=guest.as_json(),
@@ -287,13 +1720,20 @@ def join_meeting():
 
 @app.route('/meetings/<uid>')
 def get_meeting(uid):
-    meeting = Meeting.query.filter_by(uid=uid).first()
+    """ Get a meeting
+
+    Usage: /meetings/<uid>[?full=1]
+
+    full=1 adds the guest and file lists to the meeting
+    """
+    full = is_true(request.args.get('full'))
+    meeting = meeting_query(full).filter_by(uid=uid).first()
 
     if meeting is None:
         return jsonify(error='Meeting not found', uid=uid)
     else:
         return jsonify(message="Meeting with given uid",
-                       meeting=meeting.as_json())
+                       meeting=meeting.as_json(full))
 
 
 @app.route('/meetings/<uid>/end', methods=['DELETE'])
@@ -311,40 +1751,232 @@ def end_meeting(uid):
         return jsonify(error="Meeting not found", uid=uid)
 
     if secret_key == meeting.secret_key:
-        # Delete stored files
+        # Serialized before it is deleted
+        response = meeting.as_json()
+
+        # Release stored files, shared contents are kept for other files.
+        # The rows are deleted by a few statements and the storage is
+        # reclaimed in the background, however many files the meeting has
+        released = release_meeting_blobs(meeting.uid)
+
+        # Delete the parts of unfinished uploads
         meeting_folder = os.path.join(app.config['UPLOADS'], meeting.uid)
 
         if os.path.exists(meeting_folder):
-            rmtree(meeting_folder)
+            delete_later(meeting_folder)
+
+        guests = db.session.execute(
+            select(Guest.uid, Guest.meeting_uid, Guest.fullname).where(
+                Guest.meeting_uid == meeting.uid)).all()
+
+        # Delete meeting from database, with its guests, files and uploads
+        sessions = select(
+            UploadSession.uid).where(UploadSession.meeting_uid == meeting.uid)
+
+        for statement in (
+                delete(UploadChunk).where(
+                    UploadChunk.session_uid.in_(sessions)),
+                delete(UploadSession).where(
+                    UploadSession.meeting_uid == meeting.uid),
+                delete(File).where(File.meeting_uid == meeting.uid),
+                delete(MeetingEvent).where(
+                    MeetingEvent.meeting_uid == meeting.uid),
+                delete(Guest).where(Guest.meeting_uid == meeting.uid),
+                delete(Meeting).where(Meeting.uid == meeting.uid)):
+            db.session.execute(
+                statement.execution_options(synchronize_session=False))
+
+        # Blobs are deleted after the files referencing them
+        for start in range(0, len(released), IN_BATCH_SIZE):
+            db.session.execute(
+                delete(Blob).where(
+                    Blob.digest.in_(released[start:start + IN_BATCH_SIZE]),
+                    Blob.references <= 0).execution_options(
+                        synchronize_session=False))
 
-        # Delete meeting from database
-        db.session.delete(meeting)
         db.session.commit()
 
+        # Forget the meeting and its guests in every process,
+        # the deleted meeting can't be read anymore
+        invalidate_auth(
+            meetings=[response['uid']],
+            guests=[('fullname', response['uid'], response['host_fullname'])] +
+            [key for guest in guests for key in guest_keys(guest)])
+
         return jsonify(success="Meeting ended successfully",
-                       meeting=meeting.as_json())
+                       meeting=response)
     else:
         return jsonify(error="Unauthorized: invalid secret_key")
 
 
 @app.route('/meetings/<uid>/guests')
 def get_meeting_guests(uid):
-    """ Get a meeting's guest list """
+    """ Get a meeting's guest list
+
+    Usage: /meetings/<uid>/guests[?cursor=CURSOR][&limit=LIMIT]
+                                 [&fields=uid,fullname]
+    """
+
+    try:
+        cursor, limit, fields = get_page_args()
+    except ValueError as e:
+        return jsonify(error=str(e))
 
     # Get corresponding meeting
-    meeting = Meeting.query.filter_by(uid=uid).first()
+    meeting = get_meeting_auth(uid)
 
     # Check if meeting exists
     if meeting is None:
         return jsonify(error="Meeting not found", uid=uid)
 
     # Get guest list
-    guests = [guest.as_json() for guest in meeting.guests]
+    query = Guest.query.filter_by(meeting_uid=meeting.uid)
+
+    try:
+        guests, next_cursor = paginate(query, [Guest.uid], cursor, limit)
+        guests = select_fields([guest.as_json() for guest in guests], fields)
+    except ValueError as e:
+        return jsonify(error=str(e))
 
     return jsonify(guests=guests,
+                   next_cursor=next_cursor,
                    success=f'Meeting with uid({meeting.uid}) guest list')
 
 
+@app.route('/meetings/<uid>/files')
+def get_meeting_files(uid):
+    """ Get a meeting's file list, by upload date
+
+    Usage: /meetings/<uid>/files?password=PASSWORD[&author_uid=AUTHOR_UID]
+                [&created_after=DATE][&created_before=DATE]
+                [&cursor=CURSOR][&limit=LIMIT][&fields=uid,filename]
+    """
+
+    # Get information from url arguments
+    password = request.args.get('password')
+    author_uid = request.args.get('author_uid')
+
+    if password is None:
+        return jsonify(error="Missing argument: password")
+
+    try:
+        cursor, limit, fields = get_page_args()
+        created_after = get_date_arg('created_after')
+        created_before = get_date_arg('created_before')
+    except ValueError as e:
+        return jsonify(error=str(e))
+
+    # Get corresponding meeting
+    meeting = get_meeting_auth(uid)
+
+    if meeting is None:
+        return jsonify(error="Meeting not found", uid=uid)
+
+    # Check password
+    if password != meeting.password:
+        return jsonify(error='Unauthorized: invalid password')
+
+    query = File.query.filter_by(meeting_uid=meeting.uid)
+
+    if author_uid is not None:
+        query = query.filter_by(author_uid=author_uid)
+
+    if created_after is not None:
+        query = query.filter(File.created_at >= created_after)
+
+    if created_before is not None:
+        query = query.filter(File.created_at < created_before)
+
+    try:
+        files, next_cursor = paginate(query, [File.created_at, File.uid],
+                                      cursor, limit)
+        files = select_fields([file.as_json() for file in files], fields)
+    except ValueError as e:
+        return jsonify(error=str(e))
+
+    return jsonify(files=files,
+                   next_cursor=next_cursor,
+                   success=f'Meeting with uid({meeting.uid}) file list')
+
+
+def stored_size(save_path):
+    """ Size of a file stored before its content had a blob """
+    try:
+        return os.path.getsize(save_path)
+    except OSError:
+        return None
+
+
+@app.route('/meetings/<uid>/manifest')
+def get_meeting_manifest(uid):
+    """ Get every file of a meeting with its author, size, digest, version
+    and modification time, to reconcile a local copy of the meeting files
+
+    Usage: /meetings/<uid>/manifest?password=PASSWORD
+
+    The ETag of the manifest is the seq of the last file event of the
+    meeting, returned as seq: If-None-Match gets a 304 Not Modified until
+    a file is added, changed or deleted. The files of guests who left
+    the meeting have no author_fullname
+    """
+
+    # Get information from url arguments
+    password = request.args.get('password')
+
+    if password is None:
+        return jsonify(error="Missing argument: password")
+
+    # Get corresponding meeting
+    meeting = get_meeting_auth(uid)
+
+    if meeting is None:
+        return jsonify(error="Meeting not found", uid=uid)
+
+    # Check password
+    if password != meeting.password:
+        return jsonify(error='Unauthorized: invalid password')
+
+    # Read before the files, a file changed meanwhile changes the ETag again
+    seq = current_seq(meeting.uid)
+    etag = f'{meeting.uid}-{seq}'
+
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        rows = db.session.execute(
+            select(File.uid, File.filename, File.author_uid, Guest.fullname,
+                   Blob.size, File.blob_digest, File.save_path,
+                   File.version, File.updated_at).outerjoin(
+                       Guest, Guest.uid == File.author_uid).outerjoin(
+                           Blob, Blob.digest == File.blob_digest).where(
+                               File.meeting_uid == meeting.uid).order_by(
+                                   File.created_at, File.uid)).all()
+
+        files = [{
+            'uid': row.uid,
+            'filename': row.filename,
+            'author_uid': row.author_uid,
+            'author_fullname': meeting.host_fullname
+            if row.author_uid == meeting.host_uid else row.fullname,
+            'size': row.size if row.size is not None else stored_size(
+                row.save_path),
+            'digest': row.blob_digest,
+            'version': row.version,
+            'updated_at': row.updated_at
+        } for row in rows]
+
+        response = jsonify(
+            files=files,
+            seq=seq,
+            success=f'Meeting with uid({meeting.uid}) file manifest')
+
+    # Cached by the clients, always revalidated
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+
+    return response
+
+
 @app.route('/meetings/<uid>/guests/<guest_uid>/leave', methods=['DELETE'])
 def leave_guest(uid, guest_uid):
     # Get corresponding guest
@@ -361,7 +1993,18 @@ def leave_guest(uid, guest_uid):
 
     else:
         db.session.delete(guest)
-        db.session.commit()
+
+        # The files of the guest lose their author name in the manifest,
+        # its ETag changes with the seq of the event (committed together)
+        if File.query.filter_by(meeting_uid=meeting.uid,
+                                author_uid=guest.uid).first() is not None:
+            log_events(meeting.uid, [('guest left', {
+                'guest_fullname': guest.fullname
+            })])
+        else:
+            db.session.commit()
+
+        invalidate_guest(guest)
 
         return jsonify(success="Guest leaved successfully",
                        guest=guest.as_json())
@@ -373,6 +2016,7 @@ def upload_file(uid):
 
     # Get information from args and form data
     author_uid = request.args.get('author_uid')
+    digest = request.args.get('digest')
     reqFile = request.files.get('file')
 
     # Error checking
@@ -382,79 +2026,390 @@ def upload_file(uid):
     if reqFile is None:
         return jsonify(error="No file attached")
 
+    if not valid_digest(digest):
+        return jsonify(error='Invalid argument: digest', digest=digest)
+
     # Get corresponding meeting
-    meeting = Meeting.query.filter_by(uid=uid).first()
+    meeting = get_meeting_auth(uid)
 
     if meeting is None:
         return jsonify(error='Meeting not found')
 
-    # If author is the host
-    if author_uid == meeting.host_uid:
-        author_fullname = meeting.host_fullname
-    else:
-        # Get corresponding guest
-        guest = Guest.query.filter_by(uid=author_uid).first()
+    author_fullname = get_author_fullname(meeting, author_uid)
 
-        if guest is None:
-            return jsonify(error='Unauthorized: guest not found',
-                           author_uid=author_uid)
-        else:
-            author_fullname = guest.fullname
+    if author_fullname is None:
+        return jsonify(error='Unauthorized: guest not found',
+                       author_uid=author_uid)
 
-    # Check for no duplicate filenames from the same author
-    existingFile = File.query.filter_by(filename=reqFile.filename,
-                                        meeting_uid=meeting.uid,
-                                        author_uid=author_uid).first()
+    # Save the file
+    file = store_file(meeting, author_uid, reqFile.filename, reqFile.save,
+                      digest)
 
-    # If file doesnt exist
-    if existingFile is None:
-        # Create file
-        file_uid = gen_uid()
-        save_path = os.path.join(app.config['UPLOADS'], meeting.uid, file_uid)
+    notify_new_file(meeting, reqFile.filename, author_uid, author_fullname)
 
-        file = File(
-            uid=file_uid,
-            meeting_uid=meeting.uid,
-            author_uid=author_uid,
-            filename=secure_filename(reqFile.filename),
-            local_path='/',  #TODO change this
-            save_path=save_path)
+    return jsonify(message=f'File {reqFile.filename} uploaded successfully',
+                   file=file.as_json())
 
-        # Create meeting folder if doesn't exist
-        meeting_folder = os.path.join(app.config['UPLOADS'], meeting.uid)
 
-        if not os.path.exists(meeting_folder):
-            os.mkdir(meeting_folder)
+@app.route('/meetings/<uid>/files/upload/bulk', methods=['POST'])
+def upload_files(uid):
+    """ Upload many files of an author in one request
 
-        db.session.add(file)
-        db.session.commit()
+    Usage: POST /meetings/<uid>/files/upload/bulk?author_uid=AUTHOR_UID
+           multipart/form-data with a "file" part for every file
+           and an optional "digests" field: {"FILENAME": DIGEST, ...}
 
-    else:
-        # Update existing file
-        save_path = os.path.join(app.config['UPLOADS'], meeting.uid,
-                                 existingFile.uid)
+    The files are stored in one transaction and announced to the room
+    together. A file without a digest is addressed by the SHA-256 of its
+    content, a file sent twice is stored with its last content
+    """
+
+    # Get information from args and form data
+    author_uid = request.args.get('author_uid')
+    reqFiles = request.files.getlist('file')
 
-    # Upload file
-    reqFile.save(save_path)
+    # Error checking
+    if author_uid is None:
+        return jsonify(error='Missing argument: author_uid')
 
-    # Notify the room
-    sio.emit("new file", {
-        'filename': reqFile.filename,
-        'author_uid': author_uid,
-        'author_fullname': author_fullname,
-    },
-             room=uid)
+    if not reqFiles:
+        return jsonify(error="No file attached")
 
-    returnFile = file if existingFile is None else existingFile
+    if len(reqFiles) > app.config['BULK_UPLOAD_MAX_FILES']:
+        return jsonify(error='Too many files',
+                       max_files=app.config['BULK_UPLOAD_MAX_FILES'])
 
-    return jsonify(message=f'File {reqFile.filename} uploaded successfully',
-                   file=returnFile.as_json())
+    try:
+        digests = json.loads(request.form.get('digests', '{}'))
+    except ValueError:
+        return jsonify(error='Invalid information: digests')
+
+    if not isinstance(digests, dict) or not all(
+            isinstance(digest, str) and valid_digest(digest)
+            for digest in digests.values()):
+        return jsonify(error='Invalid information: digests')
+
+    # Get corresponding meeting
+    meeting = get_meeting_auth(uid)
+
+    if meeting is None:
+        return jsonify(error='Meeting not found')
+
+    author_fullname = get_author_fullname(meeting, author_uid)
+
+    if author_fullname is None:
+        return jsonify(error='Unauthorized: guest not found',
+                       author_uid=author_uid)
+
+    # Save the files
+    files = store_files(meeting, author_uid,
+                        [(reqFile.filename, reqFile.save,
+                          digests.get(reqFile.filename)
+                          or content_digest(reqFile.stream))
+                         for reqFile in reqFiles])
+
+    # Serialized before the files expire again
+    files = [file.as_json() for file in files]
+
+    notify_new_files(meeting, [file['filename'] for file in files],
+                     author_uid, author_fullname)
+
+    return jsonify(message=f'{len(files)} files uploaded successfully',
+                   files=files)
+
+
+@app.route('/meetings/<uid>/files/preflight', methods=['POST'])
+def preflight_file(uid):
+    """ Upload a file without its content if the server already has it
+
+    Usage: POST /meetings/<uid>/files/preflight?author_uid=AUTHOR_UID
+           {"filename": FILENAME, "digest": DIGEST}
+
+    The digest is a meeting scoped keyed digest of the plaintext,
+    so files of the meeting with the same content share one blob.
+    If the response has exists: false, the file has to be uploaded
+    with its digest
+    """
+
+    # Get information from args and body
+    author_uid = request.args.get('author_uid')
+    filename = request.json.get('filename')
+    digest = request.json.get('digest')
+
+    # Error checking
+    if author_uid is None:
+        return jsonify(error='Missing argument: author_uid')
+
+    if filename is None:
+        return jsonify(error='Missing information: filename')
+
+    if digest is None or not valid_digest(digest):
+        return jsonify(error='Invalid information: digest', digest=digest)
+
+    # Get corresponding meeting
+    meeting = get_meeting_auth(uid)
+
+    if meeting is None:
+        return jsonify(error='Meeting not found')
+
+    author_fullname = get_author_fullname(meeting, author_uid)
+
+    if author_fullname is None:
+        return jsonify(error='Unauthorized: guest not found',
+                       author_uid=author_uid)
+
+    # The content has to be sent
+    if find_blob(digest) is None:
+        return jsonify(message='Content not stored', exists=False)
+
+    # Point the file to the stored content, unless it was released meanwhile
+    file = store_file(meeting, author_uid, filename, None, digest)
+
+    if file is None:
+        return jsonify(message='Content not stored', exists=False)
+
+    notify_new_file(meeting, filename, author_uid, author_fullname)
+
+    return jsonify(message=f'File {filename} uploaded successfully',
+                   exists=True,
+                   file=file.as_json())
+
+
+@app.route('/meetings/<uid>/files/uploads', methods=['POST'])
+def new_upload_session(uid):
+    """ Start a resumable upload
+
+    Usage: POST /meetings/<uid>/files/uploads?author_uid=AUTHOR_UID
+           {"filename": FILENAME, "size": SIZE, "chunk_size": CHUNK_SIZE,
+            "digest": DIGEST}
+
+    The digest is optional, see preflight_file
+
+    Chunks are then sent with PUT .../uploads/<session_uid>/chunks/<index>
+    and the file is created by POST .../uploads/<session_uid>/commit.
+    A session not committed within UPLOAD_SESSION_TTL is dropped
+    """
+
+    # Get information from args and body
+    author_uid = request.args.get('author_uid')
+    filename = request.json.get('filename')
+    size = request.json.get('size')
+    chunk_size = request.json.get('chunk_size')
+    digest = request.json.get('digest')
+
+    # Error checking
+    if author_uid is None:
+        return jsonify(error='Missing argument: author_uid')
+
+    if filename is None:
+        return jsonify(error='Missing information: filename')
+
+    if not isinstance(size, int) or size < 0:
+        return jsonify(error='Invalid information: size')
+
+    if size > app.config['MAX_UPLOAD_SIZE']:
+        return jsonify(error='File too large',
+                       max_size=app.config['MAX_UPLOAD_SIZE'])
+
+    if not isinstance(chunk_size, int) or not 0 < chunk_size <= app.config[
+            'MAX_UPLOAD_CHUNK_SIZE']:
+        return jsonify(error='Invalid information: chunk_size',
+                       max_chunk_size=app.config['MAX_UPLOAD_CHUNK_SIZE'])
+
+    if not valid_digest(digest):
+        return jsonify(error='Invalid information: digest', digest=digest)
+
+    # Get corresponding meeting
+    meeting = get_meeting_auth(uid)
+
+    if meeting is None:
+        return jsonify(error='Meeting not found')
+
+    if get_author_fullname(meeting, author_uid) is None:
+        return jsonify(error='Unauthorized: guest not found',
+                       author_uid=author_uid)
+
+    # Chunks are written in place in a file of the final size
+    sessions_folder = os.path.join(app.config['UPLOADS'], meeting.uid,
+                                   '.sessions')
+    os.makedirs(sessions_folder, exist_ok=True)
+
+    session_uid = gen_uid()
+    part_path = os.path.join(sessions_folder, session_uid)
+
+    with open(part_path, 'wb') as part:
+        part.truncate(size)
+
+    upload = UploadSession(uid=session_uid,
+                           meeting_uid=meeting.uid,
+                           author_uid=author_uid,
+                           filename=filename,
+                           size=size,
+                           chunk_size=chunk_size,
+                           part_path=part_path,
+                           digest=digest)
+
+    db.session.add(upload)
+
+    # Dropped if it is still not committed after its TTL
+    db.session.execute(
+        insert(Job).values(
+            kind=JOB_EXPIRE_UPLOAD,
+            path=part_path,
+            run_after=datetime.now() +
+            timedelta(seconds=app.config['UPLOAD_SESSION_TTL'])))
+    db.session.commit()
+
+    return jsonify(message='Upload session created',
+                   session=upload.as_json())
+
+
+def get_upload_session(uid, session_uid, author_uid):
+    """ Upload session of the author, None if not found """
+    if author_uid is None:
+        return None
+
+    return UploadSession.query.filter_by(uid=session_uid,
+                                         meeting_uid=uid,
+                                         author_uid=author_uid).first()
+
+
+@app.route('/meetings/<uid>/files/uploads/<session_uid>')
+def get_upload(uid, session_uid):
+    """ Get an upload session with the indexes of its received chunks """
+    upload = get_upload_session(uid, session_uid,
+                                request.args.get('author_uid'))
+
+    if upload is None:
+        return jsonify(error='Upload session not found',
+                       session_uid=session_uid)
+
+    return jsonify(message='Upload session', session=upload.as_json())
+
+
+@app.route('/meetings/<uid>/files/uploads/<session_uid>', methods=['DELETE'])
+def delete_upload(uid, session_uid):
+    """ Drop an upload session and its received chunks """
+    upload = get_upload_session(uid, session_uid,
+                                request.args.get('author_uid'))
+
+    if upload is None:
+        return jsonify(error='Upload session not found',
+                       session_uid=session_uid)
+
+    delete_later(upload.part_path)
+
+    db.session.delete(upload)
+    db.session.commit()
+
+    return jsonify(message='Upload session deleted', session_uid=session_uid)
+
+
+@app.route('/meetings/<uid>/files/uploads/<session_uid>/chunks/<int:index>',
+           methods=['PUT'])
+def upload_chunk(uid, session_uid, index):
+    """ Write a chunk of an upload, sent as the raw request body """
+    upload = get_upload_session(uid, session_uid,
+                                request.args.get('author_uid'))
+
+    if upload is None:
+        return jsonify(error='Upload session not found',
+                       session_uid=session_uid)
+
+    if not 0 <= index < upload.chunk_count():
+        return jsonify(error='Invalid chunk index', index=index)
+
+    length = upload.chunk_length(index)
+
+    if request.content_length != length:
+        return jsonify(error='Invalid chunk length',
+                       index=index,
+                       expected=length)
+
+    # Copy the body straight to its place in the file
+    with open(upload.part_path, 'r+b') as part:
+        part.seek(index * upload.chunk_size)
+
+        remaining = length
+        while remaining > 0:
+            data = request.stream.read(min(BUFFER_SIZE, remaining))
+
+            if not data:
+                return jsonify(error='Incomplete chunk', index=index)
+
+            part.write(data)
+            remaining -= len(data)
+
+    # A chunk sent again is only recorded once,
+    # even when it is sent twice at the same time
+    if UploadChunk.query.get((upload.uid, index)) is None:
+        db.session.add(UploadChunk(session_uid=upload.uid, index=index))
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+    return jsonify(message=f'Chunk {index} received', index=index)
+
+
+@app.route('/meetings/<uid>/files/uploads/<session_uid>/commit',
+           methods=['POST'])
+def commit_upload(uid, session_uid):
+    """ Create the file once every chunk of the upload was received """
+    author_uid = request.args.get('author_uid')
+    upload = get_upload_session(uid, session_uid, author_uid)
+
+    if upload is None:
+        return jsonify(error='Upload session not found',
+                       session_uid=session_uid)
+
+    # Every chunk must have been received
+    received = {chunk.index for chunk in upload.chunks}
+    missing = [i for i in range(upload.chunk_count()) if i not in received]
+
+    if missing:
+        return jsonify(error='Missing chunks', missing=missing)
+
+    meeting = get_meeting_auth(uid)
+
+    if meeting is None:
+        return jsonify(error='Meeting not found')
+
+    author_fullname = get_author_fullname(meeting, author_uid)
+
+    if author_fullname is None:
+        return jsonify(error='Unauthorized: guest not found',
+                       author_uid=author_uid)
+
+    # Move the received file to its place
+    file = store_file(meeting, author_uid, upload.filename,
+                      lambda save_path: os.replace(upload.part_path, save_path),
+                      upload.digest)
+
+    filename = upload.filename
+
+    # The content was already stored
+    if os.path.exists(upload.part_path):
+        os.remove(upload.part_path)
+
+    db.session.delete(upload)
+    db.session.commit()
+
+    notify_new_file(meeting, filename, author_uid, author_fullname)
+
+    return jsonify(message=f'File {filename} uploaded successfully',
+                   file=file.as_json())
 
 
 @app.route('/meetings/<uid>/files/download')
 def download_file(uid):
     # return send_from_directory('.', filename='tux.png', as_attachment=True)
-    """ Download a file """
+    """ Download a file
+
+    Supports Range requests (206 Partial Content) to resume a download,
+    and If-None-Match / If-Range against the file ETag (uid and version)
+    """
 
     # ?filename=enonce.txt&author_fullname=John%20Doe158d&password=9599
 
@@ -474,14 +2429,13 @@ def download_file(uid):
         return jsonify(error="Missing argument: password")
 
     # Get corresponding meeting
-    meeting = Meeting.query.filter_by(uid=uid).first()
+    meeting = get_meeting_auth(uid)
 
     if meeting is None:
         return jsonify(error='Meeting not found')
 
     # Get corresponding guest
-    author = Guest.query.filter_by(meeting_uid=meeting.uid,
-                                   fullname=author_fullname).first()
+    author = get_guest_auth_by_fullname(meeting.uid, author_fullname)
 
     if author is None and author_fullname != meeting.host_fullname:
         return jsonify(error='Guest not found')
@@ -495,7 +2449,7 @@ def download_file(uid):
     # Get corresponding file
     file = File.query.filter_by(meeting_uid=meeting.uid,
                                 author_uid=author_uid,
-                                filename=filename).first()
+                                filename=secure_filename(filename)).first()
 
     # If file not found
     if file is None:
@@ -504,8 +2458,11 @@ def download_file(uid):
                        author_uid=author_uid)
 
     else:
-        folder = os.path.join(app.config['UPLOADS'], meeting.uid)
-        return send_from_directory(folder, file.uid, as_attachment=True)
+        return send_from_directory(os.path.dirname(file.save_path),
+                                   os.path.basename(file.save_path),
+                                   as_attachment=True,
+                                   conditional=True,
+                                   etag=file.etag())
 
 
 @app.route('/meetings/<uid>/files/public/delete', methods=['DELETE'])
@@ -522,7 +2479,7 @@ def delete_public_file(uid):
         return jsonify(error="Missing argument: secret_key")
 
     # Get corresponding meeting
-    meeting = Meeting.query.filter_by(uid=uid).first()
+    meeting = get_meeting_auth(uid)
 
     # If meeting not found
     if meeting is None:
@@ -532,7 +2489,7 @@ def delete_public_file(uid):
         return jsonify(error="Unauthorized: invalid secret_key")
 
     # Get corresponding file
-    saved_filename = filename + '.encrypted'
+    saved_filename = secure_filename(filename + '.encrypted')
     file = File.query.filter_by(meeting_uid=meeting.uid,
                                 filename=saved_filename,
                                 author_uid=meeting.host_uid).first()
@@ -542,17 +2499,21 @@ def delete_public_file(uid):
         return jsonify(error=f'File not found: {filename}')
 
     else:
-        # Delete file from storage
-        if os.path.exists(file.save_path):
-            os.remove(file.save_path)
+        # Release the stored content, deleted with its last file
+        if file.blob is not None or os.path.exists(file.save_path):
+            released = (file.blob_digest, file.save_path)
 
             # Delete file from database
             db.session.delete(file)
+            db.session.flush()
+
+            release_blob(*released)
             db.session.commit()
 
             # Notify room
-            sio.emit('delete file public', {'filename': filename},
-                     room=meeting.uid)
+            notify_file_change(meeting.uid, 'delete file public',
+                               {'filename': filename}, meeting.host_uid,
+                               saved_filename)
 
             return jsonify(success=f"File {filename} deleted successfully")
         else:
@@ -577,14 +2538,14 @@ def delete_guest_file(uid):
         return jsonify(error="Missing argument: password")
 
     # Get corresponding meeting
-    meeting = Meeting.query.filter_by(uid=uid).first()
+    meeting = get_meeting_auth(uid)
 
     # If meeting not found
     if meeting is None:
         return jsonify(error="Meeting not found")
 
     # Get corresponding guest
-    guest = Guest.query.filter_by(uid=author_uid).first()
+    guest = get_guest_auth(author_uid)
 
     # If guest not found
     if guest is None:
@@ -595,7 +2556,7 @@ def delete_guest_file(uid):
         return jsonify(error="Unauthorized: invalid password")
 
     # Get corresponding file
-    saved_filename = filename + '.encrypted'
+    saved_filename = secure_filename(filename + '.encrypted')
     file = File.query.filter_by(meeting_uid=meeting.uid,
                                 filename=saved_filename,
                                 author_uid=guest.uid).first()
@@ -605,35 +2566,78 @@ def delete_guest_file(uid):
         return jsonify(error=f'File not found: {filename}')
 
     else:
-        # Delete file from storage
-        if os.path.exists(file.save_path):
-            os.remove(file.save_path)
+        # Release the stored content, deleted with its last file
+        if file.blob is not None or os.path.exists(file.save_path):
+            released = (file.blob_digest, file.save_path)
 
             # Delete file from database
             db.session.delete(file)
+            db.session.flush()
+
+            release_blob(*released)
             db.session.commit()
 
             # Notify room
-            sio.emit("delete file guest", {
+            notify_file_change(meeting.uid, 'delete file guest', {
                 'filename': filename,
                 'guest_fullname': guest.fullname
-            },
-                     room=meeting.uid)
+            }, guest.uid, saved_filename)
 
             return jsonify(success=f"File {filename} deleted successfully")
         else:
             return jsonify(error="Could not file stored file")
 
 
+@app.route('/stats/cache')
+def cache_stats():
+    """ Hits and misses of the meeting and guest auth caches """
+    return jsonify(meetings=meeting_cache.stats(), guests=guest_cache.stats())
+
+
+@app.route('/stats/presence')
+def presence_stats():
+    """ Meetings, guests and sockets known by the presence registry """
+    return jsonify(presence.stats())
+
+
+@app.route('/stats/events')
+def event_stats():
+    """ File changes batched by this process """
+    return jsonify(files=file_events.stats())
+
+
+@app.route('/stats/jobs')
+def job_stats():
+    """ Jobs waiting in the queue, by status,
+        and work done by the job runner of this process """
+    rows = db.session.execute(
+        select(Job.status, func.count(),
+               func.min(Job.created_at)).group_by(Job.status)).all()
+
+    queue = {
+        status: {
+            'count': count,
+            'oldest': oldest
+        }
+        for status, count, oldest in rows
+    }
+
+    with job_counters_lock:
+        runner = dict(job_counters, started=job_runner_started)
+
+    return jsonify(queue=queue, runner=runner)
+
+
 # Test route
 @app.route("/meetings/<uid>/files/new")
 def ping_meeting(uid):
-    sio.emit("new file", {
-        'filename': request.args.get('filename'),
-        'author_uid': request.args.get('author_uid'),
-        'author_fullname': request.args.get('author_fullname')
-    },
-             room=uid)
+    notify_file_change(
+        uid, 'new file', {
+            'filename': request.args.get('filename'),
+            'author_uid': request.args.get('author_uid'),
+            'author_fullname': request.args.get('author_fullname')
+        }, request.args.get('author_uid'),
+        request.args.get('filename') or '')
 
     return jsonify()
 
@@ -0,0 +1,115 @@
+import threading
+import time
+
+
+class EventBatcher:
+    """ Coalesces the changes sent to every room into batches.
+
+        The changes added to a room are sent together with
+        send(room, changes) window seconds after the first one, or as soon
+        as max_size changes are waiting. A change replaces the waiting
+        change with the same key, a file uploaded then deleted is only
+        sent as deleted.
+
+        The delayed sends run in tasks started by start_task(function,
+        *args) and waiting with sleep(seconds), threads by default
+    """
+    def __init__(self,
+                 send,
+                 window=0.2,
+                 max_size=100,
+                 start_task=None,
+                 sleep=time.sleep):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.start_task = start_task or self._start_thread
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.pending = {}  # room -> {key: change}, in order of last change
+
+        self.changes = 0
+        self.coalesced = 0
+        self.batches = 0
+
+    def add(self, room, key, change):
+        self.add_many(room, [(key, change)])
+
+    def add_many(self, room, changes):
+        """ Add (key, change) pairs to a room at once,
+            they are sent in batches of max_size changes """
+        full = []
+
+        with self.lock:
+            scheduled = batch = self.pending.get(room)
+
+            for key, change in changes:
+                if batch is None:
+                    batch = self.pending[room] = {}
+
+                if key in batch:
+                    del batch[key]
+                    self.coalesced += 1
+
+                batch[key] = change
+                self.changes += 1
+
+                if len(batch) >= self.max_size:
+                    del self.pending[room]
+                    full.append(batch)
+                    batch = None
+
+            # A batch started here is sent after the window
+            waiting = batch if batch is not scheduled else None
+
+        for batch in full:
+            self._send(room, batch)
+
+        if waiting is not None:
+            self.start_task(self._send_later, room, waiting)
+
+    def flush(self):
+        """ Send every waiting batch now """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        for room, batch in pending.items():
+            self._send(room, batch)
+
+    def _send_later(self, room, batch):
+        self.sleep(self.window)
+
+        with self.lock:
+            # Already sent when it was full
+            if self.pending.get(room) is not batch:
+                return
+
+            del self.pending[room]
+
+        self._send(room, batch)
+
+    def _send(self, room, batch):
+        with self.lock:
+            self.batches += 1
+
+        self.send(room, list(batch.values()))
+
+    @staticmethod
+    def _start_thread(function, *args):
+        threading.Thread(target=function, args=args, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'window': self.window,
+                'max_size': self.max_size,
+                'waiting': sum(len(batch) for batch in self.pending.values()),
+                'changes': self.changes,
+                'coalesced': self.coalesced,
+                'batches': self.batches,
+                'changes_per_batch':
+                (self.changes - self.coalesced) / self.batches
+                if self.batches else None
+            }
@@ -0,0 +1,673 @@
+""" Roomdrop server benchmarks
+
+Usage: python3 bench.py lookups [--meetings N] [--files N] [--guests N]
+       python3 bench.py queries [--meetings N,N,...]
+       python3 bench.py writers [--writers N] [--writes N] [--modes MODE,...]
+       python3 bench.py teardown [--files N,N,...]
+       python3 bench.py joins [--guests N,N,...]
+       python3 bench.py filechanges [--uploads N,N,...] [--sockets N]
+       python3 bench.py bulk [--files N,N,...] [--batch N]
+
+Every result is printed as one JSON object per line
+so that runs can be saved and compared.
+"""
+
+import argparse
+import atexit
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+# The benchmarks never use the server database
+DATABASE_FOLDER = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, DATABASE_FOLDER)
+
+os.environ['DATABASE_URL'] = (
+    f'sqlite:///{os.path.join(DATABASE_FOLDER, "db.sqlite3")}')
+os.environ['COUNT_QUERIES'] = '1'
+
+from app import app, db, file_events, guest_cache, meeting_cache, run_jobs
+from app import sio
+from app import Blob, File, Guest, Job, Meeting
+
+# Rows inserted per statement while the database is filled
+BATCH_SIZE = 50000
+
+
+def unique_uid():
+    # 6 characters uids would collide at a million rows
+    return uuid4().hex
+
+
+def report(**result):
+    print(json.dumps(result), flush=True)
+
+
+def fill(engine, meetings, files, guests):
+    """ Insert meetings with their guests, and files spread over them.
+        Returns the inserted meetings, guests and files """
+    meeting_rows = [{
+        'uid': unique_uid(),
+        'title': 'bench',
+        'host_fullname': 'Host',
+        'host_uid': unique_uid(),
+        'password': unique_uid(),
+        'secret_key': unique_uid()
+    } for _ in range(meetings)]
+
+    guest_rows = [{
+        'uid': unique_uid(),
+        'meeting_uid': meeting['uid'],
+        'fullname': f'Guest {i}'
+    } for meeting in meeting_rows for i in range(guests)]
+
+    file_rows = []
+    for i in range(files):
+        # Files are shared by the host and the guests of every meeting
+        meeting = meeting_rows[i % meetings]
+        author = random.randrange(guests + 1)
+        author_uid = meeting['host_uid'] if author == guests else guest_rows[
+            (i % meetings) * guests + author]['uid']
+
+        file_rows.append({
+            'uid': unique_uid(),
+            'meeting_uid': meeting['uid'],
+            'author_uid': author_uid,
+            'filename': f'file-{i}.encrypted',
+            'local_path': '/',
+            'save_path': '/',
+            'version': 1
+        })
+
+    with engine.begin() as connection:
+        for table, rows in ((Meeting.__table__, meeting_rows),
+                            (Guest.__table__, guest_rows),
+                            (File.__table__, file_rows)):
+            for start in range(0, len(rows), BATCH_SIZE):
+                connection.execute(table.insert(),
+                                   rows[start:start + BATCH_SIZE])
+
+    return meeting_rows, guest_rows, file_rows
+
+
+def measure(function, samples):
+    # Average duration of function(sample) in milliseconds
+    start = time.perf_counter()
+    for sample in samples:
+        function(sample)
+
+    return (time.perf_counter() - start) / len(samples) * 1000
+
+
+def bench_lookups(args):
+    """ Latency of the lookups done by the routes, with and without indexes """
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(
+            f'sqlite:///{os.path.join(folder, "bench.sqlite3")}')
+        db.metadata.create_all(engine)
+
+        start = time.perf_counter()
+        meetings, guests, files = fill(engine, args.meetings, args.files,
+                                       args.guests)
+        report(bench='fill',
+               meetings=len(meetings),
+               guests=len(guests),
+               files=len(files),
+               seconds=time.perf_counter() - start)
+
+        file_samples = random.sample(files, args.lookups)
+        guest_samples = random.sample(guests, args.lookups)
+        meeting_samples = random.sample(meetings, args.lookups)
+
+        session = Session(engine)
+
+        # Lookups of the routes, through the ORM like the routes
+        lookups = {
+            'file':
+            (file_samples, lambda f: session.query(File).filter_by(
+                meeting_uid=f['meeting_uid'],
+                author_uid=f['author_uid'],
+                filename=f['filename']).first(),
+             'SELECT * FROM file {} WHERE meeting_uid = :meeting_uid '
+             'AND author_uid = :author_uid AND filename = :filename'),
+            'guest':
+            (guest_samples, lambda g: session.query(Guest).filter_by(
+                meeting_uid=g['meeting_uid'], fullname=g['fullname']).first(),
+             'SELECT * FROM guest {} WHERE meeting_uid = :meeting_uid '
+             'AND fullname = :fullname'),
+            'meeting_files':
+            (meeting_samples, lambda m: session.query(File).filter_by(
+                meeting_uid=m['uid']).all(),
+             'SELECT * FROM file {} WHERE meeting_uid = :uid'),
+            'host_files':
+            (meeting_samples, lambda m: session.query(File).filter_by(
+                meeting_uid=m['uid'], author_uid=m['host_uid']).all(),
+             'SELECT * FROM file {} WHERE meeting_uid = :uid '
+             'AND author_uid = :host_uid'),
+        }
+
+        with engine.connect() as connection:
+            for name, (samples, lookup, sql) in lookups.items():
+                orm = measure(lookup, samples)
+
+                # The same query, then with NOT INDEXED
+                # to make SQLite scan the table like before
+                query = text(sql.format(''))
+                indexed = measure(
+                    lambda sample: connection.execute(query, sample).all(),
+                    samples)
+
+                scan = text(sql.format('NOT INDEXED'))
+                scanned = measure(
+                    lambda sample: connection.execute(scan, sample).all(),
+                    samples[:args.scans])
+
+                plan = connection.execute(
+                    text('EXPLAIN QUERY PLAN ' + sql.format('')),
+                    samples[0]).all()
+
+                report(bench='lookups',
+                       lookup=name,
+                       files=len(files),
+                       orm_ms=orm,
+                       indexed_ms=indexed,
+                       scan_ms=scanned,
+                       speedup=scanned / indexed,
+                       plan=' / '.join(row[-1] for row in plan))
+
+        session.close()
+        engine.dispose()
+
+
+def bench_queries(args):
+    """ Queries per request of the meeting routes as meetings are added,
+        fails if a route doesn't use a constant number of queries """
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+
+    def routes(meeting):
+        return {
+            'meetings': '/meetings',
+            'meetings_full': '/meetings?full=1',
+            'meeting': f'/meetings/{meeting["uid"]}',
+            'meeting_full': f'/meetings/{meeting["uid"]}?full=1',
+            'guests': f'/meetings/{meeting["uid"]}/guests',
+            'manifest': f'/meetings/{meeting["uid"]}/manifest'
+            f'?password={meeting["password"]}',
+        }
+
+    counts = {}
+    total = 0
+
+    for meetings in args.meetings:
+        # Add meetings up to the wanted number, with their guests and files
+        with app.app_context():
+            fill(db.engine, meetings - total, (meetings - total) * args.files,
+                 args.guests)
+
+        total = meetings
+
+        with app.app_context():
+            meeting = Meeting.query.first()
+            meeting = {'uid': meeting.uid, 'password': meeting.password}
+
+        for name, url in routes(meeting).items():
+            # Count the queries of a cold request
+            meeting_cache.clear()
+            guest_cache.clear()
+
+            start = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - start
+
+            queries = int(response.headers['X-Query-Count'])
+            counts.setdefault(name, set()).add(queries)
+
+            report(bench='queries',
+                   route=name,
+                   meetings=meetings,
+                   queries=queries,
+                   ms=elapsed * 1000)
+
+    growing = sorted(name for name, seen in counts.items() if len(seen) > 1)
+
+    report(bench='queries', constant=not growing, growing=growing)
+
+    if growing:
+        sys.exit(1)
+
+
+def write(engine, meeting_uids, writes):
+    """ Joins followed by uploads, like a meeting filling up.
+        Returns the latency of every write in ms and the number of errors """
+    latencies = []
+    errors = 0
+
+    with Session(engine) as session:
+        for _ in range(writes):
+            start = time.perf_counter()
+
+            try:
+                # Read then write in the same transaction, like the routes
+                meeting = session.get(Meeting, random.choice(meeting_uids))
+                guest = Guest(uid=unique_uid(),
+                              meeting_uid=meeting.uid,
+                              fullname=unique_uid())
+                session.add(guest)
+                session.commit()
+
+                session.add(
+                    File(uid=unique_uid(),
+                         meeting_uid=meeting.uid,
+                         author_uid=guest.uid,
+                         filename='handout.encrypted',
+                         local_path='/',
+                         save_path='/'))
+                session.commit()
+            except OperationalError:
+                # database is locked
+                session.rollback()
+                errors += 1
+
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    return latencies, errors
+
+
+def run_writer(url, journal_mode, busy_timeout, meeting_uids, writes):
+    # Every writer is a process with its own engine, like gunicorn workers
+    app.config['SQLITE_JOURNAL_MODE'] = journal_mode
+    app.config['SQLITE_BUSY_TIMEOUT'] = busy_timeout
+
+    engine = create_engine(url)
+    result = write(engine, meeting_uids, writes)
+    engine.dispose()
+
+    return result
+
+
+def bench_writers(args):
+    """ Throughput, latency and errors of parallel writers
+        in rollback journal mode and in WAL mode """
+    # journal mode -> busy timeout: the previous settings
+    # were the rollback journal with the 5 s default timeout of sqlite3
+    modes = {'delete': 5000, 'wal': app.config['SQLITE_BUSY_TIMEOUT']}
+
+    for mode in args.modes:
+        url = f'sqlite:///{os.path.join(DATABASE_FOLDER, mode + ".sqlite3")}'
+
+        app.config['SQLITE_JOURNAL_MODE'] = mode
+        engine = create_engine(url)
+        db.metadata.create_all(engine)
+        meetings, _, _ = fill(engine, 100, 0, 0)
+        engine.dispose()
+
+        meeting_uids = [meeting['uid'] for meeting in meetings]
+
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.writers) as pool:
+            results = pool.starmap(
+                run_writer, [(url, mode, modes[mode], meeting_uids,
+                              args.writes)] * args.writers)
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(latency for result in results
+                           for latency in result[0])
+        errors = sum(result[1] for result in results)
+
+        report(bench='writers',
+               journal_mode=mode,
+               busy_timeout_ms=modes[mode],
+               writers=args.writers,
+               writes=len(latencies),
+               errors=errors,
+               writes_s=(len(latencies) - errors) / elapsed,
+               p50_ms=latencies[len(latencies) // 2],
+               p99_ms=latencies[len(latencies) * 99 // 100])
+
+
+def bench_teardown(args):
+    """ Latency of ending a meeting as its number of files grows,
+        then time taken by the job runner to reclaim the storage """
+    client = app.test_client()
+
+    # Jobs are run here, not by a runner started with the first request
+    app.config['JOB_RUNNER'] = False
+    app.config['UPLOADS'] = os.path.join(DATABASE_FOLDER, 'uploads')
+
+    blobs_folder = os.path.join(app.config['UPLOADS'], '.blobs')
+    os.makedirs(blobs_folder, exist_ok=True)
+
+    with app.app_context():
+        db.create_all()
+
+    for files in args.files:
+        with app.app_context():
+            meetings, _, file_rows = fill(db.engine, 1, files, 0)
+
+            # Every file has its own stored content
+            blob_rows = []
+            for file in file_rows:
+                digest = uuid4().hex * 2
+                save_path = os.path.join(blobs_folder, digest)
+
+                with open(save_path, 'wb') as blob:
+                    blob.write(b'roomdrop')
+
+                blob_rows.append({
+                    'digest': digest,
+                    'size': 8,
+                    'save_path': save_path,
+                    'references': 1
+                })
+                file['blob_digest'] = digest
+
+            with db.engine.begin() as connection:
+                connection.execute(Blob.__table__.insert(), blob_rows)
+                connection.execute(
+                    File.__table__.update().where(
+                        File.uid == bindparam('b_uid')).values(
+                            blob_digest=bindparam('b_digest')),
+                    [{
+                        'b_uid': file['uid'],
+                        'b_digest': file['blob_digest']
+                    } for file in file_rows])
+
+        meeting = meetings[0]
+
+        start = time.perf_counter()
+        response = client.delete(f'/meetings/{meeting["uid"]}/end',
+                                 query_string={
+                                     'secret_key': meeting['secret_key']
+                                 })
+        elapsed = time.perf_counter() - start
+
+        # Drain the queue like the job runner does
+        start = time.perf_counter()
+        with app.app_context():
+            jobs = Job.query.count()
+
+            while run_jobs():
+                pass
+
+        reclaimed = time.perf_counter() - start
+
+        report(bench='teardown',
+               files=files,
+               end_ms=elapsed * 1000,
+               queries=int(response.headers['X-Query-Count']),
+               jobs=jobs,
+               reclaim_seconds=reclaimed,
+               left=len(os.listdir(blobs_folder)))
+
+
+def bench_joins(args):
+    """ Payload sent to a meeting room by a storm of guests joining it """
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+
+    for guests in args.guests:
+        meeting = client.post('/meetings/new',
+                              json={
+                                  'fullname': 'Host',
+                                  'title': 'bench'
+                              }).json['meeting']
+
+        sockets = []
+
+        start = time.perf_counter()
+        for i in range(guests):
+            # Guests join the meeting, then its room
+            client.get('/meetings/join',
+                       query_string={
+                           'uid': meeting['uid'],
+                           'pwd': meeting['password'],
+                           'fullname': f'Guest {i}'
+                       })
+
+            socket = sio.test_client(app)
+            socket.emit('join', {
+                'meeting_uid': meeting['uid'],
+                'guest_fullname': f'Guest {i}'
+            })
+            sockets.append(socket)
+        elapsed = time.perf_counter() - start
+
+        # Bytes of the events every socket received
+        received = [socket.get_received() for socket in sockets]
+        payload = sum(
+            len(app.json.dumps(event['args'])) for events in received
+            for event in events)
+
+        report(bench='joins',
+               guests=guests,
+               events=sum(len(events) for events in received),
+               payload_bytes=payload,
+               bytes_per_join=payload / guests,
+               ms_per_join=elapsed / guests * 1000)
+
+        for socket in sockets:
+            socket.disconnect()
+
+
+def bench_filechanges(args):
+    """ Events sent to a meeting room by a burst of uploads, to the
+        sockets receiving every change and to those receiving batches """
+    app.config['UPLOADS'] = os.path.join(DATABASE_FOLDER, 'uploads')
+    os.makedirs(app.config['UPLOADS'], exist_ok=True)
+
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+
+    for uploads in args.uploads:
+        meeting = client.post('/meetings/new',
+                              json={
+                                  'fullname': 'Host',
+                                  'title': 'bench'
+                              }).json['meeting']
+
+        sockets = {False: [], True: []}
+
+        for batch_files, group in sockets.items():
+            for i in range(args.sockets):
+                socket = sio.test_client(app)
+                socket.emit('join', {
+                    'meeting_uid': meeting['uid'],
+                    'batch_files': batch_files
+                })
+                socket.get_received()
+                group.append(socket)
+
+        start = time.perf_counter()
+        for i in range(uploads):
+            client.post(f'/meetings/{meeting["uid"]}/files/upload',
+                        query_string={'author_uid': meeting['host_uid']},
+                        data={'file': (io.BytesIO(b'%d' % i), f'{i}.encrypted')})
+        elapsed = time.perf_counter() - start
+
+        # Last batch
+        time.sleep(app.config['FILE_EVENTS_WINDOW'] * 2)
+        file_events.flush()
+
+        for batch_files, group in sockets.items():
+            received = [socket.get_received() for socket in group]
+
+            report(bench='filechanges',
+                   uploads=uploads,
+                   batch_files=batch_files,
+                   events_per_socket=sum(len(events)
+                                         for events in received) / len(group),
+                   payload_bytes_per_socket=sum(
+                       len(app.json.dumps(event['args']))
+                       for events in received for event in events) / len(group),
+                   ms_per_upload=elapsed / uploads * 1000)
+
+            for socket in group:
+                socket.disconnect()
+
+
+def bench_bulk(args):
+    """ Small files uploaded one request each or by bulk uploads """
+    app.config['UPLOADS'] = os.path.join(DATABASE_FOLDER, 'uploads')
+    os.makedirs(app.config['UPLOADS'], exist_ok=True)
+
+    client = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+
+    for files in args.files:
+        for bulk in (False, True):
+            meeting = client.post('/meetings/new',
+                                  json={
+                                      'fullname': 'Host',
+                                      'title': 'bench'
+                                  }).json['meeting']
+
+            contents = [(f'{i}.encrypted', os.urandom(512))
+                        for i in range(files)]
+            queries = 0
+
+            start = time.perf_counter()
+            if bulk:
+                for first in range(0, files, args.batch):
+                    response = client.post(
+                        f'/meetings/{meeting["uid"]}/files/upload/bulk',
+                        query_string={'author_uid': meeting['host_uid']},
+                        data={
+                            'file': [(io.BytesIO(content), filename)
+                                     for filename, content in
+                                     contents[first:first + args.batch]]
+                        })
+                    queries += int(response.headers['X-Query-Count'])
+            else:
+                for filename, content in contents:
+                    response = client.post(
+                        f'/meetings/{meeting["uid"]}/files/upload',
+                        query_string={'author_uid': meeting['host_uid']},
+                        data={'file': (io.BytesIO(content), filename)})
+                    queries += int(response.headers['X-Query-Count'])
+            elapsed = time.perf_counter() - start
+
+            report(bench='bulk',
+                   files=files,
+                   bulk=bulk,
+                   requests=-(-files // args.batch) if bulk else files,
+                   queries=queries,
+                   ms=elapsed * 1000,
+                   ms_per_file=elapsed / files * 1000)
+
+    # Last batches of file events
+    file_events.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roomdrop server benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    lookups = commands.add_parser('lookups', help=bench_lookups.__doc__)
+    lookups.add_argument('--meetings', type=int, default=10000)
+    lookups.add_argument('--files', type=int, default=1000000)
+    lookups.add_argument('--guests',
+                         type=int,
+                         default=5,
+                         help='per meeting')
+    lookups.add_argument('--lookups',
+                         type=int,
+                         default=1000,
+                         help='indexed lookups per query')
+    lookups.add_argument('--scans',
+                         type=int,
+                         default=20,
+                         help='lookups per query without indexes')
+    lookups.set_defaults(run=bench_lookups)
+
+    queries = commands.add_parser('queries', help=bench_queries.__doc__)
+    queries.add_argument('--meetings',
+                         type=lambda sizes: [int(s) for s in sizes.split(',')],
+                         default=[1, 10, 100, 1000],
+                         help='comma separated numbers of meetings')
+    queries.add_argument('--guests',
+                         type=int,
+                         default=5,
+                         help='per meeting')
+    queries.add_argument('--files',
+                         type=int,
+                         default=10,
+                         help='per meeting')
+    queries.set_defaults(run=bench_queries)
+
+    writers = commands.add_parser('writers', help=bench_writers.__doc__)
+    writers.add_argument('--writers', type=int, default=16)
+    writers.add_argument('--writes',
+                         type=int,
+                         default=200,
+                         help='joins and uploads per writer')
+    writers.add_argument('--modes',
+                         type=lambda modes: modes.split(','),
+                         default=['delete', 'wal'],
+                         help='comma separated journal modes')
+    writers.set_defaults(run=bench_writers)
+
+    teardown = commands.add_parser('teardown', help=bench_teardown.__doc__)
+    teardown.add_argument(
+        '--files',
+        type=lambda sizes: [int(s) for s in sizes.split(',')],
+        default=[10, 100, 1000, 10000],
+        help='comma separated numbers of files')
+    teardown.set_defaults(run=bench_teardown)
+
+    joins = commands.add_parser('joins', help=bench_joins.__doc__)
+    joins.add_argument('--guests',
+                       type=lambda sizes: [int(s) for s in sizes.split(',')],
+                       default=[10, 100, 500],
+                       help='comma separated numbers of guests')
+    joins.set_defaults(run=bench_joins)
+
+    filechanges = commands.add_parser('filechanges',
+                                      help=bench_filechanges.__doc__)
+    filechanges.add_argument(
+        '--uploads',
+        type=lambda sizes: [int(s) for s in sizes.split(',')],
+        default=[10, 100, 500],
+        help='comma separated numbers of uploads')
+    filechanges.add_argument('--sockets',
+                             type=int,
+                             default=10,
+                             help='sockets of each kind')
+    filechanges.set_defaults(run=bench_filechanges)
+
+    bulk = commands.add_parser('bulk', help=bench_bulk.__doc__)
+    bulk.add_argument('--files',
+                      type=lambda sizes: [int(s) for s in sizes.split(',')],
+                      default=[100, 1000],
+                      help='comma separated numbers of files')
+    bulk.add_argument('--batch',
+                      type=int,
+                      default=100,
+                      help='files per bulk upload')
+    bulk.set_defaults(run=bench_bulk)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
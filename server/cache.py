@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by get() when a key isn't cached,
+# since None can be a cached value
+MISSING = object()
+
+
+class LRUCache:
+    """ Least recently used cache whose entries expire after ttl seconds.
+
+        Once maxsize entries are cached, adding one evicts the entry
+        that was used the longest time ago. Hits, misses and evictions
+        are counted for stats()
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Cached value of key, MISSING if it isn't cached or expired """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] <= time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return MISSING
+
+            # Most recently used entries are at the end
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, load, cache_none=True):
+        """ Cached value of key, or the value of load() that is then cached.
+            With cache_none=False, None is loaded again every time """
+        value = self.get(key)
+
+        if value is MISSING:
+            value = load()
+
+            if value is not None or cache_none:
+                self.set(key, value)
+
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else None
+            }
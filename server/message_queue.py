@@ -0,0 +1,262 @@
+""" Message queue sharing the Socket.IO rooms of the server workers
+
+Every worker listens to the queue, so an event emitted to a room by one
+worker reaches the clients of the room connected to any worker.
+
+The redis://, amqp://, kafka:// and zmq+tcp:// queues of flask_socketio
+are supported. This module adds a loopback queue that needs no service,
+for tests and for the workers of a single machine:
+
+    loopback://                  the workers of this process
+    loopback://127.0.0.1:5555    the processes connected to a broker
+
+Usage: python3 message_queue.py [--host HOST] [--port PORT]
+
+runs the broker of a loopback://HOST:PORT queue.
+"""
+
+import argparse
+import logging
+import queue
+import socket
+import socketserver
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+from socketio import PubSubManager
+
+# First line sent to the broker by the connections receiving the messages
+SUBSCRIBE = b'subscribe\n'
+
+# Seconds between two attempts to reach the broker
+RECONNECT_DELAY = 1
+
+
+class LoopbackManager(PubSubManager):
+    """ Socket.IO client manager publishing to a loopback queue.
+
+        Without a host, messages go to the managers of this process.
+        With a host, they are sent as JSON lines to a LoopbackBroker
+        that sends them to every subscribed manager
+    """
+    name = 'loopback'
+
+    # Queues of the managers of this process, for loopback://
+    local_subscribers = []
+    local_lock = threading.Lock()
+
+    def __init__(self,
+                 url='loopback://',
+                 channel='socketio',
+                 write_only=False,
+                 logger=None,
+                 json=None):
+        super().__init__(channel=channel,
+                         write_only=write_only,
+                         logger=logger,
+                         json=json)
+
+        url = urlparse(url)
+        self.address = (url.hostname, url.port) if url.hostname else None
+
+        self.lock = threading.Lock()
+        self.connection = None  # Publishing connection to the broker
+
+    def _publish(self, data):
+        message = {'channel': self.channel, 'data': data}
+
+        if self.address is None:
+            with self.local_lock:
+                subscribers = list(self.local_subscribers)
+
+            for subscriber in subscribers:
+                subscriber.put(message)
+            return
+
+        line = self.json.dumps(message).encode() + b'\n'
+
+        with self.lock:
+            # Connect again once if the broker restarted
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connection = socket.create_connection(
+                            self.address)
+
+                    self.connection.sendall(line)
+                    return
+                except OSError:
+                    self.connection = None
+
+                    if attempt == 1:
+                        self._get_logger().error(
+                            'Cannot publish to the loopback broker')
+
+    def _listen(self):
+        if self.address is None:
+            yield from self._listen_local()
+        else:
+            yield from self._listen_broker()
+
+    def _listen_local(self):
+        subscriber = queue.Queue()
+
+        with self.local_lock:
+            self.local_subscribers.append(subscriber)
+
+        while True:
+            message = subscriber.get()
+
+            if message['channel'] == self.channel:
+                yield message['data']
+
+    def _listen_broker(self):
+        while True:
+            try:
+                connection = socket.create_connection(self.address)
+                connection.sendall(SUBSCRIBE)
+
+                for line in connection.makefile('rb'):
+                    message = self.json.loads(line)
+
+                    if message['channel'] == self.channel:
+                        yield message['data']
+            except OSError:
+                self._get_logger().error(
+                    'Cannot listen to the loopback broker, retrying')
+
+            time.sleep(RECONNECT_DELAY)
+
+
+class LoopbackBroker(socketserver.ThreadingTCPServer):
+    """ Sends every line it receives to the subscribed connections """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def broadcast(self, line):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.sendall(line)
+            except OSError:
+                self.unsubscribe(subscriber)
+
+    def subscribe(self, connection):
+        with self.lock:
+            self.subscribers.add(connection)
+
+    def unsubscribe(self, connection):
+        with self.lock:
+            self.subscribers.discard(connection)
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        first = self.rfile.readline()
+
+        # Subscribers only receive, until they disconnect
+        if first == SUBSCRIBE:
+            self.server.subscribe(self.request)
+
+            try:
+                while self.rfile.readline():
+                    pass
+            finally:
+                self.server.unsubscribe(self.request)
+            return
+
+        # Publishers only send
+        line = first
+        while line:
+            self.server.broadcast(line)
+            line = self.rfile.readline()
+
+
+def queue_class(url):
+    """ Client manager class of a queue url, picked like flask_socketio """
+    if url.startswith('loopback://'):
+        return LoopbackManager
+    elif url.startswith(('redis://', 'rediss://')):
+        return socketio.RedisManager
+    elif url.startswith('kafka://'):
+        return socketio.KafkaManager
+    elif url.startswith('zmq'):
+        return socketio.ZmqManager
+    else:
+        return socketio.KombuManager
+
+
+def client_manager(url,
+                   channel='flask-socketio',
+                   on_remote_emit=None,
+                   json=None):
+    """ Client manager of the queue at url, publishing with the json
+        module given to the Socket.IO server.
+
+        on_remote_emit(event, data, room) is called for the events that
+        aren't binary emitted by the other processes, before they are sent
+        to the clients of this process. The manager then listens to the
+        queue as soon as it is given to the server, rather than from the
+        first connection, so on_remote_emit sees every remote event
+    """
+    base = queue_class(url)
+
+    if on_remote_emit is None:
+        return base(url, channel=channel, json=json)
+
+    class Manager(base):
+        listening = False
+
+        def set_server(self, server):
+            super().set_server(server)
+            self.initialize()
+
+        def initialize(self):
+            # python-socketio 5 (pinned in requirements.txt) initializes
+            # the manager again on the first connection, listen only once
+            if self.listening:
+                return
+
+            self.listening = True
+            super().initialize()
+
+        def _handle_emit(self, message):
+            # Also called for the events emitted by this process,
+            # binary events are never watched
+            if (message.get('host_id') != self.host_id
+                    and not message.get('binary')):
+                # Events are published with a list of arguments
+                data = message['data']
+                data = data[0] if len(data) == 1 else tuple(data)
+
+                on_remote_emit(message['event'], data, message.get('room'))
+
+            super()._handle_emit(message)
+
+    return Manager(url, channel=channel, json=json)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback queue broker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.info(f'Loopback broker on loopback://{args.host}:{args.port}')
+
+    LoopbackBroker((args.host, args.port)).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
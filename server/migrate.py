@@ -0,0 +1,217 @@
+""" Migrate an existing database to the current models
+
+Usage: python3 migrate.py
+
+SQLite can't change the type of a column or add a constraint to a table,
+so every table whose schema differs from its model is rebuilt:
+the table is renamed, created again from the model and its rows are copied.
+Missing tables are created, tables that didn't change are left untouched.
+
+Rows breaking a new unique constraint are skipped and reported, the
+storage of the skipped files is deleted by the job runners.
+"""
+
+from sqlalchemy import insert, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app import JOB_DELETE, Job, app, db
+
+
+def expected_schema(table, connection):
+    # SQL of the table and its indexes as SQLite stores it
+    dialect = connection.dialect
+    statements = [str(CreateTable(table).compile(dialect=dialect))]
+    statements += [
+        str(CreateIndex(index).compile(dialect=dialect))
+        for index in table.indexes
+    ]
+
+    return sorted(statement.strip() for statement in statements)
+
+
+def current_schema(table_name, connection):
+    # Automatic indexes of unique constraints have no SQL
+    rows = connection.execute(
+        text('SELECT sql FROM sqlite_master '
+             'WHERE tbl_name = :name AND sql IS NOT NULL'), {
+                 'name': table_name
+             }).scalars()
+
+    return sorted(row.strip() for row in rows)
+
+
+def restored_uids():
+    """ File.meeting_uid and File.author_uid used to be integer columns:
+        SQLite stored the uids made of digits as numbers, losing their
+        leading zeros. Their text uids are taken back from the meetings
+        and guests while the rows are copied
+    """
+    meeting_uid = ('(SELECT uid FROM meeting '
+                   'WHERE CAST(uid AS INTEGER) = old.meeting_uid)')
+    guest_uid = ('(SELECT uid FROM guest '
+                 'WHERE CAST(uid AS INTEGER) = old.author_uid)')
+    host_uid = ('(SELECT host_uid FROM meeting '
+                'WHERE CAST(host_uid AS INTEGER) = old.author_uid)')
+
+    return {
+        'meeting_uid':
+        "CASE WHEN typeof(old.meeting_uid) = 'integer' "
+        f'THEN COALESCE({meeting_uid}, old.meeting_uid) '
+        'ELSE old.meeting_uid END',
+        'author_uid':
+        "CASE WHEN typeof(old.author_uid) = 'integer' "
+        f'THEN COALESCE({guest_uid}, {host_uid}, old.author_uid) '
+        'ELSE old.author_uid END'
+    }
+
+
+def rebuild(table, connection):
+    """ Create the table from its model again and copy its rows,
+        returns the number of copied and skipped rows, and the
+        (uid, save_path) of the skipped rows of the file table """
+    old_name = f'_old_{table.name}'
+
+    connection.execute(
+        text(f'ALTER TABLE "{table.name}" RENAME TO "{old_name}"'))
+
+    # The indexes follow the renamed table, free their names
+    indexes = connection.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'index' "
+             'AND tbl_name = :name AND sql IS NOT NULL'), {
+                 'name': old_name
+             }).scalars().all()
+
+    for index in indexes:
+        connection.execute(text(f'DROP INDEX "{index}"'))
+
+    table.create(connection)
+
+    old_columns = {
+        row[1]
+        for row in connection.execute(
+            text(f'PRAGMA table_info("{old_name}")'))
+    }
+
+    # Copy the columns the old table has,
+    # new columns get the default of their model
+    names = []
+    values = []
+    params = {}
+    expressions = restored_uids() if table.name == 'file' else {}
+
+    # New columns computed from the old ones
+    filled = {}
+
+    if table.name == 'file' and 'created_at' in old_columns:
+        filled['updated_at'] = 'old.created_at'
+
+    # Numbered after the events already logged
+    if table.name == 'meeting' and connection.execute(
+            text("SELECT 1 FROM sqlite_master "
+                 "WHERE type = 'table' AND name = 'meeting_event'")).first():
+        filled['event_seq'] = ('(SELECT COALESCE(MAX(seq), 0) '
+                               'FROM meeting_event '
+                               'WHERE meeting_uid = old.uid)')
+
+    for column in table.columns:
+        if column.name in old_columns:
+            names.append(f'"{column.name}"')
+            values.append(
+                expressions.get(column.name, f'old."{column.name}"'))
+
+        elif column.name in filled:
+            names.append(f'"{column.name}"')
+            values.append(filled[column.name])
+
+        elif column.default is not None and column.default.is_scalar:
+            names.append(f'"{column.name}"')
+            values.append(f':{column.name}')
+            params[column.name] = column.default.arg
+
+        # Computed once for every row (ex: datetime.now)
+        elif column.default is not None and column.default.is_callable:
+            names.append(f'"{column.name}"')
+            values.append(f':{column.name}')
+            params[column.name] = column.default.arg(None)
+
+    total = connection.execute(
+        text(f'SELECT COUNT(*) FROM "{old_name}"')).scalar()
+
+    # Rows breaking a unique constraint are skipped
+    copied = connection.execute(
+        text(f'INSERT OR IGNORE INTO "{table.name}" ({", ".join(names)}) '
+             f'SELECT {", ".join(values)} FROM "{old_name}" AS old'),
+        params).rowcount
+
+    dropped = []
+
+    if table.name == 'file' and copied < total:
+        dropped = connection.execute(
+            text(f'SELECT uid, save_path FROM "{old_name}" '
+                 'WHERE uid NOT IN (SELECT uid FROM file) '
+                 'ORDER BY uid')).all()
+
+    connection.execute(text(f'DROP TABLE "{old_name}"'))
+
+    return copied, total - copied, dropped
+
+
+def delete_dropped_files(dropped, connection):
+    """ Queue the deletion of the storage of the dropped files,
+        unless a copied file or a blob uses it """
+    used = set(
+        connection.execute(
+            text('SELECT save_path FROM file '
+                 'UNION SELECT save_path FROM blob')).scalars())
+
+    paths = sorted({save_path for uid, save_path in dropped} - used)
+
+    if paths:
+        connection.execute(insert(Job.__table__), [{
+            'kind': JOB_DELETE,
+            'path': path
+        } for path in paths])
+
+    return paths
+
+
+def migrate():
+    dropped = []
+
+    with app.app_context(), db.engine.begin() as connection:
+        # Renaming a table must not rewrite the foreign keys pointing to it
+        connection.execute(text('PRAGMA legacy_alter_table = ON'))
+
+        tables = set(
+            connection.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'table'")).
+            scalars())
+
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                table.create(connection)
+                print(f'{table.name}: created')
+
+            elif current_schema(table.name, connection) != expected_schema(
+                    table, connection):
+                copied, skipped, files = rebuild(table, connection)
+                print(f'{table.name}: rebuilt, {copied} rows copied, '
+                      f'{skipped} duplicates skipped')
+
+                for uid, save_path in files:
+                    print(f'  skipped file {uid}: {save_path}')
+
+                dropped += files
+
+            else:
+                print(f'{table.name}: up to date')
+
+        # Every table exists by now
+        if dropped:
+            paths = delete_dropped_files(dropped, connection)
+            print(f'{len(paths)} stored files of the skipped rows '
+                  'queued for deletion')
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,117 @@
+import threading
+from collections import Counter
+
+
+class PresenceRegistry:
+    """ Guests present in every meeting, kept in memory.
+
+        The sockets of this process are registered by join(), leave() and
+        disconnect(), which tell when the first socket of a guest joined a
+        meeting and when its last one left. Every process is then told
+        with apply(), so that fullnames() lists the guests present through
+        any process, in joining order, and the clients are only told when
+        a guest joined its first process or left its last one.
+
+        A process only learns the changes made after it started
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.sockets = {}  # sid -> {meeting_uid: fullname}
+        self.local = {}  # meeting_uid -> Counter(fullname: sockets)
+        self.present = {}  # meeting_uid -> Counter(fullname: processes)
+
+    def join(self, meeting_uid, sid, fullname):
+        """ Register a socket joining a meeting, fullname is None for the
+            host. True if it is the first socket of the guest here """
+        with self.lock:
+            meetings = self.sockets.setdefault(sid, {})
+
+            # Joined twice
+            if meeting_uid in meetings:
+                return False
+
+            meetings[meeting_uid] = fullname
+
+            if fullname is None:
+                return False
+
+            local = self.local.setdefault(meeting_uid, Counter())
+            local[fullname] += 1
+
+            return local[fullname] == 1
+
+    def leave(self, meeting_uid, sid):
+        """ Unregister a socket leaving a meeting. Returns the fullname of
+            the guest if it was its last socket here, None otherwise """
+        with self.lock:
+            return self._leave(meeting_uid, sid)
+
+    def disconnect(self, sid):
+        """ Unregister a disconnected socket from its meetings. Returns the
+            (meeting_uid, fullname) of the guests whose last socket it was """
+        with self.lock:
+            left = [(meeting_uid, self._leave(meeting_uid, sid))
+                    for meeting_uid in list(self.sockets.get(sid, {}))]
+
+        return [(meeting_uid, fullname) for meeting_uid, fullname in left
+                if fullname is not None]
+
+    def _leave(self, meeting_uid, sid):
+        meetings = self.sockets.get(sid, {})
+
+        if meeting_uid not in meetings:
+            return None
+
+        fullname = meetings.pop(meeting_uid)
+
+        if not meetings:
+            del self.sockets[sid]
+
+        if fullname is None:
+            return None
+
+        local = self.local[meeting_uid]
+        local[fullname] -= 1
+
+        if local[fullname] > 0:
+            return None
+
+        del local[fullname]
+
+        if not local:
+            del self.local[meeting_uid]
+
+        return fullname
+
+    def apply(self, meeting_uid, fullname, joined):
+        """ A guest joined a meeting through a process, or left it.
+            True if it is now present through one process, or none """
+        with self.lock:
+            present = self.present.setdefault(meeting_uid, Counter())
+            present[fullname] += 1 if joined else -1
+
+            if joined:
+                changed = present[fullname] == 1
+            else:
+                changed = present[fullname] <= 0
+
+            if present[fullname] <= 0:
+                del present[fullname]
+
+            if not present:
+                del self.present[meeting_uid]
+
+            return changed
+
+    def fullnames(self, meeting_uid):
+        with self.lock:
+            return list(self.present.get(meeting_uid, ()))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'meetings': len(self.present),
+                'guests': sum(len(p) for p in self.present.values()),
+                'sockets': len(self.sockets)
+            }
@@ -0,0 +1,457 @@
+""" Multi-worker harness of the Socket.IO events
+
+Usage: python3 workers.py [--workers N] [--clients N] [--queue URL]
+
+Starts N server processes sharing a database, an uploads folder and a
+message queue, connects Socket.IO clients spread over the workers, then
+checks that the join, message, upload and leave events of every worker
+reach the clients of every worker. Half of the clients join with
+batch_files and must get the upload in a "files changed" event instead.
+A guest joining again through another worker must catch up with the
+uploads it missed, a guest connected through two workers is only gone
+once it left both, and a meeting ended through one worker must be
+forgotten by the others.
+
+Without --queue, a loopback broker is started in this process.
+Every check is printed as one JSON object per line,
+the harness exits with 1 if one of them fails.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+from message_queue import LoopbackBroker
+
+# Seconds to wait for a worker to start and for an event to arrive
+TIMEOUT = 10
+
+
+def report(**result):
+    print(json.dumps(result), flush=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_worker(args):
+    """ Serve the app on the given port, with the environment settings """
+    from app import app, sio
+
+    sio.run(app,
+            host='127.0.0.1',
+            port=args.port,
+            log_output=False,
+            allow_unsafe_werkzeug=True)
+
+
+def create_tables():
+    from app import app, db
+
+    with app.app_context():
+        db.create_all()
+
+
+def wait_until_up(url):
+    deadline = time.monotonic() + TIMEOUT
+
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{url}/meetings', timeout=1)
+            return True
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    return False
+
+
+class Client:
+    """ Socket.IO client of one worker recording the events it receives """
+    EVENTS = ('snapshot', 'catch up', 'new join', 'new message', 'new file',
+              'files changed', 'leaved')
+
+    def __init__(self, url, fullname, batch_files=False):
+        self.url = url
+        self.fullname = fullname
+        self.batch_files = batch_files
+
+        self.condition = threading.Condition()
+        self.received = []  # (event, data)
+
+        self.sio = socketio.Client()
+
+        for name in self.EVENTS:
+            self.sio.on(name, self._recorder(name))
+
+        self.sio.connect(url)
+
+    def _recorder(self, name):
+
+        def record(data):
+            with self.condition:
+                self.received.append((name, data))
+                self.condition.notify_all()
+
+        return record
+
+    def wait_for(self, name, match, deadline):
+        """ True once an event name whose data matches was received,
+            False if it wasn't before the time.monotonic() deadline """
+        with self.condition:
+            while True:
+                if any(event == name and match(data)
+                       for event, data in self.received):
+                    return True
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+                self.condition.wait(remaining)
+
+
+def check(name, clients, event, match, start):
+    """ Report whether every client received the event """
+    deadline = time.monotonic() + TIMEOUT
+
+    missing = [
+        client.fullname for client in clients
+        if not client.wait_for(event, match, deadline)
+    ]
+
+    report(check=name,
+           event=event,
+           clients=len(clients),
+           missing=missing,
+           ms=(time.perf_counter() - start) * 1000,
+           passed=not missing)
+
+    return not missing
+
+
+def run_checks(urls, clients_count):
+    """ Events emitted by one worker must reach the clients of all of them """
+    meeting = requests.post(f'{urls[0]}/meetings/new',
+                            json={
+                                'fullname': 'Host',
+                                'title': 'workers'
+                            }).json()['meeting']
+
+    passed = True
+    clients = []
+
+    # Guests join through every worker
+    for i in range(clients_count):
+        url = urls[i % len(urls)]
+        fullname = f'Guest {i}'
+
+        guest = requests.get(f'{url}/meetings/join',
+                             params={
+                                 'uid': meeting['uid'],
+                                 'pwd': meeting['password'],
+                                 'fullname': fullname
+                             }).json()['guest']
+
+        client = Client(url, fullname, batch_files=i % 2 == 1)
+        client.uid = guest['uid']
+        clients.append(client)
+
+        start = time.perf_counter()
+        client.sio.emit(
+            'join', {
+                'meeting_uid': meeting['uid'],
+                'guest_fullname': fullname,
+                'batch_files': client.batch_files
+            })
+
+        # The guest gets every guest joined through any worker,
+        # the others only the new guest
+        fullnames = [other.fullname for other in clients]
+
+        passed &= check(f'snapshot {i}', [client], 'snapshot',
+                        lambda data: data.get('guests') == fullnames, start)
+        passed &= check(f'join {i}', clients[:-1], 'new join',
+                        lambda data: data.get('guest_fullname') == fullname,
+                        start)
+
+    # A message sent through the first worker
+    start = time.perf_counter()
+    clients[0].sio.emit('message', {
+        'meeting_uid': meeting['uid'],
+        'from': clients[0].fullname,
+        'text': 'hello'
+    })
+
+    passed &= check('message', clients, 'new message',
+                    lambda data: data.get('text') == 'hello', start)
+
+    # An upload through the last worker, emitted from an HTTP request
+    start = time.perf_counter()
+    requests.post(f'{urls[-1]}/meetings/{meeting["uid"]}/files/upload',
+                  params={'author_uid': meeting['host_uid']},
+                  files={'file': ('handout.encrypted', b'roomdrop')})
+
+    passed &= check('upload',
+                    [client for client in clients if not client.batch_files],
+                    'new file', lambda data: 'handout' in json.dumps(data),
+                    start)
+    passed &= check('batched upload',
+                    [client for client in clients if client.batch_files],
+                    'files changed',
+                    lambda data: 'handout' in json.dumps(data.get('added')),
+                    start)
+
+    # Each client got the upload once, in one of the two forms
+    twice = [
+        client.fullname for client in clients
+        if sum(event in ('new file', 'files changed')
+               for event, data in client.received) != 1
+    ]
+    report(check='upload once', missing=twice, passed=not twice)
+    passed &= not twice
+
+    # The last guest leaves, the others must hear it
+    leaving = clients.pop()
+
+    start = time.perf_counter()
+    leaving.sio.emit('leave', {
+        'meeting_uid': meeting['uid'],
+        'guest_fullname': leaving.fullname
+    })
+
+    passed &= check(
+        'leave', clients, 'leaved',
+        lambda data: data.get('guest_fullname') == leaving.fullname, start)
+
+    # Another guest closes its connection without leaving
+    leaving.sio.disconnect()
+    leaving = clients.pop()
+
+    start = time.perf_counter()
+    leaving.sio.disconnect()
+
+    passed &= check(
+        'disconnect', clients, 'leaved',
+        lambda data: data.get('guest_fullname') == leaving.fullname, start)
+
+    # A guest misses an upload while disconnected, then joins again
+    # through another worker with the seq of the last event it received
+    leaving = clients.pop(0)
+
+    start = time.perf_counter()
+    leaving.sio.disconnect()
+
+    passed &= check(
+        'reconnect', clients, 'leaved',
+        lambda data: data.get('guest_fullname') == leaving.fullname, start)
+
+    last_seq = max(data['seq'] for event, data in leaving.received
+                   if event == 'new file')
+
+    requests.post(f'{urls[-1]}/meetings/{meeting["uid"]}/files/upload',
+                  params={'author_uid': meeting['host_uid']},
+                  files={'file': ('notes.encrypted', b'roomdrop')})
+
+    client = Client(urls[1 % len(urls)], leaving.fullname)
+    clients.append(client)
+
+    start = time.perf_counter()
+    client.sio.emit(
+        'join', {
+            'meeting_uid': meeting['uid'],
+            'guest_fullname': client.fullname,
+            'last_seq': last_seq
+        })
+
+    passed &= check(
+        'catch up', [client], 'catch up', lambda data: [
+            change['filename'] for change in data.get('events', [])
+        ] == ['notes.encrypted'], start)
+
+    # A late guest only sees the guests still here
+    client = Client(urls[0], 'Late guest')
+    client.sio.emit('join', {'meeting_uid': meeting['uid']})
+    fullnames = [other.fullname for other in clients]
+
+    start = time.perf_counter()
+    passed &= check('roster', [client], 'snapshot',
+                    lambda data: data.get('guests') == fullnames, start)
+
+    clients.append(client)
+
+    # A guest connected through two workers leaves one of them:
+    # the others must only hear it once it left both
+    requests.get(f'{urls[0]}/meetings/join',
+                 params={
+                     'uid': meeting['uid'],
+                     'pwd': meeting['password'],
+                     'fullname': 'Twin'
+                 })
+    twins = [Client(urls[0], 'Twin'), Client(urls[-1], 'Twin')]
+
+    for twin in twins:
+        twin.sio.emit('join', {
+            'meeting_uid': meeting['uid'],
+            'guest_fullname': 'Twin'
+        })
+
+    start = time.perf_counter()
+    passed &= check('twin join', clients, 'new join',
+                    lambda data: data.get('guest_fullname') == 'Twin', start)
+
+    twins[0].sio.emit('leave', {'meeting_uid': meeting['uid']})
+
+    # Given the time to reach every worker
+    time.sleep(1)
+    heard = [
+        client.fullname for client in clients
+        if any(event == 'leaved' and data.get('guest_fullname') == 'Twin'
+               for event, data in client.received)
+    ]
+    report(check='twin still here', heard=heard, passed=not heard)
+    passed &= not heard
+
+    start = time.perf_counter()
+    twins[1].sio.emit('leave', {'meeting_uid': meeting['uid']})
+
+    passed &= check('twin leave', clients, 'leaved',
+                    lambda data: data.get('guest_fullname') == 'Twin', start)
+
+    for client in clients + twins:
+        client.sio.disconnect()
+
+    # The meeting is cached by every worker, ending it through the first
+    # one must make the others forget it right away, not after the TTL
+    manifest = lambda url: requests.get(
+        f'{url}/meetings/{meeting["uid"]}/manifest',
+        params={
+            'password': meeting['password']
+        }).json()
+
+    for url in urls:
+        manifest(url)
+
+    start = time.perf_counter()
+    requests.delete(f'{urls[0]}/meetings/{meeting["uid"]}/end',
+                    params={'secret_key': meeting['secret_key']})
+
+    forgotten = []
+
+    while time.perf_counter() - start < TIMEOUT:
+        forgotten = [url for url in urls if 'error' in manifest(url)]
+
+        if len(forgotten) == len(urls):
+            break
+
+        time.sleep(0.05)
+
+    report(check='end',
+           forgotten=len(forgotten),
+           workers=len(urls),
+           ms=(time.perf_counter() - start) * 1000,
+           passed=len(forgotten) == len(urls))
+    passed &= len(forgotten) == len(urls)
+
+    return passed
+
+
+def run_harness(args):
+    folder = tempfile.mkdtemp()
+    broker = None
+    workers = []
+
+    queue = args.queue
+
+    if queue is None:
+        broker = LoopbackBroker(('127.0.0.1', 0))
+        threading.Thread(target=broker.serve_forever, daemon=True).start()
+        queue = f'loopback://127.0.0.1:{broker.server_address[1]}'
+
+    # The workers share the database and the uploads folder of the cwd
+    env = dict(os.environ,
+               DATABASE_URL=f'sqlite:///{os.path.join(folder, "db.sqlite3")}',
+               SOCKETIO_MESSAGE_QUEUE=queue)
+
+    try:
+        subprocess.run([sys.executable, __file__, 'tables'],
+                       env=env,
+                       cwd=folder,
+                       check=True)
+
+        ports = [free_port() for _ in range(args.workers)]
+
+        for port in ports:
+            workers.append(
+                subprocess.Popen(
+                    [sys.executable, __file__, 'worker', '--port',
+                     str(port)],
+                    env=env,
+                    cwd=folder,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL))
+
+        urls = [f'http://127.0.0.1:{port}' for port in ports]
+
+        if not all(wait_until_up(url) for url in urls):
+            report(check='workers', queue=queue, passed=False)
+            return False
+
+        report(check='workers', queue=queue, workers=len(urls), passed=True)
+
+        return run_checks(urls, args.clients)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+        if broker is not None:
+            broker.shutdown()
+            broker.server_close()
+
+        shutil.rmtree(folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Multi-worker harness of the Socket.IO events')
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--clients',
+                        type=int,
+                        default=6,
+                        help='spread over the workers')
+    parser.add_argument('--queue',
+                        help='message queue url, '
+                        'a loopback broker is started by default')
+
+    commands = parser.add_subparsers(dest='command')
+
+    worker = commands.add_parser('worker', help=run_worker.__doc__)
+    worker.add_argument('--port', type=int, required=True)
+
+    commands.add_parser('tables')
+
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        run_worker(args)
+    elif args.command == 'tables':
+        create_tables()
+    elif not run_harness(args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()